@@ -0,0 +1,304 @@
+"""
+Times every stage of the KML pipeline and every output endpoint on synthetic
+MapMil feeds served by a local stand-in upstream, and writes throughput,
+p50/p99 latency and peak traced memory per (size, case) as JSON so runs can be
+compared.
+
+    python bench/pipeline.py [--sizes 100,1000,10000,50000] [--out run.json]
+                             [--compare baseline.json] [--only refresh,/mapmil.kml]
+
+Sizes are placemark counts (units plus their routes). Endpoint cases drop the
+feed's rendered outputs before every request, so they time a render, not a
+cache hit; the "(cached)" case times the hit path. With --compare, p50s more
+than --threshold times the baseline's are listed and the exit status is 1.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import kml_proxy as kp
+from synthetic import synthetic_sources
+
+BASE_URL = "http://localhost"  # what the Flask test client's requests resolve to
+DEFAULT_SIZES = (100, 1000, 10000, 50000)
+DEFAULT_RUNS = {100: 50, 1000: 20, 10000: 5, 50000: 3}  # larger sizes: fewer, longer runs
+
+# -------------------------
+# Stand-in upstream: /recent, /full (with ETags, so unchanged polls get 304) and /icons/*
+# -------------------------
+class Upstream(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    bodies = {}  # path -> bytes
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path.startswith("/icons/"):
+            body, ctype = b"\x89PNG\r\n\x1a\n" + hashlib.sha256(path.encode()).digest() * 8, "image/png"
+        elif path in self.bodies:
+            body, ctype = self.bodies[path], "application/vnd.google-earth.kml+xml"
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        etag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_upstream() -> str:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Upstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+def configure_proxy(upstream: str) -> None:
+    # Inline refreshes only, never on a timer, so a request never pays for one
+    kp.SOURCE_KML_RECENT = upstream + "/recent"
+    kp.SOURCE_KML_FULL = upstream + "/full"
+    kp.ALLOWED_ICON_PREFIX = upstream + "/icons/"
+    kp.ICON_CACHE_DIR = tempfile.mkdtemp(prefix="kml-proxy-bench-icons-")
+    kp.BACKGROUND_REFRESH = False
+    kp.CACHE_SECONDS = 10 ** 9
+    kp.CACHE_BACKEND = "memory"
+    kp.FEEDS = kp.load_feed_registry(None)
+
+# -------------------------
+# Measurement
+# -------------------------
+def percentile(samples: list[float], pct: float) -> float:
+    # Nearest rank, so p99 of a handful of runs is their maximum
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))]
+
+def peak_memory(fn, setup=None) -> int:
+    """Peak traced Python allocation while fn() runs, above what was live before it."""
+    tracemalloc.start()
+    try:
+        if setup:
+            setup()
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        fn()
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+def measure(fn, runs: int, setup=None, memory: bool = True) -> dict:
+    if setup:
+        setup()
+    out = fn()  # warm-up: imports, icon store, lazily built renditions
+    samples = []
+    for _ in range(runs):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    mean = statistics.fmean(samples)
+    return {
+        "runs": runs,
+        "p50_ms": statistics.median(samples) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "mean_ms": mean * 1000,
+        "ops_per_s": 1 / mean if mean else None,
+        "output_bytes": len(out) if isinstance(out, (str, bytes)) else None,
+        "peak_mem_bytes": peak_memory(fn, setup) if memory else None,
+    }
+
+# -------------------------
+# Cases
+# -------------------------
+def stage_cases(recent: str, full: str) -> list[tuple[str, object, object]]:
+    """(name, fn, setup) for each pipeline stage on its own, fed what precedes it in production."""
+    state = kp.new_merge_state()
+    merged, gdh_by_id = kp.merge_kml_incremental(state, {kp.SOURCE_PRIORITY_RECENT: recent,
+                                                         kp.SOURCE_PRIORITY_FULL: full})
+    records = state["records"]
+    flagged = kp.flag_stale_placemarks_in_kml(merged, BASE_URL)
+    grouped = kp.group_route_placemarks_into_folders(flagged)
+    moved = kp.move_stale_items_to_inativos_folder(grouped, kp.INATIVOS_FOLDER_NAME)
+    rendered = kp.run_kml_pipeline(merged, BASE_URL, kp.PIPELINE_FULL, gdh_by_id=gdh_by_id)
+    return [
+        ("transform_kml_scales", lambda: kp.transform_kml_scales(full), None),
+        ("merge_kml_two_sources", lambda: kp.merge_kml_two_sources(recent, full), None),
+        ("merge_kml_incremental", lambda: kp.merge_kml_incremental(
+            kp.new_merge_state(), {kp.SOURCE_PRIORITY_RECENT: recent, kp.SOURCE_PRIORITY_FULL: full})[0], None),
+        ("flag_stale_placemarks_in_kml", lambda: kp.flag_stale_placemarks_in_kml(merged, BASE_URL), None),
+        ("group_route_placemarks_into_folders", lambda: kp.group_route_placemarks_into_folders(flagged), None),
+        ("move_stale_items_to_inativos_folder",
+         lambda: kp.move_stale_items_to_inativos_folder(grouped, kp.INATIVOS_FOLDER_NAME), None),
+        ("sort_kml_document_alphabetically", lambda: kp.sort_kml_document_alphabetically(moved), None),
+        ("run_kml_pipeline", lambda: kp.run_kml_pipeline(merged, BASE_URL, kp.PIPELINE_FULL,
+                                                         gdh_by_id=gdh_by_id), None),
+        ("render_records", lambda: kp.render_records(records, BASE_URL, kp.PIPELINE_FULL), None),
+        ("build_kmz_with_embedded_icons", lambda: kp.build_kmz_with_embedded_icons(rendered, BASE_URL), None),
+    ]
+
+def drop_rendered(feed: kp.Feed) -> None:
+    feed.render_cache.clear()
+    feed.live_current.clear()
+    feed.live_history.clear()
+    feed.live_updates.clear()
+    feed.live_usage.clear()
+    feed.index.update(gen=None, index=None)
+
+def forget_sources(feed: kp.Feed) -> None:
+    feed.source_state.clear()
+    feed.merge_state = kp.new_merge_state()
+
+def endpoint_cases(client, feed: kp.Feed) -> list[tuple[str, object, object]]:
+    def get(path: str, **headers):
+        def call() -> bytes:
+            resp = client.get(path, headers=headers)
+            body = resp.get_data()
+            if resp.status_code != 200 or b"KML Proxy Error" in body[:2048]:
+                raise RuntimeError(f"{path}: {resp.status_code} {body[:200]!r}")
+            return body
+        return call
+
+    cold = lambda: drop_rendered(feed)
+    cases = [
+        ("refresh (cold)", lambda: kp.refresh_merged_kml(feed)[0], lambda: forget_sources(feed)),
+        ("refresh (304)", lambda: kp.refresh_merged_kml(feed)[0], None),
+    ]
+    for path in ("/mapmil", "/mapmil.kml", "/mapmil.kmz", "/mapmil_atak.kmz",
+                 "/mapmil_live.kml", "/mapmil_live_base.kml", "/mapmil_update.kml?since=resync",
+                 "/mapmil.kml?bbox=-9,37,-8,38"):
+        cases.append((path, get(path), cold))
+    cases.append(("/mapmil.kml (cached)", get("/mapmil.kml", **{"Accept-Encoding": "gzip"}), None))
+    return cases
+
+def run_size(size: int, args, upstream: str) -> list[dict]:
+    # synthetic_feed adds a route to ~route_ratio of the units
+    units = max(1, round(size / (1 + args.route_ratio)))
+    recent, full = synthetic_sources(units, time.time(), stale_ratio=args.stale_ratio,
+                                     route_ratio=args.route_ratio, icon_variety=args.icons,
+                                     icon_base=upstream + "/icons/", seed=args.seed)
+    Upstream.bodies = {"/recent": recent.encode("utf-8"), "/full": full.encode("utf-8")}
+    kp.FEEDS = kp.load_feed_registry(None)
+    feed = kp.get_feed()
+    kp.refresh_merged_kml(feed)
+    placemarks = len(feed.cache["records"])
+
+    runs = args.runs or DEFAULT_RUNS.get(size, 3)
+    cases = [("stage", *c) for c in stage_cases(recent, full)]
+    cases += [("endpoint", *c) for c in endpoint_cases(kp.app.test_client(), feed)]
+    results = []
+    for kind, name, fn, setup in cases:
+        if args.only and not any(sel in name for sel in args.only):
+            continue
+        row = {"size": size, "placemarks": placemarks, "kind": kind, "case": name,
+               **measure(fn, runs, setup, memory=not args.no_memory)}
+        row["placemarks_per_s"] = placemarks / (row["mean_ms"] / 1000) if row["mean_ms"] else None
+        results.append(row)
+        mem = "" if row["peak_mem_bytes"] is None else f"  peak {row['peak_mem_bytes'] / 2 ** 20:8.1f} MiB"
+        print(f"{size:>6} {name:<40} p50 {row['p50_ms']:9.2f} ms  p99 {row['p99_ms']:9.2f} ms"
+              f"  {row['placemarks_per_s']:>12,.0f} pm/s{mem}", file=sys.stderr)
+    return results
+
+# -------------------------
+# Reporting
+# -------------------------
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results: list[dict], baseline_path: str, threshold: float) -> list[str]:
+    """Lines for every (size, case) whose p50 grew beyond threshold x the baseline run's."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {(r["size"], r["case"]): r for r in json.load(f)["results"]}
+    slower = []
+    for row in results:
+        old = baseline.get((row["size"], row["case"]))
+        if old and old["p50_ms"] and row["p50_ms"] > old["p50_ms"] * threshold:
+            slower.append(f"{row['size']:>6} {row['case']:<40} p50 {old['p50_ms']:9.2f} -> "
+                          f"{row['p50_ms']:9.2f} ms ({row['p50_ms'] / old['p50_ms']:.2f}x)")
+    return slower
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma-separated placemark counts")
+    parser.add_argument("--runs", type=int, help="timed runs per case (default depends on size)")
+    parser.add_argument("--only", type=lambda s: [p for p in s.split(",") if p],
+                        help="comma-separated substrings of the case names to run")
+    parser.add_argument("--stale-ratio", type=float, default=0.3)
+    parser.add_argument("--route-ratio", type=float, default=0.3)
+    parser.add_argument("--icons", type=int, default=17, help="distinct icon URLs")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--render-processes", type=int, default=0,
+                        help="RENDER_PROCESSES for the endpoint cases (0: render in this process)")
+    parser.add_argument("--out", help="write the JSON here instead of stdout")
+    parser.add_argument("--compare", help="JSON of an earlier run to check p50s against")
+    parser.add_argument("--threshold", type=float, default=1.10)
+    args = parser.parse_args(argv)
+
+    upstream = start_upstream()
+    configure_proxy(upstream)
+    kp.RENDER_PROCESSES = args.render_processes
+    results = []
+    try:
+        for size in (int(s) for s in args.sizes.split(",") if s):
+            results += run_size(size, args, upstream)
+    finally:
+        kp.stop_render_processes()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "params": {k: v for k, v in vars(args).items() if k not in ("out", "compare", "threshold")},
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        slower = compare(results, args.compare, args.threshold)
+        for line in slower:
+            print(f"slower: {line}", file=sys.stderr)
+        return 1 if slower else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
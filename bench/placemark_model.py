@@ -0,0 +1,78 @@
+"""
+Compares the retained ElementTree placemarks (what the merge state held before
+PlacemarkRecord) with PlacemarkRecords, and the ElementTree render pipeline with
+the record renderer.
+
+    python bench/placemark_model.py [units ...]
+"""
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import kml_proxy as kp
+from synthetic import synthetic_feed
+
+BASE_URL = "http://localhost:8000"
+
+def retained_bytes(build) -> tuple[object, int]:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, after - before
+
+def build_elements(feed: str) -> list:
+    # One source as the merge state held it: parsed, scaled element plus its serialization
+    out = []
+    for pm in ET.fromstring(feed).find("kml:Document", kp.KML_NS).findall("kml:Placemark", kp.KML_NS):
+        kp.scale_styles_in_tree(pm)
+        out.append((pm, kp.serialize_fragment(pm)))
+    return out
+
+def build_records(feed: str) -> list:
+    out = []
+    for pm in ET.fromstring(feed).find("kml:Document", kp.KML_NS).findall("kml:Placemark", kp.KML_NS):
+        gdh = kp.gdh_epoch_of(pm)
+        kp.scale_styles_in_tree(pm)
+        out.append(kp.PlacemarkRecord(pm, gdh))
+    return out
+
+def timed(fn, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t0)
+    return statistics.median(samples)
+
+def run(units: int, repeat: int = 5) -> None:
+    now = time.time()
+    feed = synthetic_feed(units, now)
+    elements, mem_tree = retained_bytes(lambda: build_elements(feed))
+    records, mem_records = retained_bytes(lambda: build_records(feed))
+    n = len(records)
+
+    state = kp.new_merge_state()
+    merged, gdh_by_id = kp.merge_kml_incremental(state, {kp.SOURCE_PRIORITY_FULL: feed})
+    recs = state["records"]
+    kp.render_records(recs, BASE_URL)  # warm the stale renditions, as a long-running process has them
+    t_tree = timed(lambda: kp.run_kml_pipeline(merged, BASE_URL, kp.PIPELINE_FULL, gdh_by_id=gdh_by_id), repeat)
+    t_records = timed(lambda: kp.render_records(recs, BASE_URL, kp.PIPELINE_FULL), repeat)
+
+    print(f"placemarks={n}")
+    print(f"  retained per placemark: tree {mem_tree / n:8.0f} B   records {mem_records / n:8.0f} B"
+          f"   ({mem_tree / max(mem_records, 1):.1f}x smaller)")
+    print(f"  /mapmil.kml render:     tree {t_tree * 1000:8.1f} ms  records {t_records * 1000:8.1f} ms"
+          f"  ({t_tree / max(t_records, 1e-9):.1f}x faster)")
+    del elements
+
+if __name__ == "__main__":
+    for arg in sys.argv[1:] or ["500", "5000"]:
+        run(int(arg))
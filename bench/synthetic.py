@@ -0,0 +1,52 @@
+"""
+Synthetic MapMil-like feeds for the benchmarks: one <Placemark> per unit with a
+GDH description, an inline style and a point; some units also get a "<id>_route"
+line. Deterministic for a given seed.
+"""
+import datetime
+import random
+
+MONTHS = ["JAN", "FEV", "MAR", "ABR", "MAI", "JUN", "JUL", "AGO", "SET", "OUT", "NOV", "DEZ"]
+ICON_BASE = "https://mapmil.igeoe.pt/localizador/kmlMarkers/"
+
+def gdh_text(ts: float) -> str:
+    d = datetime.datetime.fromtimestamp(ts)
+    return f"{d.day:02d}{MONTHS[d.month - 1]}{d.year % 100:02d} {d:%H:%M:%S}.{d.microsecond // 1000:03d}"
+
+def synthetic_feed(units: int, now: float, stale_ratio: float = 0.3, route_ratio: float = 0.3,
+                   seed: int = 1, icon_variety: int = 17, icon_base: str = ICON_BASE) -> str:
+    rnd = random.Random(seed)
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+           '<Document>\n<name>Synthetic</name>\n']
+    for i in range(units):
+        age = rnd.uniform(4000, 90000) if rnd.random() < stale_ratio else rnd.uniform(0, 3000)
+        name = rnd.choice(["Alfa", "Bravo", "Charlie", "Delta", "Écho"]) + f" {i}"
+        lon, lat = -9 + rnd.random() * 2, 37 + rnd.random() * 4
+        out.append(
+            f'<Placemark id="u{i}"><name>{name}</name>'
+            f'<description><![CDATA[Unidade {i}<br>GDH de recepção do último sinal:<br> {gdh_text(now - age)}'
+            f'<br>Velocidade: {rnd.randint(0, 90)} km/h]]></description>'
+            f'<Style><IconStyle><scale>1</scale><Icon><href>{icon_base}m{i % icon_variety}.png</href></Icon></IconStyle>'
+            f'<LabelStyle><scale>1</scale></LabelStyle></Style>'
+            f'<Point><coordinates>{lon:.6f},{lat:.6f},0</coordinates></Point></Placemark>\n'
+        )
+        if rnd.random() < route_ratio:
+            pts = " ".join(f"{lon + k * 0.001:.6f},{lat + k * 0.001:.6f},0" for k in range(8))
+            out.append(
+                f'<Placemark id="u{i}_route"><name>{name} rota</name>'
+                f'<Style><LineStyle><width>2</width></LineStyle></Style>'
+                f'<LineString><coordinates>{pts}</coordinates></LineString></Placemark>\n'
+            )
+    out.append("</Document>\n</kml>\n")
+    return "".join(out)
+
+def synthetic_sources(units: int, now: float, recent_ratio: float = 0.2, **kwargs) -> tuple[str, str]:
+    """
+    (recent, full) like the two upstream URLs: the full feed has every unit, the
+    recent one re-reports the first `recent_ratio` of them with fresh GDHs, so
+    the merge has overlaps to resolve. kwargs go to synthetic_feed.
+    """
+    full = synthetic_feed(units, now, **kwargs)
+    recent_kwargs = dict(kwargs, stale_ratio=0.0, seed=kwargs.get("seed", 1) + 1)
+    recent = synthetic_feed(max(1, int(units * recent_ratio)), now, **recent_kwargs)
+    return recent, full
@@ -1,6 +1,16 @@
-from flask import Flask, Response, request, send_from_directory
-import requests, time, re, certifi, io, zipfile, hashlib, os
+from flask import Flask, Response, abort, request, send_from_directory
+import requests, time, re, stat, certifi, zipfile, hashlib, os, threading, json, tempfile, struct, zlib, gzip, datetime, bisect, html, socket, sys
+import multiprocessing
 from urllib.parse import urlparse
+from abc import ABC, abstractmethod
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from collections.abc import Callable, Iterable, Iterator
+from operator import attrgetter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import xml.etree.ElementTree as ET
 
 app = Flask(__name__)
@@ -10,15 +20,69 @@ app = Flask(__name__)
 # -------------------------
 SOURCE_KML_RECENT = "https://mapmil.igeoe.pt/localizador/kml/104BM80_30eff84?h=5"
 SOURCE_KML_FULL   = "https://mapmil.igeoe.pt/localizador/kml/104BM80_30eff84"
+FEEDS_CONFIG_FILE = os.path.join(os.path.dirname(__file__), "feeds.json")  # optional extra feeds, see README
+DEFAULT_FEED_NAME = "default"                  # the SOURCE_KML_* pair, also served on the unprefixed routes
+MEMORY_BUDGET_BYTES = 256 * 1024 * 1024        # merged documents + rendered outputs of all feeds together
 
 ICON_SCALE = 1.7
 LABEL_SCALE = 0.7
 
+USER_AGENT = "KML-Proxy/ATAK-1.2"
+UPSTREAM_TIMEOUT_SECONDS = 15                  # read timeout; read timeouts are not retried
+UPSTREAM_CONNECT_TIMEOUT_SECONDS = 5
+UPSTREAM_RETRIES = 2                           # per request, on connect errors and 429/5xx
+UPSTREAM_BACKOFF_SECONDS = 0.5                 # urllib3 backoff_factor: retries wait 0, 1, 2, 4, ... s
+UPSTREAM_POOL_SIZE = 8                         # keep-alive connections per host (>= ICON_FETCH_CONCURRENCY + 2)
+STREAM_INGEST = True                           # parse feeds placemark by placemark off the socket
+STREAM_INGEST_CHUNK_BYTES = 64 * 1024
+
 CACHE_SECONDS = 10
+BACKGROUND_REFRESH = True                      # refresh feeds off the request path
+REFRESH_INTERVAL_SECONDS = CACHE_SECONDS
+STALE_BUCKET_SECONDS = 10                      # rendered outputs are reused within one bucket
+RENDER_CACHE_MAX_ENTRIES = 32
+RENDER_WAIT_SECONDS = 60                       # a miss waits this long for another thread's render of its key, then renders itself
+CACHE_BACKEND = "memory"                       # "memory" (per process), "file" (workers on one host) or "redis"
+CACHE_SHARED_DIR = (f"/dev/shm/kml-proxy-{os.getuid()}" if os.path.isdir("/dev/shm")  # created 0700, must be ours
+                    else os.path.join(os.path.dirname(__file__), "cache", "shared"))
+CACHE_SHARED_PRUNE_INTERVAL_SECONDS = 60       # expired files in CACHE_SHARED_DIR are removed this often
+CACHE_REDIS_URL = "redis://localhost:6379/0"
+CACHE_KEY_PREFIX = "kml-proxy"
+REFRESH_LEASE_SECONDS = 60                     # longest one worker may hold a feed's refresh lease
+OUTPUT_CACHE_CONTROL = "no-cache, max-age=0, must-revalidate"  # clients may keep a copy but revalidate every poll
+COMPRESS_LEVEL = 6                             # gzip/deflate copies of cached KML bodies
+COMPRESS_MIN_BYTES = 1024                      # smaller bodies are always sent as-is
 ALLOW_INSECURE_SSL = False
 
 ALLOWED_ICON_PREFIX = "https://mapmil.igeoe.pt/localizador/kmlMarkers/"
 ICON_CACHE_SECONDS = 3600
+ICON_FETCH_TIMEOUT_SECONDS = 10
+ICON_CACHE_DIR = os.path.join(os.path.dirname(__file__), "cache", "icons")  # shared by all workers
+ICON_CACHE_MAX_BYTES = 64 * 1024 * 1024        # LRU-evicted above this
+ICON_CACHE_MAX_AGE_SECONDS = 7 * 24 * 3600     # entries unused for longer are dropped
+ICON_CACHE_PRUNE_INTERVAL_SECONDS = 300
+ICON_MEMORY_CACHE_MAX_ENTRIES = 512            # in-process layer in front of the disk store
+KMZ_STORE_ICONS = True                         # PNG/JPEG don't shrink under DEFLATE; store them as-is
+
+STREAM_RESPONSES = False                       # stream render-cache misses instead of buffering them
+STREAM_CHUNK_BYTES = 64 * 1024
+STREAM_CACHE_MAX_BYTES = 16 * 1024 * 1024      # streamed bodies up to this size still fill the render cache
+RENDER_PROCESSES = 0                           # > 0: render-cache misses (pipeline + KMZ build) run in this many worker processes
+ICON_FETCH_CONCURRENCY = 6                     # parallel icon downloads, process-wide
+ICON_FETCH_DEADLINE_SECONDS = 20               # per KMZ build; late icons are left out
+ICON_RETRY_AFTER_SECONDS = 30                  # KMZ builds leave out an icon whose download failed this recently
+
+INDEX_GRID_DEGREES = 0.25                      # spatial grid cell size for ?bbox= queries
+INDEX_MAX_CELLS_PER_ITEM = 64                  # longer routes go to a list checked on every bbox query
+
+METRICS_ENABLED = True                         # /metrics (Prometheus text format) and the timers behind it
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)  # seconds
+
+LIVE_REFRESH_SECONDS = STALE_BUCKET_SECONDS    # update poll interval advertised by /mapmil_live.kml
+LIVE_HISTORY_SIZE = 90                         # snapshots kept per base URL to diff client tokens against
+LIVE_MAX_BASE_URLS = 8                         # base URLs (Host headers) with live state; least recently used dropped
+LIVE_DOCUMENT_ID = "mapmil"                    # <Document id> targeted by <Create>
+LIVE_INATIVOS_FOLDER_ID = "inativos"
 
 STALE_THRESHOLD_SECONDS = 3600
 STALE_ICON_PATH = "/static/stale.png"          # served by this app
@@ -37,14 +101,162 @@ ET.register_namespace("", KML_NS_URI)
 ET.register_namespace("gx", "http://www.google.com/kml/ext/2.2")
 ET.register_namespace("atom", "http://www.w3.org/2005/Atom")
 
-_cache = {"ts": 0.0, "kml": None}
-_icon_cache = {}  # url -> (ts, bytes, content_type)
+# Merge, render, live and index state is per feed: see Feed / FEEDS
+_render_lock = threading.Lock()  # guards every feed's cache + render cache (they share MEMORY_BUDGET_BYTES)
+_refresher = {"lock": threading.Lock()}
+_backend = {"backend": None, "lock": threading.Lock()}  # see get_cache_backend()
+_upstream = {"session": None, "pool": None, "icon_pool": None, "lock": threading.Lock()}
+_icon_cache = {}  # url -> (ts, bytes, content_type); bounded front of the disk icon store
+_icon_failures = {}  # url -> (ts, error) of the last failed download, see ICON_RETRY_AFTER_SECONDS
+_icon_store = {"last_prune": 0.0, "lock": threading.Lock()}
+_zip_entry_cache = {}  # (embedded_path, crc32, size) -> _ZipEntry, reused across KMZ builds
+_render_processes = {"pool": None, "lock": threading.Lock()}  # see render_pool()
+_worker_documents = {}  # in a render worker process: feed name -> (gen, kml, records)
 
 HREF_RE = r"<(?:\w+:)?href>\s*([^<]+)\s*</(?:\w+:)?href>"
 
+# -------------------------
+# Metrics: per-process counters and histograms, exposed at /metrics
+# -------------------------
+def _label_value(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _label_text(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_label_value(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    """Monotonic total per label tuple; inc() is a dict update under a lock."""
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def expose(self) -> list[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_label_text(self.labels, k)} {v}" for k, v in items]
+
+class Histogram:
+    """Observations per label tuple in METRICS_BUCKETS (upper bounds, seconds) plus sum and count."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets: tuple = METRICS_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, tuple(buckets)
+        self._series = {}  # label values -> [per-bucket counts (last is +Inf), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        if not METRICS_ENABLED:
+            return
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def observe_since(self, started: float, *label_values) -> None:
+        """observe(perf_counter() - started): the usual way to time a block."""
+        self.observe(time.perf_counter() - started, *label_values)
+
+    def expose(self) -> list[str]:
+        with self._lock:
+            items = [(k, list(s[0]), s[1], s[2]) for k, s in self._series.items()]
+        lines = []
+        for k, counts, total, n in items:
+            cumulative = 0
+            for bound, c in zip((*self.buckets, "+Inf"), counts):
+                cumulative += c
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_label_text(self.labels, k, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, k)} {total}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, k)} {n}")
+        return lines
+
+METRIC_UPSTREAM_SECONDS = Histogram(
+    "kml_proxy_upstream_request_seconds",
+    "Upstream GETs; streamed feeds include parsing the body as it arrives", ("kind",))
+METRIC_UPSTREAM_RESPONSES = Counter(
+    "kml_proxy_upstream_responses_total",
+    "Upstream GETs by outcome (changed, not_modified, unchanged, fetched, error, expired_copy)", ("kind", "outcome"))
+METRIC_UPSTREAM_BYTES = Counter("kml_proxy_upstream_bytes_total", "Response bytes read from upstream", ("kind",))
+METRIC_REFRESH_SECONDS = Histogram(
+    "kml_proxy_refresh_seconds", "Fetch + merge of both sources of a feed", ("feed", "outcome"))
+METRIC_SNAPSHOT_SECONDS = Histogram(
+    "kml_proxy_snapshot_seconds", "Request-path wait for the merged document (first merge or inline refresh)",
+    ("feed",))
+METRIC_STAGE_SECONDS = Histogram(
+    "kml_proxy_stage_seconds", "Time per processing stage of the tree or record pipeline, the merge and KMZ builds",
+    ("pipeline", "stage"))
+METRIC_RENDER_SECONDS = Histogram(
+    "kml_proxy_render_seconds", "Render-cache misses: merged document to response body", ("feed", "variant"))
+METRIC_RENDER_CACHE = Counter(
+    "kml_proxy_render_cache_total", "Render-cache lookups (hit, miss, shared = rendered by another worker)",
+    ("feed", "variant", "result"))
+METRIC_ICON_CACHE = Counter("kml_proxy_icon_cache_total", "Icon lookups served without (hit) or needing (miss) a download",
+                            ("result",))
+METRICS = [METRIC_UPSTREAM_SECONDS, METRIC_UPSTREAM_RESPONSES, METRIC_UPSTREAM_BYTES, METRIC_REFRESH_SECONDS,
+           METRIC_SNAPSHOT_SECONDS, METRIC_STAGE_SECONDS, METRIC_RENDER_SECONDS, METRIC_RENDER_CACHE,
+           METRIC_ICON_CACHE]
+
+def _feed_gauges() -> list[tuple[str, str, list[tuple[str, float]]]]:
+    # Read at scrape time from each feed's current merge rather than tracked on every change
+    now = time.time()
+    rows = {"placemarks": [], "stale": [], "gen": [], "bytes": [], "success": []}
+    for feed in list(FEEDS.values()):
+        with _render_lock:
+            records, gen, size = feed.cache["records"], feed.cache["gen"], feed.cache["bytes"]
+        rows["gen"].append((feed.name, gen))
+        rows["bytes"].append((feed.name, size))
+        rows["success"].append((feed.name, feed.refresh_stats["last_success"]))
+        if records is not None:
+            rows["placemarks"].append((feed.name, len(records)))
+            rows["stale"].append((feed.name, sum(1 for rec in records if rec.is_stale(now, feed.stale_threshold))))
+    return [
+        ("kml_proxy_placemarks", "Placemarks in the feed's current merge", rows["placemarks"]),
+        ("kml_proxy_stale_placemarks", "Placemarks of the current merge past the stale threshold now", rows["stale"]),
+        ("kml_proxy_merge_generation", "Generation of the feed's current merge", rows["gen"]),
+        ("kml_proxy_merged_bytes", "Memory held by the feed's merged snapshot", rows["bytes"]),
+        ("kml_proxy_last_refresh_success_timestamp_seconds", "Unix time of the last successful refresh",
+         rows["success"]),
+    ]
+
+def render_metrics() -> str:
+    """All metrics of this process in the Prometheus text exposition format (0.0.4)."""
+    lines = []
+    for metric in METRICS:
+        lines += [f"# HELP {metric.name} {metric.help}", f"# TYPE {metric.name} {metric.kind}", *metric.expose()]
+    for name, help_text, values in _feed_gauges():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        lines += [f'{name}{{feed="{_label_value(feed_name)}"}} {v}' for feed_name, v in values]
+    with _render_lock:
+        used = sum(memory_usage())
+    lines += ["# HELP kml_proxy_memory_bytes Merged documents + rendered outputs + live-update state of all feeds",
+              "# TYPE kml_proxy_memory_bytes gauge", f"kml_proxy_memory_bytes {used}",
+              "# HELP kml_proxy_memory_budget_bytes MEMORY_BUDGET_BYTES",
+              "# TYPE kml_proxy_memory_budget_bytes gauge", f"kml_proxy_memory_budget_bytes {MEMORY_BUDGET_BYTES}"]
+    return "\n".join(lines) + "\n"
+
 # -------------------------
 # Small XML helpers
 # -------------------------
+_DOCUMENT_TAG = f"{{{KML_NS_URI}}}Document"
+_FOLDER_TAG = f"{{{KML_NS_URI}}}Folder"
+_PLACEMARK_TAG = f"{{{KML_NS_URI}}}Placemark"
+
 def _sub(parent: ET.Element, local: str) -> ET.Element:
     return ET.SubElement(parent, f"{{{KML_NS_URI}}}{local}")
 
@@ -58,6 +270,27 @@ def _ensure(parent: ET.Element, local: str) -> ET.Element:
     el = _find(parent, local)
     return el if el is not None else _sub(parent, local)
 
+def parse_kml(kml_xml: str) -> tuple[ET.Element, ET.Element | None]:
+    root = ET.fromstring(kml_xml)
+    return root, root.find("kml:Document", KML_NS)
+
+def serialize_kml(root: ET.Element) -> str:
+    return ET.tostring(root, encoding="utf-8", xml_declaration=True).decode("utf-8")
+
+_XML_DECLARATION = "<?xml version='1.0' encoding='utf-8'?>\n"
+_KML_XMLNS_ATTR = f' xmlns="{KML_NS_URI}"'
+
+def serialize_fragment(el: ET.Element) -> str:
+    """
+    Serializes one element (with its tail) for splicing into a document whose
+    <kml> root already declares the default KML namespace.
+    """
+    s = ET.tostring(el, encoding="unicode")
+    pos = s.find(_KML_XMLNS_ATTR)
+    if 0 <= pos < s.find(">"):
+        s = s[:pos] + s[pos + len(_KML_XMLNS_ATTR):]
+    return s
+
 def _ensure_path(parent: ET.Element, locals_: list[str]) -> ET.Element:
     cur = parent
     for loc in locals_:
@@ -81,81 +314,127 @@ def group_route_placemarks_into_folders(kml_xml: str) -> str:
 
     Works on the final KML string and returns a new KML string.
     """
-    root = ET.fromstring(kml_xml)
-    doc = root.find("kml:Document", KML_NS)
+    root, doc = parse_kml(kml_xml)
     if doc is None:
         return kml_xml
+    group_route_placemarks(doc)
+    return serialize_kml(root)
 
-    # Only consider direct children of Document for stable / predictable re-ordering
-    children = list(doc)
-
-    # Index direct placemark children by id
-    id_to_pm = {}
-    for el in children:
-        if el.tag == f"{{{KML_NS_URI}}}Placemark":
-            pm_id = el.attrib.get("id")
-            if pm_id:
-                id_to_pm[pm_id] = el
-
-    def is_route_id(pid: str) -> bool:
-        return pid.endswith("_route")
-
-    used = set()
+def group_route_placemarks(doc: ET.Element, index: "RenderIndex | None" = None) -> None:
+    """
+    In-place variant of group_route_placemarks_into_folders on a parsed <Document>.
 
-    # We'll rebuild Document contents in a new list, then replace
-    new_children = []
-    for el in children:
-        # Pass through non-placemark elements unchanged (name, etc.)
-        if el.tag != f"{{{KML_NS_URI}}}Placemark":
-            new_children.append(el)
-            continue
+    A placemark with a "<id>_route" partner anywhere in the document gets a
+    Folder (named after it) holding it and its route, in its own position; the
+    route is taken out of wherever it was. Placemarks inside existing folders
+    are grouped the same way. Id-less placemarks directly under the Document
+    are dropped, as before.
+    """
+    index = index or RenderIndex(doc)
+    folders = list(doc.iter(_FOLDER_TAG))
+    parent_of = {child: parent for parent in (doc, *folders) for child in parent}
+    grouped = set()  # ids already placed in a route folder
+
+    def group_children(parent: ET.Element, drop_idless: bool) -> list[ET.Element]:
+        new_children, seen, kept_at = [], set(), {}  # kept_at: placemark kept as-is -> its slot
+        for el in list(parent):
+            # Pass through non-placemark elements unchanged (name, folders, etc.)
+            if el.tag != _PLACEMARK_TAG:
+                new_children.append(el)
+                continue
 
-        pm_id = el.attrib.get("id") or ""
-        if not pm_id or pm_id in used:
-            continue
+            pm_id = el.attrib.get("id") or ""
+            if not pm_id:
+                if not drop_idless:
+                    new_children.append(el)
+                continue
+            if pm_id in seen or pm_id in grouped:
+                continue
+            seen.add(pm_id)
 
-        # If this is a base waypoint and there is a matching "<base>_route"
-        route_id = f"{pm_id}_route"
-        if route_id in id_to_pm:
-            base_pm = el
-            route_pm = id_to_pm[route_id]
+            route_id = f"{pm_id}_route"
+            route_pm = index.by_id.get(route_id)
+            if route_pm is None or route_pm is el or route_id in grouped:
+                # Not groupable: keep as-is
+                kept_at[el] = len(new_children)
+                new_children.append(el)
+                continue
 
-            folder = ET.Element(f"{{{KML_NS_URI}}}Folder")
+            folder = ET.Element(_FOLDER_TAG)
             # Folder name: use placemark name if present, else id
-            base_name = base_pm.findtext("kml:name", default="", namespaces=KML_NS).strip()
-            name_el = ET.SubElement(folder, f"{{{KML_NS_URI}}}name")
-            name_el.text = base_name if base_name else pm_id
-
-            folder.append(base_pm)
+            base_name = el.findtext("kml:name", default="", namespaces=KML_NS).strip()
+            _sub(folder, "name").text = base_name if base_name else pm_id
+
+            route_parent = parent_of.get(route_pm)
+            if route_parent is parent:
+                slot = kept_at.pop(route_pm, None)
+                if slot is not None:  # route listed before its base: vacate its slot
+                    new_children[slot] = None
+            elif route_parent is not None:
+                route_parent.remove(route_pm)
+            folder.append(el)
             folder.append(route_pm)
+            parent_of[el] = parent_of[route_pm] = folder
+            parent_of[folder] = parent
 
             new_children.append(folder)
-            used.add(pm_id)
-            used.add(route_id)
-        else:
-            # Not groupable: keep as-is
-            new_children.append(el)
-            used.add(pm_id)
+            grouped.update((pm_id, route_id))
+        return [el for el in new_children if el is not None]
 
-    # Also include any route placemarks that were never added because their base wasn't present
-    # (only if they were direct children and not already used)
-    for el in children:
-        if el.tag == f"{{{KML_NS_URI}}}Placemark":
-            pid = el.attrib.get("id") or ""
-            if pid and pid not in used and is_route_id(pid):
-                new_children.append(el)
-                used.add(pid)
+    for folder in folders:
+        folder[:] = group_children(folder, drop_idless=False)
 
     # Replace Document children
+    new_children = group_children(doc, drop_idless=True)
     doc.clear()
     for el in new_children:
         doc.append(el)
 
-    return ET.tostring(root, encoding="utf-8", xml_declaration=True).decode("utf-8")
-
 # -------------------------
-# KML scale transform (string-based, keeps your behavior)
+# KML scale transform
 # -------------------------
+_STYLE_TAG = f"{{{KML_NS_URI}}}Style"
+_SCALE_TAG = f"{{{KML_NS_URI}}}scale"
+
+def _set_scale(style_child: ET.Element, new_value: float) -> None:
+    scales = list(style_child.iter(_SCALE_TAG))
+    if not scales:
+        # New <scale> goes first, ahead of whatever text/children were there
+        scale = ET.Element(_SCALE_TAG)
+        scale.text = str(new_value)
+        scale.tail, style_child.text = style_child.text, None
+        style_child.insert(0, scale)
+        return
+    for scale in scales:
+        t = scale.text or ""
+        core = t.strip()
+        lead = t[:len(t) - len(t.lstrip())]
+        trail = t[len(lead) + len(core):] if core else ""
+        scale.text = f"{lead}{new_value}{trail}"
+
+def scale_style_element(style: ET.Element, scales: tuple[float, float] | None = None) -> None:
+    """Applies (icon, label) scales (default ICON_SCALE / LABEL_SCALE) to one <Style>, adding Icon/LabelStyle if missing."""
+    icon_scale, label_scale = scales or (ICON_SCALE, LABEL_SCALE)
+    icon_style = _find(style, "IconStyle")
+    label_style = _find(style, "LabelStyle")
+    if icon_style is None:
+        icon_style = _sub(style, "IconStyle")
+    if label_style is None:
+        label_style = _sub(style, "LabelStyle")
+    _set_scale(icon_style, icon_scale)
+    _set_scale(label_style, label_scale)
+
+def scale_styles_in_tree(el: ET.Element, scales: tuple[float, float] | None = None) -> None:
+    """
+    Tree counterpart of transform_kml_scales: every <Style> under `el` (shared
+    Document styles, inline placemark styles, styles inside a StyleMap) is
+    patched exactly once.
+    """
+    for style in list(el.iter(_STYLE_TAG)):
+        scale_style_element(style, scales)
+
+# String-based original, kept for callers that hold raw KML text. Note it cannot
+# see self-closing <Style/> / <IconStyle/> elements, which the tree version patches.
 def _replace_scale_in_block(block: str, tag_name: str, new_value: float) -> str:
     if f"<{tag_name}" not in block:
         return block
@@ -191,46 +470,227 @@ def transform_kml_scales(kml: str) -> str:
 # -------------------------
 # Fetch + parse GDH
 # -------------------------
+UPSTREAM_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+def upstream_backoff_seconds(retry: int) -> float:
+    """Sleep before the `retry`-th retry (1-based), as urllib3's Retry computes it for the session."""
+    return 0.0 if retry <= 1 else UPSTREAM_BACKOFF_SECONDS * 2 ** (retry - 1)
+
+def get_upstream_session() -> requests.Session:
+    """Shared keep-alive session (connection pool + retries) for all upstream traffic."""
+    s = _upstream["session"]
+    if s is not None:
+        return s
+    with _upstream["lock"]:
+        if _upstream["session"] is None:
+            retry = Retry(
+                total=UPSTREAM_RETRIES,
+                read=0,  # a read timeout already cost UPSTREAM_TIMEOUT_SECONDS; don't wait it out again
+                backoff_factor=UPSTREAM_BACKOFF_SECONDS,
+                status_forcelist=UPSTREAM_RETRY_STATUSES,
+                allowed_methods=frozenset({"GET"}),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=UPSTREAM_POOL_SIZE, max_retries=retry)
+            s = requests.Session()
+            s.headers["User-Agent"] = USER_AGENT
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            _upstream["session"] = s
+        return _upstream["session"]
+
+def _upstream_verify() -> bool | str:
+    return False if ALLOW_INSECURE_SSL else certifi.where()
+
+def _upstream_timeout() -> tuple[float, float]:
+    return UPSTREAM_CONNECT_TIMEOUT_SECONDS, UPSTREAM_TIMEOUT_SECONDS
+
 def fetch_kml(url: str) -> str:
-    verify = False if ALLOW_INSECURE_SSL else certifi.where()
-    r = requests.get(url, timeout=15, headers={"User-Agent": "KML-Proxy/ATAK-1.2"}, verify=verify)
-    r.raise_for_status()
+    """Unconditional GET of one KML document through the shared session; raises on HTTP errors."""
+    started = time.perf_counter()
+    try:
+        r = get_upstream_session().get(url, timeout=_upstream_timeout(), verify=_upstream_verify())
+        r.raise_for_status()
+    except Exception:
+        METRIC_UPSTREAM_RESPONSES.inc("kml", "error")
+        raise
+    finally:
+        METRIC_UPSTREAM_SECONDS.observe_since(started, "kml")
+    METRIC_UPSTREAM_RESPONSES.inc("kml", "fetched")
+    METRIC_UPSTREAM_BYTES.inc("kml", amount=len(r.content))
     return r.text
 
-def extract_gdh_epoch_from_placemark(pm_xml: str) -> float:
-    normalized = (pm_xml.replace("&lt;br&gt;", "<br>")
-                        .replace("&lt;br/&gt;", "<br>")
-                        .replace("&lt;br /&gt;", "<br>"))
+def _fetch_pool() -> ThreadPoolExecutor:
+    pool = _upstream["pool"]
+    if pool is None:
+        with _upstream["lock"]:
+            if _upstream["pool"] is None:
+                _upstream["pool"] = ThreadPoolExecutor(max_workers=4, thread_name_prefix="kml-fetch")
+            pool = _upstream["pool"]
+    return pool
+
+def _conditional_headers(prev: dict | None) -> dict[str, str]:
+    headers = {}
+    if prev is not None:
+        if prev["etag"]:
+            headers["If-None-Match"] = prev["etag"]
+        if prev["last_modified"]:
+            headers["If-Modified-Since"] = prev["last_modified"]
+    return headers
+
+def fetch_source(url: str, feed: "Feed | None" = None) -> tuple[str, bool]:
+    """
+    Conditional GET of one feed, returning (kml, changed).
 
-    m = re.search(
-        r"GDH\s+de\s+recep(?:ç|c)ão\s+do\s+último\s+sinal:?<br>\s*"
-        r"([0-9]{2}[A-Z]{3}[0-9]{2})\s+"
-        r"([0-9]{2}:[0-9]{2}:[0-9]{2})(?:\.(\d+))?",
-        normalized,
-        flags=re.IGNORECASE
-    )
-    if not m:
-        return 0.0
+    Sends If-None-Match / If-Modified-Since from the last good fetch. On 304, or
+    when the body hashes the same as last time, the previous body is returned
+    with changed=False so the caller can skip parsing and merging it again.
+    Validators are kept per feed, since two feeds may poll the same URL.
+    """
+    feed = feed or get_feed()
+    headers = _conditional_headers(feed.source_state.get(url))
 
+    started = time.perf_counter()
+    try:
+        r = get_upstream_session().get(url, timeout=_upstream_timeout(), headers=headers,
+                                       verify=_upstream_verify())
+        r.raise_for_status()
+    except Exception:
+        METRIC_UPSTREAM_RESPONSES.inc("kml", "error")
+        raise
+    finally:
+        METRIC_UPSTREAM_SECONDS.observe_since(started, "kml")
+    return accept_source_response(url, feed, r.status_code, r.headers, r.content, lambda: r.text)
+
+def accept_source_response(url: str, feed: "Feed", status: int, headers, content: bytes,
+                           text: Callable[[], str]) -> tuple[str, bool]:
+    """
+    fetch_source's handling of a successful response to its conditional GET,
+    for responses fetched elsewhere too (the ASGI mode's async client).
+    `headers` is case-insensitive; `text` decodes `content`, called only when
+    the body changed.
+    """
+    source_state, stats = feed.source_state, feed.upstream_stats
+    prev = source_state.get(url)
+    if status == 304 and prev is not None:
+        stats["not_modified"] += 1
+        METRIC_UPSTREAM_RESPONSES.inc("kml", "not_modified")
+        return prev["text"], False
+    METRIC_UPSTREAM_BYTES.inc("kml", amount=len(content))
+
+    digest = hashlib.sha256(content).hexdigest()
+    if prev is not None and prev["hash"] == digest:
+        stats["unchanged_body"] += 1
+        METRIC_UPSTREAM_RESPONSES.inc("kml", "unchanged")
+        prev.update({"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")})
+        return prev["text"], False
+
+    stats["fetched"] += 1
+    METRIC_UPSTREAM_RESPONSES.inc("kml", "changed")
+    body = text()
+    source_state[url] = {
+        "etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified"),
+        "hash": digest, "text": body,
+    }
+    return body, True
+
+def ingest_source_stream(url: str, prev_entries: dict[str, tuple] | None, scale_styles: bool = True,
+                         feed: "Feed | None" = None) -> tuple[dict[str, tuple], set[str]] | None:
+    """
+    Streaming counterpart of fetch_source + _ingest_source: the response body is
+    read in STREAM_INGEST_CHUNK_BYTES pieces straight into an incremental parser
+    and placemarks are ingested as they complete, so neither the full text nor
+    the full tree is ever held. Returns (entries, dirty) for the merge, or None
+    when the feed is unchanged (304 or same body hash). The hash is only known
+    once the body has been parsed, so a matching one saves the merge, not the
+    parse; unchanged placemarks are still not rescaled (see _ingest_placemarks).
+    Without prev_entries (nothing merged yet for this source) the feed is always
+    ingested. Styles are scaled with the feed's scales.
+    """
+    feed = feed or get_feed()
+    source_state, stats = feed.source_state, feed.upstream_stats
+    prev = source_state.get(url) if prev_entries is not None else None
+    digest, size = hashlib.sha256(), [0]
+    started = time.perf_counter()
+    try:
+        with get_upstream_session().get(url, timeout=_upstream_timeout(), headers=_conditional_headers(prev),
+                                        verify=_upstream_verify(), stream=True) as r:
+            if r.status_code == 304 and prev is not None:
+                stats["not_modified"] += 1
+                METRIC_UPSTREAM_RESPONSES.inc("kml", "not_modified")
+                return None
+            r.raise_for_status()
+
+            def chunks() -> Iterator[bytes]:
+                for chunk in r.iter_content(STREAM_INGEST_CHUNK_BYTES):
+                    digest.update(chunk)
+                    size[0] += len(chunk)
+                    yield chunk
+
+            ingested = _ingest_placemarks(iter_document_placemarks(chunks()), prev_entries or {}, scale_styles,
+                                          feed.scales)
+            validators = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+    except Exception:
+        METRIC_UPSTREAM_RESPONSES.inc("kml", "error")
+        raise
+    finally:
+        METRIC_UPSTREAM_SECONDS.observe_since(started, "kml")
+        METRIC_UPSTREAM_BYTES.inc("kml", amount=size[0])
+
+    if prev is not None and prev["hash"] == digest.hexdigest():
+        stats["unchanged_body"] += 1
+        METRIC_UPSTREAM_RESPONSES.inc("kml", "unchanged")
+        prev.update(validators)
+        return None
+    stats["fetched"] += 1
+    METRIC_UPSTREAM_RESPONSES.inc("kml", "changed")
+    source_state[url] = {**validators, "hash": digest.hexdigest(), "text": None}
+    return ingested
+
+GDH_MONTHS = {
+    "JAN": 1, "FEV": 2, "FEB": 2, "MAR": 3, "ABR": 4, "APR": 4,
+    "MAI": 5, "MAY": 5, "JUN": 6, "JUL": 7, "AGO": 8, "AUG": 8,
+    "SET": 9, "SEP": 9, "OUT": 10, "OCT": 10, "NOV": 11, "DEZ": 12, "DEC": 12
+}
+_GDH_TAIL = r"\s*([0-9]{2}[A-Z]{3}[0-9]{2})\s+([0-9]{2}:[0-9]{2}:[0-9]{2})(?:\.(\d+))?"
+# Serialized placemark XML (after &lt;br&gt; normalization) vs. parsed element text
+GDH_XML_RE = re.compile(r"GDH\s+de\s+recep(?:ç|c)ão\s+do\s+último\s+sinal:?<br>" + _GDH_TAIL, re.IGNORECASE)
+GDH_TEXT_RE = re.compile(r"GDH\s+de\s+recep(?:ç|c)ão\s+do\s+último\s+sinal:?<br ?/?>" + _GDH_TAIL, re.IGNORECASE)
+
+def _gdh_match_to_epoch(m: re.Match) -> float:
     date_part, time_part, ms_part = m.group(1), m.group(2), (m.group(3) or "0")
     day = int(date_part[0:2])
-    mon_str = date_part[2:5].upper()
+    month = GDH_MONTHS.get(date_part[2:5].upper(), 1)
     yy = int(date_part[5:7])
     year = 2000 + yy if yy < 80 else 1900 + yy
+    hh, mm, ss = int(time_part[0:2]), int(time_part[3:5]), int(time_part[6:8])
 
-    month_map = {
-        "JAN": 1, "FEV": 2, "FEB": 2, "MAR": 3, "ABR": 4, "APR": 4,
-        "MAI": 5, "MAY": 5, "JUN": 6, "JUL": 7, "AGO": 8, "AUG": 8,
-        "SET": 9, "SEP": 9, "OUT": 10, "OCT": 10, "NOV": 11, "DEZ": 12, "DEC": 12
-    }
-    month = month_map.get(mon_str, 1)
+    dt = datetime.datetime(year, month, day, hh, mm, ss) + datetime.timedelta(seconds=float("0." + ms_part))
+    return dt.timestamp()
 
-    hh, mm, ss = map(int, time_part.split(":"))
-    frac = float("0." + re.sub(r"\D", "", ms_part))
+def extract_gdh_epoch_from_placemark(pm_xml: str) -> float:
+    """GDH from serialized placemark XML. Kept for callers holding strings; see gdh_epoch_of()."""
+    normalized = (pm_xml.replace("&lt;br&gt;", "<br>")
+                        .replace("&lt;br/&gt;", "<br>")
+                        .replace("&lt;br /&gt;", "<br>"))
+    m = GDH_XML_RE.search(normalized)
+    return _gdh_match_to_epoch(m) if m else 0.0
 
-    import datetime
-    dt = datetime.datetime(year, month, day, hh, mm, ss) + datetime.timedelta(seconds=frac)
-    return dt.timestamp()
+def gdh_epoch_from_text(text: str) -> float:
+    m = GDH_TEXT_RE.search(text)
+    return _gdh_match_to_epoch(m) if m else 0.0
+
+def gdh_epoch_of(pm: ET.Element) -> float:
+    """
+    GDH epoch of a placemark element without serializing it: looks at <description>
+    first and only falls back to all of the placemark's text when that has no GDH.
+    """
+    desc = pm.findtext("kml:description", default="", namespaces=KML_NS)
+    if desc:
+        gdh = gdh_epoch_from_text(desc)
+        if gdh:
+            return gdh
+    return gdh_epoch_from_text("".join(pm.itertext()))
 
 def placemark_fallback_key(pm_el: ET.Element) -> str:
     name = (pm_el.findtext("kml:name", default="", namespaces=KML_NS) or "").strip()
@@ -244,6 +704,17 @@ def placemark_fallback_key(pm_el: ET.Element) -> str:
 # Merge + dedupe
 # -------------------------
 def merge_kml_two_sources(kml_recent: str, kml_full: str) -> str:
+    return merge_kml_two_sources_with_gdh(kml_recent, kml_full)[0]
+
+def merge_kml_two_sources_with_gdh(kml_recent: str, kml_full: str,
+                                   scale_styles: bool = False) -> tuple[str, dict[str, float]]:
+    """
+    Like merge_kml_two_sources, plus the GDH epoch of every kept placemark by id.
+
+    With scale_styles the inputs are raw feeds: the styles of the placemarks that
+    survive dedupe are scaled on the tree (scale_styles_in_tree) instead of
+    running transform_kml_scales over both documents beforehand.
+    """
     r_root = ET.fromstring(kml_recent)
     f_root = ET.fromstring(kml_full)
 
@@ -263,7 +734,7 @@ def merge_kml_two_sources(kml_recent: str, kml_full: str) -> str:
         pm_id = pm.attrib.get("id")
         key = f"id:{pm_id}" if pm_id else f"fb:{placemark_fallback_key(pm)}"
 
-        gdh = extract_gdh_epoch_from_placemark(ET.tostring(pm, encoding="unicode"))
+        gdh = gdh_epoch_of(pm)
 
         if key not in chosen:
             chosen[key] = (pri, gdh, pm); return
@@ -285,22 +756,939 @@ def merge_kml_two_sources(kml_recent: str, kml_full: str) -> str:
     for pm in collect(f_doc): consider(pm, 1)
     for pm in collect(r_doc): consider(pm, 2)
 
-    for k in sorted(chosen.keys()):
-        out_doc.append(chosen[k][2])
+    # Document order is the order the render sorts into: by <name>, then key
+    order = sorted(chosen, key=lambda k: (sort_name_key(chosen[k][2].findtext("kml:name", "", KML_NS)), k))
+    gdh_by_id = {}
+    for k in order:
+        _, gdh, pm = chosen[k]
+        if scale_styles:
+            scale_styles_in_tree(pm)
+        out_doc.append(pm)
+        if k.startswith("id:"):
+            gdh_by_id[k[3:]] = gdh
 
-    return ET.tostring(out_root, encoding="utf-8", xml_declaration=True).decode("utf-8")
+    return serialize_kml(out_root), gdh_by_id
 
-def get_merged_kml_cached() -> str:
-    now = time.time()
-    if _cache["kml"] is not None and (now - _cache["ts"] < CACHE_SECONDS):
-        return _cache["kml"]
+# -------------------------
+# Incremental merge: per-placemark fingerprints, only churn is re-evaluated
+# -------------------------
+SOURCE_PRIORITY_FULL = 1
+SOURCE_PRIORITY_RECENT = 2
+
+def placemark_merge_key(pm: ET.Element) -> str:
+    pm_id = pm.attrib.get("id")
+    return f"id:{pm_id}" if pm_id else f"fb:{placemark_fallback_key(pm)}"
+
+def placemark_fingerprint(pm: ET.Element) -> int:
+    """Cheap in-process content hash of a raw (unscaled) placemark subtree."""
+    return hash(tuple(
+        (el.tag, el.text, el.tail, tuple(el.attrib.items()) if el.attrib else None)
+        for el in pm.iter()
+    ))
+
+def _prefer(new_pri: int, new_gdh: float, old_pri: int, old_gdh: float) -> bool:
+    # Same rule as merge_kml_two_sources: any GDH beats none, newer GDH wins,
+    # then higher source priority; full ties keep the earlier candidate.
+    return (new_gdh > 0, new_gdh, new_pri) > (old_gdh > 0, old_gdh, old_pri)
+
+_MERGED_HEAD = f'{_XML_DECLARATION}<kml xmlns="{KML_NS_URI}"><Document><name>Merged KML</name>'
+_MERGED_TAIL = "</Document></kml>"
+
+# -------------------------
+# Placemark records: compact per-unit state instead of retained ElementTrees
+# -------------------------
+_COORDINATES_TAG = f"{{{KML_NS_URI}}}coordinates"
+_FRAGMENT_OPEN = f'<kml xmlns="{KML_NS_URI}">'.encode("utf-8")
+_FRAGMENT_CLOSE = b"</kml>"
+
+def placemark_coords(pm: ET.Element) -> array:
+    """Every lon/lat pair under pm's <coordinates>, flattened as [lon0, lat0, lon1, lat1, ...]."""
+    out = array("d")
+    for coords in pm.iter(_COORDINATES_TAG):
+        for tup in (coords.text or "").split():
+            parts = tup.split(",")
+            if len(parts) < 2:
+                continue
+            try:
+                lon, lat = float(parts[0]), float(parts[1])
+            except ValueError:
+                continue
+            out.append(lon)
+            out.append(lat)
+    return out
+
+class PlacemarkRecord:
+    """
+    One merged placemark, reduced to what the render stages and the index look at:
+    id, <name> text (None without the element) and its sort keys as is and once
+    flagged stale, coordinates, GDH epoch, styleUrl, the base id for
+    "<base>_route" placemarks, whether the feed already marked it stale, and the
+    scaled placemark itself as UTF-8 bytes (default namespace stripped, tail
+    kept; the description travels inside it untouched). The stale-styled
+    rendition is built once per stale icon href and kept.
+    """
+    __slots__ = ("id", "name", "sort_key", "stale_sort_key", "coords", "gdh", "style_url", "route_of",
+                 "marked_stale", "xml", "_stale")
+
+    def __init__(self, pm: ET.Element, gdh: float):
+        self.id = pm.get("id") or ""
+        name_el = pm.find("kml:name", KML_NS)
+        self.name = None if name_el is None else (name_el.text or "")
+        self.sort_key = sort_name_key(self.name)
+        self.stale_sort_key = sort_name_key(self.stale_name())
+        self.coords = placemark_coords(pm)
+        self.gdh = gdh
+        self.style_url = pm.findtext("kml:styleUrl", default=None, namespaces=KML_NS)
+        self.route_of = self.id[:-len("_route")] if self.id.endswith("_route") else None
+        self.marked_stale = is_stale_placemark(pm)
+        self.xml = serialize_fragment(pm).encode("utf-8")
+        self._stale = None
+
+    def bbox(self) -> tuple[float, float, float, float] | None:
+        if not self.coords:
+            return None
+        lons, lats = self.coords[0::2], self.coords[1::2]
+        return min(lons), min(lats), max(lons), max(lats)
+
+    def is_stale(self, now: float, threshold: float | None = None) -> bool:
+        """The flag_stale_placemarks rule."""
+        threshold = STALE_THRESHOLD_SECONDS if threshold is None else threshold
+        return bool(self.gdh) and (now - self.gdh) > threshold
+
+    def stale_name(self) -> str:
+        """<name> text after apply_stale_style."""
+        t = (self.name or "").strip()
+        if self.name is not None and t.startswith("⚠"):
+            return self.name
+        return f"⚠ {t}" if t else "⚠"
+
+    def stale_rendition(self, stale_href: str) -> tuple[bytes, bool]:
+        """(xml, marked_stale) after apply_stale_style + mark_pm_stale."""
+        cached = self._stale
+        if cached is None or cached[0] != stale_href:
+            pm = ET.fromstring(_FRAGMENT_OPEN + self.xml + _FRAGMENT_CLOSE)[0]
+            apply_stale_style(pm, stale_href)
+            mark_pm_stale(pm)
+            cached = self._stale = (stale_href, serialize_fragment(pm).encode("utf-8"), is_stale_placemark(pm))
+        return cached[1], cached[2]
+
+def records_from_kml(kml_xml: str, gdh_by_id: dict[str, float] | None = None) -> list[PlacemarkRecord]:
+    """Records for the direct <Placemark>s of an already merged (and scaled) document."""
+    gdh_by_id = gdh_by_id or {}
+    _, doc = parse_kml(kml_xml)
+    records = []
+    for pm in ([] if doc is None else doc.findall("kml:Placemark", KML_NS)):
+        gdh = gdh_by_id.get(pm.get("id") or "")
+        records.append(PlacemarkRecord(pm, gdh_epoch_of(pm) if gdh is None else gdh))
+    return records
+
+def merged_kml_from_records(records: list[PlacemarkRecord]) -> str:
+    return _MERGED_HEAD + b"".join(rec.xml for rec in records).decode("utf-8") + _MERGED_TAIL
+
+def new_merge_state() -> dict:
+    """
+    sources: priority -> {key: (fingerprint, PlacemarkRecord)} of the last
+             ingested version of that source; the record holds the scaled,
+             serialized placemark, so no parsed tree outlives the ingest
+    chosen:  key -> (priority, entry) winning across sources
+    gdh:     placemark id -> GDH epoch of the chosen entries
+    order:   (sort_key, key, record) of the chosen entries, kept sorted across
+             merges: the merged document is in the order the render sorts into
+    records: chosen records in merged-document order (a new list per merge)
+    stats:   placemark counts of the last merge
+    """
+    return {"sources": {}, "chosen": {}, "gdh": {}, "order": [], "records": [],
+            "stats": {"placemarks": 0, "reused": 0, "reprocessed": 0, "removed": 0}}
+
+def iter_document_placemarks(chunks: Iterable[bytes]) -> Iterator[ET.Element]:
+    """
+    Incrementally parses a KML byte stream and yields each <Placemark> directly
+    under the first <Document> as soon as its end tag arrives (the same set
+    root.find("kml:Document").findall("kml:Placemark") gives). Every finished
+    Document child is detached once consumed, so memory stays at roughly one
+    placemark plus the parser buffer regardless of feed size.
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    stack, doc = [], None
+
+    def drain() -> Iterator[ET.Element]:
+        nonlocal doc
+        for event, el in parser.read_events():
+            if event == "start":
+                if doc is None and len(stack) == 1 and el.tag == _DOCUMENT_TAG:
+                    doc = el
+                stack.append(el)
+                continue
+            stack.pop()
+            if stack and stack[-1] is doc:
+                if el.tag == _PLACEMARK_TAG:
+                    yield el
+                doc.remove(el)
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from drain()
+    parser.close()
+    yield from drain()
+
+def _ingest_source(kml: str, prev: dict[str, tuple], scale_styles: bool = True,
+                   scales: tuple[float, float] | None = None) -> tuple[dict[str, tuple], set[str]]:
+    root = ET.fromstring(kml)
+    doc = root.find("kml:Document", KML_NS)
+    return _ingest_placemarks([] if doc is None else doc.findall("kml:Placemark", KML_NS), prev, scale_styles, scales)
+
+def _ingest_placemarks(placemarks: Iterable[ET.Element], prev: dict[str, tuple], scale_styles: bool = True,
+                       scales: tuple[float, float] | None = None) -> tuple[dict[str, tuple], set[str]]:
+    entries, dirty = {}, set()
+    for pm in placemarks:
+        key = placemark_merge_key(pm)
+        fp = placemark_fingerprint(pm)
+        old = prev.get(key)
+        if old is not None and old[0] == fp:
+            entry = old
+        else:
+            gdh = gdh_epoch_of(pm)
+            if scale_styles:
+                scale_styles_in_tree(pm, scales)
+            entry = (fp, PlacemarkRecord(pm, gdh))
+        cur = entries.get(key)
+        if cur is None or _prefer(0, entry[1].gdh, 0, cur[1].gdh):
+            entries[key] = entry
+    for key in prev.keys() | entries.keys():
+        if prev.get(key) is not entries.get(key):
+            dirty.add(key)
+    return entries, dirty
+
+def merge_kml_incremental(state: dict, kml_by_priority: dict[int, str], unchanged: set[int] = frozenset(),
+                          scale_styles: bool = True,
+                          scales: tuple[float, float] | None = None) -> tuple[str, dict[str, float]]:
+    """
+    Merges sources into `state` and returns (merged_kml, gdh_by_id) like
+    merge_kml_two_sources_with_gdh. Priorities in `unchanged` that the state
+    already holds are not parsed at all. Placemarks whose fingerprint did not
+    change keep their parsed GDH and serialized output; only new, changed and
+    removed keys are re-evaluated, and the merged document is spliced together
+    from the per-placemark records instead of serializing a whole tree.
+    """
+    sources = state["sources"]
+    ingested = {}
+    for pri, kml in kml_by_priority.items():
+        if pri in unchanged and pri in sources:
+            continue
+        ingested[pri] = _ingest_source(kml, sources.get(pri, {}), scale_styles, scales)
+    return merge_ingested(state, ingested)
+
+def _reorder(order: list[tuple], key: str, old: PlacemarkRecord | None, new: PlacemarkRecord | None) -> None:
+    # Moves `key` in the sorted merge order from old's place to new's (None: not chosen)
+    if old is not None:
+        i = bisect.bisect_left(order, (old.sort_key, key))
+        if new is not None and new.sort_key == old.sort_key:
+            order[i] = (new.sort_key, key, new)
+            return
+        del order[i]
+    if new is not None:
+        bisect.insort(order, (new.sort_key, key, new))
 
-    recent_scaled = transform_kml_scales(fetch_kml(SOURCE_KML_RECENT))
-    full_scaled   = transform_kml_scales(fetch_kml(SOURCE_KML_FULL))
+def merge_ingested(state: dict, ingested: dict[int, tuple[dict[str, tuple], set[str]]]) -> tuple[str, dict[str, float]]:
+    """
+    Second half of merge_kml_incremental: commits per-priority (entries, dirty)
+    from _ingest_placemarks (or ingest_source_stream) and re-picks the winners
+    of the dirty keys. Sources missing from `ingested` keep their last state.
+    """
+    sources = state["sources"]
+    dirty = set()
+    for entries, changed in ingested.values():
+        dirty |= changed
+    # Commit only after every source parsed, so a bad feed leaves the state intact
+    sources.update({pri: entries for pri, (entries, _) in ingested.items()})
+
+    chosen, gdh_by_id, order = state["chosen"], state["gdh"], state["order"]
+    # Past a small churn one sort beats moving entries one by one (as on the first merge)
+    resort = len(dirty) * 8 > len(order)
+    reprocessed = 0
+    for key in dirty:
+        best = None
+        for pri in sorted(sources):
+            entry = sources[pri].get(key)
+            if entry is not None and (best is None or _prefer(pri, entry[1].gdh, best[0], best[1][1].gdh)):
+                best = (pri, entry)
+        prev = chosen.get(key)
+        if not resort:
+            _reorder(order, key, None if prev is None else prev[1][1], None if best is None else best[1][1])
+        if best is None:
+            chosen.pop(key, None)
+            if key.startswith("id:"):
+                gdh_by_id.pop(key[3:], None)
+            continue
+        if prev is None or prev[1] is not best[1]:
+            reprocessed += 1
+        chosen[key] = best
+        if key.startswith("id:"):
+            gdh_by_id[key[3:]] = best[1][1].gdh
+    if resort:
+        order[:] = sorted((entry[1].sort_key, key, entry[1]) for key, (_, entry) in chosen.items())
+
+    records = [rec for _, _, rec in order]
+    state["records"] = records
+    merged = merged_kml_from_records(records)
+
+    state["stats"].update({
+        "placemarks": len(chosen), "reprocessed": reprocessed,
+        "reused": len(chosen) - reprocessed, "removed": sum(1 for k in dirty if k not in chosen),
+    })
+    return merged, dict(gdh_by_id)
+
+# -------------------------
+# Cache backends: what workers share (merged snapshots, renders, icons) + refresh leases
+# -------------------------
+def _shared_key(*parts: str) -> str:
+    return ":".join((CACHE_KEY_PREFIX, *parts))
+
+def _lease_owner() -> str:
+    # Per process, computed on use: workers forked from a preloaded app get their own pid
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class CacheBackend(ABC):
+    """
+    Byte values by string key with an optional TTL, plus named leases so only
+    one holder at a time refreshes a feed. `shared` backends are visible to
+    every worker, so merged snapshots and renders are published there;
+    `holds_icons` ones also take over the per-process icon memory layer.
+    """
+    shared = False
+    holds_icons = False
+
+    @abstractmethod
+    def get(self, key: str) -> bytes | None: ...
+
+    @abstractmethod
+    def set(self, key: str, value: bytes, ttl: float | None = None) -> None: ...
+
+    @abstractmethod
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        """Non-blocking; True if this process now holds `name` (for at most `ttl` seconds)."""
+
+    @abstractmethod
+    def release_lease(self, name: str) -> None: ...
+
+class MemoryCacheBackend(CacheBackend):
+    """In-process dict and locks: the single-worker default, where nothing needs publishing."""
+
+    def __init__(self):
+        self._values = {}  # key -> (expires or 0.0, value)
+        self._leases = {}  # name -> Lock
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            if entry[0] and entry[0] < time.time():
+                del self._values[key]
+                return None
+            return entry[1]
+
+    def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        with self._lock:
+            self._values[key] = (time.time() + ttl if ttl else 0.0, value)
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        with self._lock:
+            lease = self._leases.setdefault(name, threading.Lock())
+        return lease.acquire(blocking=False)
+
+    def release_lease(self, name: str) -> None:
+        self._leases[name].release()
+
+_FILE_EXPIRES = struct.Struct("<d")
+
+def _private_directory(directory: str) -> None:
+    """
+    Creates `directory` with mode 0700, or checks that the existing one is a
+    real directory owned by this user that nobody else can write to. Whoever
+    can write there could plant merged documents and renders for every worker.
+    """
+    try:
+        os.makedirs(directory, mode=0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode):
+        raise RuntimeError(f"CACHE_SHARED_DIR {directory!r} is not a directory (or is a symlink)")
+    if st.st_uid != os.getuid():
+        raise RuntimeError(f"CACHE_SHARED_DIR {directory!r} is owned by uid {st.st_uid}, not {os.getuid()}")
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise RuntimeError(f"CACHE_SHARED_DIR {directory!r} is writable by group or others "
+                           f"(mode {stat.S_IMODE(st.st_mode):o})")
+
+class FileCacheBackend(CacheBackend):
+    """
+    One file per key in `directory`: by default a tmpfs under /dev/shm, i.e.
+    shared memory for every worker on the host. Files start with their expiry
+    (0 = none) and are replaced atomically, so a reader sees a whole old or
+    new value. A lease is an flock on a per-name lock file, which the kernel
+    drops if the holder dies, so `ttl` is not needed. Icons stay in the disk
+    icon store, which is already shared between workers.
+    """
+    shared = True
+
+    def __init__(self, directory: str | None = None):
+        self.directory = directory = directory or CACHE_SHARED_DIR
+        _private_directory(directory)
+        self._held = {}  # lease name -> open lock file
+        self._last_prune = 0.0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            with open(self._path(key), "rb") as f:
+                expires, = _FILE_EXPIRES.unpack(f.read(_FILE_EXPIRES.size))
+                if expires and expires < time.time():
+                    return None
+                return f.read()
+        except (OSError, struct.error):
+            return None  # missing, or empty/truncated
+
+    def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        _atomic_write(self._path(key), _FILE_EXPIRES.pack(time.time() + ttl if ttl else 0.0) + value)
+        self._maybe_prune()
+
+    def _maybe_prune(self) -> None:
+        now = time.time()
+        if now - self._last_prune < CACHE_SHARED_PRUNE_INTERVAL_SECONDS:
+            return
+        self._last_prune = now
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(".") or entry.name.endswith(".lease"):
+                continue
+            try:
+                with open(entry.path, "rb") as f:
+                    expires, = _FILE_EXPIRES.unpack(f.read(_FILE_EXPIRES.size))
+                if expires and expires < now:
+                    os.unlink(entry.path)
+            except (OSError, struct.error):
+                pass
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        import fcntl  # POSIX only, like /dev/shm
+        if name in self._held:
+            return False
+        f = open(self._path(name) + ".lease", "a+b")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._held[name] = f
+        return True
+
+    def release_lease(self, name: str) -> None:
+        import fcntl
+        f = self._held.pop(name)
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Redis at CACHE_REDIS_URL (needs the redis package), shared by workers on
+    any host. `client` may be any object with redis-py's get / set(nx=, px=) /
+    eval, e.g. a local stand-in. Leases are SET NX PX keys holding the owner,
+    deleted only by that owner.
+    """
+    shared = True
+    holds_icons = True
+    _RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
 
-    merged = merge_kml_two_sources(recent_scaled, full_scaled)
-    _cache.update({"kml": merged, "ts": now})
-    return merged
+    def __init__(self, url: str | None = None, client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError('CACHE_BACKEND = "redis" needs the redis package') from None
+            client = redis.Redis.from_url(url or CACHE_REDIS_URL)
+        self.client = client
+
+    def get(self, key: str) -> bytes | None:
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes, ttl: float | None = None) -> None:
+        self.client.set(key, value, px=max(1, int(ttl * 1000)) if ttl else None)
+
+    def acquire_lease(self, name: str, ttl: float) -> bool:
+        return bool(self.client.set(name, _lease_owner(), nx=True, px=max(1, int(ttl * 1000))))
+
+    def release_lease(self, name: str) -> None:
+        self.client.eval(self._RELEASE_SCRIPT, 1, name, _lease_owner())
+
+CACHE_BACKENDS = {
+    "memory": MemoryCacheBackend,
+    "file": FileCacheBackend,
+    "redis": RedisCacheBackend,
+}
+
+def get_cache_backend() -> CacheBackend:
+    """The process-wide CACHE_BACKEND instance, created on first use."""
+    backend = _backend["backend"]
+    if backend is None:
+        with _backend["lock"]:
+            if _backend["backend"] is None:
+                _backend["backend"] = CACHE_BACKENDS[CACHE_BACKEND]()
+            backend = _backend["backend"]
+    return backend
+
+# -------------------------
+# Feed registry: named upstream pairs, each with its own merge and caches
+# -------------------------
+FEED_NAME_RE = re.compile(r"[A-Za-z0-9_-]+")
+
+class Feed:
+    """
+    One named recent/full upstream pair plus everything derived from it: its
+    own refresh schedule, conditional-GET validators, merge state, merged
+    snapshot, render cache, live snapshots and placemark index. Unset options
+    fall back to the module constants.
+
+    cache:        {"ts", "kml", "gen", "gdh", "records", "bytes"}; gen bumps on every
+                  new merge, bytes is what the merged snapshot holds in memory
+    render_cache: (gen, variant, base_url, stale_bucket) -> RenderedBody
+    live_current: base_url -> ((gen, stale_bucket), token, records, elements, base_kml),
+                  least recently used first
+    live_history: base_url -> {token: records} of recent snapshots, oldest first
+    live_updates: (base_url, since) -> update body against the current snapshot
+    live_usage:   base_url -> LiveUsage, the estimated memory of the three above
+    live_dropped: base_url -> {id: tag} served by its dropped live state, so resyncs of
+                  clients still holding it delete them too; ids only, at most
+                  LIVE_MAX_BASE_URLS base URLs
+    """
+
+    def __init__(self, name: str, recent_url: str, full_url: str, stale_threshold: float | None = None,
+                 icon_scale: float | None = None, label_scale: float | None = None,
+                 refresh_interval: float | None = None):
+        self.name = name
+        self.recent_url, self.full_url = recent_url, full_url
+        self.stale_threshold = STALE_THRESHOLD_SECONDS if stale_threshold is None else stale_threshold
+        self.scales = (ICON_SCALE if icon_scale is None else icon_scale,
+                       LABEL_SCALE if label_scale is None else label_scale)
+        self.refresh_interval = REFRESH_INTERVAL_SECONDS if refresh_interval is None else refresh_interval
+
+        self.cache = {"ts": 0.0, "kml": None, "gen": 0, "gdh": {}, "records": None, "bytes": 0}
+        self.render_cache = {}
+        self.render_inflight = {}  # render_cache key -> Lock held by the thread rendering it
+        self.refresh_lock = threading.Lock()  # single-flight for upstream fetch + merge
+        self.refresher = None  # background refresh thread (or anything with is_alive()/join(), see kml_proxy_asgi)
+        self.refresh_stop = threading.Event()  # set to end this feed's refresh thread
+        self.source_state = {}  # url -> {"etag", "last_modified", "hash", "text"} of the last good fetch
+        self.upstream_stats = {"fetched": 0, "not_modified": 0, "unchanged_body": 0, "merge_skipped": 0}
+        self.merge_state = new_merge_state()
+        self.refresh_stats = {
+            "last_success": 0.0, "last_failure": 0.0, "last_error": "",
+            "last_duration": 0.0, "successes": 0, "failures": 0,
+        }
+        self.live_current, self.live_history, self.live_updates, self.live_usage = {}, {}, {}, {}
+        self.live_dropped = {}
+        self.live_lock = threading.Lock()  # taken after _render_lock, never before it
+        self.index = {"gen": None, "index": None, "lock": threading.Lock()}  # PlacemarkIndex of one generation
+        self.render_document = None  # SharedDocument of the newest generation rendered in worker processes
+
+def load_feed_registry(path: str | None = FEEDS_CONFIG_FILE) -> dict[str, Feed]:
+    """
+    DEFAULT_FEED_NAME (the SOURCE_KML_* pair) plus every feed in the JSON file
+    at `path`, if it exists:
+
+        {"feeds": {"<name>": {"recent": url, "full": url, "stale_threshold_seconds": s,
+                              "icon_scale": x, "label_scale": x, "refresh_interval_seconds": s}}}
+
+    Only "recent" and "full" are required; a feed named DEFAULT_FEED_NAME
+    replaces the built-in one. Raises ValueError on a malformed file.
+    """
+    feeds = {DEFAULT_FEED_NAME: Feed(DEFAULT_FEED_NAME, SOURCE_KML_RECENT, SOURCE_KML_FULL)}
+    if not path or not os.path.exists(path):
+        return feeds
+    with open(path, "r", encoding="utf-8") as f:
+        conf = json.load(f)
+    for name, spec in (conf.get("feeds") or {}).items():
+        if not FEED_NAME_RE.fullmatch(name):
+            raise ValueError(f"feed name {name!r} must match {FEED_NAME_RE.pattern}")
+        try:
+            feeds[name] = Feed(
+                name, spec["recent"], spec["full"],
+                stale_threshold=spec.get("stale_threshold_seconds"),
+                icon_scale=spec.get("icon_scale"), label_scale=spec.get("label_scale"),
+                refresh_interval=spec.get("refresh_interval_seconds"),
+            )
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"feed {name!r}: needs \"recent\" and \"full\" URLs ({e})") from None
+    return feeds
+
+FEEDS = load_feed_registry()
+
+def get_feed(name: str | None = None) -> Feed:
+    """The registered feed `name` (default DEFAULT_FEED_NAME); KeyError if unknown."""
+    return FEEDS[DEFAULT_FEED_NAME if name is None else name]
+
+def memory_usage() -> tuple[int, int, int]:
+    """
+    (merged snapshot bytes, rendered body bytes, live-update state bytes) over
+    all feeds. Caller holds _render_lock.
+    """
+    merged = sum(feed.cache["bytes"] for feed in FEEDS.values())
+    rendered = sum(body.size() for feed in FEEDS.values() for body in feed.render_cache.values())
+    live = 0
+    for feed in FEEDS.values():
+        with feed.live_lock:
+            live += sum(usage.size() for usage in feed.live_usage.values())
+    return merged, rendered, live
+
+def _enforce_memory_budget(keep: "RenderedBody | LiveUsage | None" = None) -> None:
+    """
+    Drops least recently used rendered bodies and live-update states (a base
+    URL's snapshot, history and cached updates), whichever feed they belong to,
+    until everything fits MEMORY_BUDGET_BYTES. Merged snapshots are never
+    evicted; `keep` (the entry just stored) is spared. Caller holds _render_lock.
+    """
+    over = sum(memory_usage()) - MEMORY_BUDGET_BYTES
+    if over <= 0:
+        return
+    entries = [(body.last_used, feed, key, body)
+               for feed in FEEDS.values() for key, body in feed.render_cache.items()]
+    for feed in FEEDS.values():
+        with feed.live_lock:
+            entries += [(usage.last_used, feed, base_url, usage) for base_url, usage in feed.live_usage.items()]
+    entries.sort(key=lambda e: e[0])
+    for _, feed, key, entry in entries:
+        if over <= 0:
+            break
+        if entry is keep:
+            continue
+        if isinstance(entry, LiveUsage):
+            with feed.live_lock:
+                if feed.live_usage.get(key) is not entry:
+                    continue  # replaced or dropped meanwhile
+                drop_live_base_url(feed, key)
+        else:
+            del feed.render_cache[key]
+        over -= entry.size()
+
+def get_merged_kml_cached(feed: Feed | None = None) -> str:
+    return get_merged_snapshot(feed)[0]
+
+def _snapshot(feed: Feed) -> tuple[str | None, int, float]:
+    with _render_lock:
+        return feed.cache["kml"], feed.cache["gen"], feed.cache["ts"]
+
+def merged_gdh_by_id(gen: int, feed: Feed | None = None) -> dict[str, float]:
+    """GDH epochs computed during the merge of generation `gen` ({} if it was replaced)."""
+    cache = (feed or get_feed()).cache
+    with _render_lock:
+        return cache["gdh"] if cache["gen"] == gen else {}
+
+def merged_records(gen: int, feed: Feed | None = None) -> list[PlacemarkRecord] | None:
+    """PlacemarkRecords of generation `gen` in document order (None if it was replaced)."""
+    cache = (feed or get_feed()).cache
+    with _render_lock:
+        return cache["records"] if cache["gen"] == gen else None
+
+def get_merged_snapshot(feed: Feed | None = None) -> tuple[str, int]:
+    """
+    Returns (merged_kml, generation) of `feed` (default feed if None);
+    generation changes whenever a new merge lands.
+
+    With BACKGROUND_REFRESH the request path only blocks until the very first merge;
+    after that it always returns the latest document the worker swapped in. Without
+    it, an expired cache is refreshed inline (one thread at a time). Either way, if
+    upstream fails and an older merge exists, that older merge is served.
+    """
+    feed = feed or get_feed()
+    started = time.perf_counter()
+    try:
+        return _merged_snapshot(feed)
+    finally:
+        METRIC_SNAPSHOT_SECONDS.observe_since(started, feed.name)
+
+def _merged_snapshot(feed: Feed) -> tuple[str, int]:
+    if BACKGROUND_REFRESH:
+        start_background_refresh(feed)
+
+    kml, gen, ts = _snapshot(feed)
+    if kml is not None and (BACKGROUND_REFRESH or time.time() - ts < feed.refresh_interval):
+        return kml, gen
+
+    with feed.refresh_lock:
+        # Another thread may have refreshed while we waited for the lock
+        kml, gen, ts = _snapshot(feed)
+        if kml is not None and time.time() - ts < feed.refresh_interval:
+            return kml, gen
+        try:
+            return _refresh_merged_kml_locked(feed)
+        except Exception:
+            if kml is None:
+                raise
+            return kml, gen
+
+def refresh_merged_kml(feed: Feed | None = None) -> tuple[str, int]:
+    """
+    Fetches both sources of `feed`, merges them and swaps the result into its
+    cache. With a shared CACHE_BACKEND this only goes upstream when no worker
+    has published a merge within the feed's refresh interval (see _refresh_shared).
+    """
+    feed = feed or get_feed()
+    with feed.refresh_lock:
+        return _refresh_merged_kml_locked(feed)
+
+def _stream_merge(feed: Feed) -> tuple[str | None, dict[str, float] | None]:
+    """Both feeds through ingest_source_stream in parallel; (None, None) if neither changed."""
+    sources = feed.merge_state["sources"]
+    urls = [(SOURCE_PRIORITY_RECENT, feed.recent_url), (SOURCE_PRIORITY_FULL, feed.full_url)]
+    results = _fetch_pool().map(lambda src: ingest_source_stream(src[1], sources.get(src[0]), feed=feed), urls)
+    ingested = {pri: res for (pri, _), res in zip(urls, results) if res is not None}
+    if not ingested:
+        return None, None
+    started = time.perf_counter()
+    try:
+        return merge_ingested(feed.merge_state, ingested)
+    finally:
+        METRIC_STAGE_SECONDS.observe_since(started, "refresh", "merge")
+
+def _text_merge(feed: Feed, responses: list | None = None) -> tuple[str | None, dict[str, float] | None]:
+    """
+    Both feeds through fetch_source in parallel, then merge_kml_incremental; (None, None) if neither changed.
+    `responses` are already fetched ones for the recent and full URL (see refresh_from_responses).
+    """
+    if responses is None:
+        pairs = _fetch_pool().map(lambda url: fetch_source(url, feed), [feed.recent_url, feed.full_url])
+    else:
+        for resp in responses:
+            if isinstance(resp, BaseException):
+                raise resp
+        pairs = [accept_source_response(url, feed, *resp) for url, resp in zip((feed.recent_url, feed.full_url),
+                                                                               responses)]
+    (recent_kml, recent_changed), (full_kml, full_changed) = pairs
+    if not (recent_changed or full_changed or feed.cache["kml"] is None):
+        return None, None
+    unchanged = {pri for pri, changed in ((SOURCE_PRIORITY_FULL, full_changed),
+                                          (SOURCE_PRIORITY_RECENT, recent_changed)) if not changed}
+    started = time.perf_counter()
+    try:
+        return merge_kml_incremental(
+            feed.merge_state, {SOURCE_PRIORITY_FULL: full_kml, SOURCE_PRIORITY_RECENT: recent_kml}, unchanged,
+            scales=feed.scales)
+    finally:
+        METRIC_STAGE_SECONDS.observe_since(started, "refresh", "merge")
+
+def _refresh_merged_kml_locked(feed: Feed) -> tuple[str, int]:
+    backend = get_cache_backend()
+    if backend.shared:
+        return _refresh_shared(feed, backend)
+    return _refresh_from_upstream(feed)
+
+def refresh_from_responses(feed: Feed, responses: list) -> tuple[str, int]:
+    """
+    refresh_merged_kml for upstream responses fetched by the caller: one per
+    source (recent, full), each (status, headers, content, text) as taken by
+    accept_source_response, or the exception its fetch raised. Used where the
+    fetching is asynchronous; always the text merge, since the bodies are
+    already in memory.
+    """
+    with feed.refresh_lock:
+        return _refresh_from_upstream(feed, responses)
+
+def _refresh_from_upstream(feed: Feed, responses: list | None = None) -> tuple[str, int]:
+    started = time.time()
+    try:
+        if responses is not None:
+            merged, gdh_by_id = _text_merge(feed, responses)
+        else:
+            merged, gdh_by_id = _stream_merge(feed) if STREAM_INGEST else _text_merge(feed)
+        records = feed.merge_state["records"]
+    except Exception as e:
+        # Forget validators so the next poll re-downloads instead of getting a 304
+        # for a body that never made it into the merge state
+        for url in (feed.recent_url, feed.full_url):
+            feed.source_state.pop(url, None)
+        feed.refresh_stats.update({
+            "last_failure": time.time(), "last_error": f"{type(e).__name__}: {e}",
+            "last_duration": time.time() - started, "failures": feed.refresh_stats["failures"] + 1,
+        })
+        METRIC_REFRESH_SECONDS.observe(time.time() - started, feed.name, "error")
+        raise
+
+    now = time.time()
+    with _render_lock:
+        cache = feed.cache
+        if merged is None:
+            # Both sources unchanged: keep the current merge (and its rendered outputs)
+            feed.upstream_stats["merge_skipped"] += 1
+            cache["ts"] = now
+            merged = cache["kml"]
+        else:
+            size = len(merged) + sum(len(rec.xml) for rec in records)
+            cache.update({"kml": merged, "ts": now, "gen": cache["gen"] + 1, "gdh": gdh_by_id,
+                          "records": records, "bytes": size})
+            feed.render_cache.clear()
+            _enforce_memory_budget()
+        gen = cache["gen"]
+    feed.refresh_stats.update({
+        "last_success": now, "last_duration": now - started,
+        "successes": feed.refresh_stats["successes"] + 1,
+    })
+    METRIC_REFRESH_SECONDS.observe(now - started, feed.name, "merged" if gdh_by_id is not None else "unchanged")
+    return merged, gen
+
+def _merged_keys(feed: Feed) -> tuple[str, str]:
+    return _shared_key("feed", feed.name, "meta"), _shared_key("feed", feed.name, "kml")
+
+def publish_merged(feed: Feed, backend: CacheBackend, changed: bool) -> None:
+    """Writes the feed's merge for other workers: the document (if it changed), then {"gen", "ts"}."""
+    meta_key, kml_key = _merged_keys(feed)
+    kml, gen, ts = _snapshot(feed)
+    if changed:
+        backend.set(kml_key, f"{gen}\n".encode("utf-8") + kml.encode("utf-8"))
+    backend.set(meta_key, json.dumps({"gen": gen, "ts": ts}).encode("utf-8"))
+
+def sync_merged_from_backend(feed: Feed, backend: CacheBackend) -> None:
+    """
+    Adopts the merge another worker published when its generation is newer than
+    ours (records are rebuilt from the document); for the same generation only
+    the refresh time is taken over.
+    """
+    meta_key, kml_key = _merged_keys(feed)
+    raw = backend.get(meta_key)
+    if raw is None:
+        return
+    meta = json.loads(raw)
+    kml, gen, ts = _snapshot(feed)
+    if kml is not None and meta["gen"] <= gen:
+        if meta["gen"] == gen and meta["ts"] > ts:
+            with _render_lock:
+                if feed.cache["gen"] == gen:
+                    feed.cache["ts"] = meta["ts"]
+        return
+
+    body = backend.get(kml_key)
+    if body is None:
+        return
+    head, _, data = body.partition(b"\n")
+    new_gen, merged = int(head), data.decode("utf-8")
+    if kml is not None and new_gen <= gen:
+        return
+    records = records_from_kml(merged)
+    gdh_by_id = {rec.id: rec.gdh for rec in records if rec.id}
+    size = len(merged) + sum(len(rec.xml) for rec in records)
+    with _render_lock:
+        feed.cache.update({"kml": merged, "ts": meta["ts"], "gen": new_gen, "gdh": gdh_by_id,
+                           "records": records, "bytes": size})
+        feed.render_cache.clear()
+        _enforce_memory_budget()
+    # Our validators describe our own last fetch, not this merge: the next
+    # refresh here must download (and re-ingest against our merge state) in full
+    feed.source_state.clear()
+
+def _refresh_shared(feed: Feed, backend: CacheBackend) -> tuple[str, int]:
+    """
+    Multi-worker refresh. A merge some worker published within the feed's
+    refresh interval is adopted as-is. Otherwise whoever wins the feed's lease
+    goes upstream and publishes; the others keep serving their current merge,
+    or, before they have one, wait up to REFRESH_LEASE_SECONDS for the publish.
+    """
+    lease = _shared_key("feed", feed.name, "refresh")
+    deadline = time.time() + REFRESH_LEASE_SECONDS
+    while True:
+        sync_merged_from_backend(feed, backend)
+        kml, gen, ts = _snapshot(feed)
+        if kml is not None and time.time() - ts < feed.refresh_interval:
+            return kml, gen
+        if backend.acquire_lease(lease, REFRESH_LEASE_SECONDS):
+            try:
+                # The previous holder may have published while we were checking
+                sync_merged_from_backend(feed, backend)
+                kml, gen, ts = _snapshot(feed)
+                if kml is not None and time.time() - ts < feed.refresh_interval:
+                    return kml, gen
+                merged, new_gen = _refresh_from_upstream(feed)
+                publish_merged(feed, backend, new_gen != gen)
+                return merged, new_gen
+            finally:
+                backend.release_lease(lease)
+        if kml is not None:
+            return kml, gen
+        if time.time() > deadline:
+            raise RuntimeError(f"feed {feed.name!r}: no merge published by the refreshing worker")
+        time.sleep(0.2)
+
+# -------------------------
+# Background refresher
+# -------------------------
+def _refresh_loop(feed: Feed) -> None:
+    while not feed.refresh_stop.is_set():
+        try:
+            refresh_merged_kml(feed)
+        except Exception:
+            pass  # recorded in feed.refresh_stats; keep serving the previous merge
+        feed.refresh_stop.wait(feed.refresh_interval)
+
+def start_background_refresh(feed: Feed | None = None) -> None:
+    """
+    Starts the refresh worker of `feed` (default feed if None) once per process
+    (safe to call on every request). Each feed polls on its own interval, and
+    only from its first request on.
+    """
+    feed = feed or get_feed()
+    t = feed.refresher
+    if t is not None and t.is_alive():
+        return
+    with _refresher["lock"]:
+        t = feed.refresher
+        if t is not None and t.is_alive():
+            return
+        feed.refresh_stop.clear()
+        t = threading.Thread(target=_refresh_loop, args=(feed,), name=f"kml-refresh-{feed.name}", daemon=True)
+        feed.refresher = t
+        t.start()
+
+def stop_background_refresh(timeout: float | None = None) -> None:
+    """Stops the refresh workers of every feed."""
+    for feed in FEEDS.values():
+        feed.refresh_stop.set()
+    for feed in FEEDS.values():
+        t = feed.refresher
+        if t is not None:
+            t.join(timeout)
+        feed.refresher = None
+
+def refresh_stats_lines(feed: Feed | None = None) -> list[str]:
+    feed = feed or get_feed()
+    now = time.time()
+    kml, gen, ts = _snapshot(feed)
+    with _render_lock:
+        merged_bytes, rendered_bytes, live_bytes = memory_usage()
+
+    def ago(t: float) -> str:
+        return f"{now - t:.1f}s ago" if t else "never"
+
+    st, up, ms = feed.refresh_stats, feed.upstream_stats, feed.merge_state["stats"]
+    return [
+        f"Feed: {feed.name} ({len(FEEDS)} registered)",
+        f"Background refresh: {'on' if BACKGROUND_REFRESH else 'off'} (every {feed.refresh_interval}s)",
+        f"Generation: {gen}",
+        f"Merged document age: {ago(ts) if kml is not None else 'none yet'}",
+        f"Last success: {ago(st['last_success'])}",
+        f"Last failure: {ago(st['last_failure'])}",
+        f"Last error: {st['last_error'] or '-'}",
+        f"Last refresh duration: {st['last_duration']:.3f}s",
+        f"Successes: {st['successes']}",
+        f"Failures: {st['failures']}",
+        f"Upstream bodies fetched: {up['fetched']}",
+        f"Upstream 304 Not Modified: {up['not_modified']}",
+        f"Upstream unchanged bodies (same hash): {up['unchanged_body']}",
+        f"Merges skipped (no source changed): {up['merge_skipped']}",
+        f"Last merge: {ms['placemarks']} placemarks, {ms['reprocessed']} re-processed, "
+        f"{ms['reused']} reused, {ms['removed']} removed",
+        f"Memory (all feeds): {merged_bytes} merged + {rendered_bytes} rendered + {live_bytes} live "
+        f"of {MEMORY_BUDGET_BYTES} bytes",
+    ]
 
 # -------------------------
 # Stale flagging (single path)
@@ -331,54 +1719,121 @@ def apply_stale_style(pm: ET.Element, stale_href: str) -> None:
     _ensure(label_style, "scale").text = str(STALE_LABEL_SCALE)
 
 def flag_stale_placemarks_in_kml(kml_xml: str, base_url: str) -> str:
-    root = ET.fromstring(kml_xml)
-    doc = root.find("kml:Document", KML_NS)
+    root, doc = parse_kml(kml_xml)
     if doc is None:
         return kml_xml
+    flag_stale_placemarks(doc, base_url)
+    return serialize_kml(root)
 
-    now = time.time()
+def flag_stale_placemarks(doc: ET.Element, base_url: str, now: float | None = None,
+                          gdh_by_id: dict[str, float] | None = None, index: "RenderIndex | None" = None,
+                          stale_threshold: float | None = None) -> None:
+    """
+    gdh_by_id (from the merge) spares re-parsing descriptions of known placemarks.
+    Placemarks it marks are added to index.stale for the later stages.
+    stale_threshold defaults to STALE_THRESHOLD_SECONDS.
+    """
+    now = time.time() if now is None else now
+    threshold = STALE_THRESHOLD_SECONDS if stale_threshold is None else stale_threshold
     stale_href = f"{base_url}{STALE_ICON_PATH}"
-
-    for pm in doc.findall(".//kml:Placemark", namespaces=KML_NS):
-        gdh = extract_gdh_epoch_from_placemark(ET.tostring(pm, encoding="unicode"))
-        if gdh and (now - gdh) > STALE_THRESHOLD_SECONDS:
+    gdh_by_id = gdh_by_id or {}
+    index = index or RenderIndex(doc)
+
+    for pm in index.placemarks:
+        gdh = gdh_by_id.get(pm.attrib.get("id") or "")
+        if gdh is None:
+            gdh = gdh_epoch_of(pm)
+        if gdh and (now - gdh) > threshold:
+            had_ext = pm.find("kml:ExtendedData", KML_NS) is not None
             apply_stale_style(pm, stale_href)
             mark_pm_stale(pm)
-
-    return ET.tostring(root, encoding="utf-8", xml_declaration=True).decode("utf-8")
+            # An existing <Data name="stale"> earlier in the feed's ExtendedData still wins
+            if not had_ext or is_stale_placemark(pm):
+                index.stale.add(pm)
 
 # -------------------------
 # KMZ icon embedding
 # -------------------------
+def _is_embeddable_icon(h: str) -> bool:
+    lh = h.lower()
+    return h.startswith(ALLOWED_ICON_PREFIX) and any(ext in lh for ext in (".png", ".jpg", ".jpeg"))
+
 def extract_icon_urls(kml: str) -> list[str]:
     hrefs = re.findall(HREF_RE, kml, flags=re.IGNORECASE)
     out, seen = [], set()
     for h in map(str.strip, hrefs):
-        lh = h.lower()
-        if h.startswith(ALLOWED_ICON_PREFIX) and any(ext in lh for ext in (".png", ".jpg", ".jpeg")):
+        if _is_embeddable_icon(h):
             if h not in seen:
                 out.append(h); seen.add(h)
     return out
+
+def _href_elements(root: ET.Element) -> Iterator[ET.Element]:
+    for el in root.iter():
+        if el.text and el.tag.rsplit("}", 1)[-1].lower() == "href":
+            yield el
+
+def icon_urls_in_tree(root: ET.Element) -> list[str]:
+    """Tree counterpart of extract_icon_urls (same order, same filter)."""
+    out, seen = [], set()
+    for el in _href_elements(root):
+        h = el.text.strip()
+        if _is_embeddable_icon(h) and h not in seen:
+            out.append(h); seen.add(h)
+    return out
+
+def rewrite_hrefs_in_tree(root: ET.Element, mapping: dict[str, str]) -> None:
+    for el in _href_elements(root):
+        url = el.text.strip()
+        if url in mapping:
+            el.text = el.text.replace(url, mapping[url])
 def move_stale_items_to_inativos_folder(kml_xml: str, folder_name: str = "inativos") -> str:
     """
     Moves:
       - stale Placemarks (ExtendedData/Data[@name='stale']/value='true') into Folder 'inativos'
       - Folders that contain at least one stale Placemark into Folder 'inativos'
     """
-    root = ET.fromstring(kml_xml)
-    doc = root.find("kml:Document", KML_NS)
+    root, doc = parse_kml(kml_xml)
     if doc is None:
         return kml_xml
+    move_stale_items_to_folder(doc, folder_name)
+    return serialize_kml(root)
+
+def is_stale_placemark(pm: ET.Element) -> bool:
+    """True if the placemark carries <Data name="stale"><value>true (as set by mark_pm_stale)."""
+    v = pm.findtext(".//kml:ExtendedData/kml:Data[@name='stale']/kml:value", default="", namespaces=KML_NS)
+    return (v or "").strip().lower() == "true"
+
+class RenderIndex:
+    """
+    Lookups shared by the tree stages of one render, built in a single pass:
+
+    placemarks: every <Placemark> in document order, at any depth
+    by_id:      placemark id -> element (the last one wins)
+    stale:      placemarks carrying the stale mark; flag_stale_placemarks adds
+                the ones it marks, so later stages never re-run the XPath
+    """
+    __slots__ = ("placemarks", "by_id", "stale")
+
+    def __init__(self, doc: ET.Element):
+        self.placemarks = list(doc.iter(_PLACEMARK_TAG))
+        self.by_id, self.stale = {}, set()
+        for pm in self.placemarks:
+            pm_id = pm.get("id")
+            if pm_id:
+                self.by_id[pm_id] = pm
+            if pm.find("kml:ExtendedData", KML_NS) is not None and is_stale_placemark(pm):
+                self.stale.add(pm)
+
+def move_stale_items_to_folder(doc: ET.Element, folder_name: str = "inativos",
+                               index: RenderIndex | None = None) -> None:
+    """In-place variant of move_stale_items_to_inativos_folder on a parsed <Document>."""
+    stale = (index or RenderIndex(doc)).stale
 
     def is_stale_pm(pm: ET.Element) -> bool:
-        v = pm.findtext(".//kml:ExtendedData/kml:Data[@name='stale']/kml:value", default="", namespaces=KML_NS)
-        return (v or "").strip().lower() == "true"
+        return pm in stale
 
     def folder_contains_stale(folder: ET.Element) -> bool:
-        for pm in folder.findall(".//kml:Placemark", namespaces=KML_NS):
-            if is_stale_pm(pm):
-                return True
-        return False
+        return any(pm in stale for pm in folder.iter(_PLACEMARK_TAG))
 
     # Find or create the inativos folder (top-level under Document)
     inativos = None
@@ -430,54 +1885,458 @@ def move_stale_items_to_inativos_folder(kml_xml: str, folder_name: str = "inativ
     for el in new_children:
         doc.append(el)
 
-    return ET.tostring(root, encoding="utf-8", xml_declaration=True).decode("utf-8")
-
 def safe_icon_filename(url: str) -> str:
     path = urlparse(url).path
     ext = ".jpg" if path.lower().endswith((".jpg", ".jpeg")) else ".png"
     h = hashlib.sha256(url.encode("utf-8")).hexdigest()[:24]
     return f"icons/{h}{ext}"
 
-def fetch_icon_bytes(url: str) -> tuple[bytes, str]:
+# -------------------------
+# Disk icon store: urls/<sha(url)>.json -> blobs/<sha(content)>, LRU by index mtime
+# -------------------------
+def _icon_index_path(url: str) -> str:
+    return os.path.join(ICON_CACHE_DIR, "urls", hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+def _icon_blob_path(digest: str) -> str:
+    return os.path.join(ICON_CACHE_DIR, "blobs", digest)
+
+def _atomic_write(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+def icon_store_get(url: str) -> tuple[float, bytes, str] | None:
+    """Returns (fetched_ts, bytes, content_type) from disk, or None. Marks the entry as used."""
+    index_path = _icon_index_path(url)
+    try:
+        with open(index_path, "rb") as f:
+            meta = json.load(f)
+        if meta.get("url") != url:
+            return None
+        with open(_icon_blob_path(meta["sha256"]), "rb") as f:
+            data = f.read()
+        os.utime(index_path)
+    except (OSError, ValueError, KeyError):
+        return None
+    return float(meta["fetched"]), data, meta["ctype"]
+
+def icon_store_put(url: str, data: bytes, ctype: str, fetched: float) -> None:
+    """Stores icon bytes once per content hash; different URLs with equal bytes share a blob."""
+    digest = hashlib.sha256(data).hexdigest()
+    try:
+        blob = _icon_blob_path(digest)
+        if not os.path.exists(blob):
+            _atomic_write(blob, data)
+        meta = {"url": url, "sha256": digest, "ctype": ctype, "fetched": fetched}
+        _atomic_write(_icon_index_path(url), json.dumps(meta).encode("utf-8"))
+    except OSError:
+        return  # the disk store is an optimisation; never fail an icon fetch over it
+    maybe_prune_icon_store()
+
+def maybe_prune_icon_store(force: bool = False) -> None:
     now = time.time()
-    cached = _icon_cache.get(url)
-    if cached and (now - cached[0] < ICON_CACHE_SECONDS):
-        return cached[1], cached[2]
+    if not force and now - _icon_store["last_prune"] < ICON_CACHE_PRUNE_INTERVAL_SECONDS:
+        return
+    if not _icon_store["lock"].acquire(blocking=False):
+        return
+    try:
+        _icon_store["last_prune"] = now
+        prune_icon_store(now)
+    except OSError:
+        pass
+    finally:
+        _icon_store["lock"].release()
+
+def prune_icon_store(now: float | None = None) -> None:
+    """
+    Drops index entries unused for ICON_CACHE_MAX_AGE_SECONDS, then evicts least
+    recently used entries until the referenced blobs fit ICON_CACHE_MAX_BYTES,
+    then deletes blobs no entry points at.
+    """
+    now = time.time() if now is None else now
+    index_dir = os.path.join(ICON_CACHE_DIR, "urls")
+    blob_dir = os.path.join(ICON_CACHE_DIR, "blobs")
+    if not os.path.isdir(index_dir):
+        return
+
+    entries = []  # (last_used, index_path, digest)
+    for name in os.listdir(index_dir):
+        path = os.path.join(index_dir, name)
+        try:
+            last_used = os.path.getmtime(path)
+            if now - last_used > ICON_CACHE_MAX_AGE_SECONDS:
+                os.unlink(path)
+                continue
+            with open(path, "rb") as f:
+                entries.append((last_used, path, json.load(f)["sha256"]))
+        except (OSError, ValueError, KeyError):
+            continue
+
+    sizes = {}
+    for _, _, digest in entries:
+        if digest not in sizes:
+            try:
+                sizes[digest] = os.path.getsize(_icon_blob_path(digest))
+            except OSError:
+                sizes[digest] = 0
+
+    refs = {}
+    for _, _, digest in entries:
+        refs[digest] = refs.get(digest, 0) + 1
+    total = sum(sizes.values())
+
+    entries.sort()
+    for _, path, digest in entries:
+        if total <= ICON_CACHE_MAX_BYTES:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        refs[digest] -= 1
+        if refs[digest] == 0:
+            total -= sizes[digest]
+
+    live = {d for d, n in refs.items() if n > 0}
+    if os.path.isdir(blob_dir):
+        for name in os.listdir(blob_dir):
+            if name not in live and not name.startswith(".tmp-"):
+                try:
+                    os.unlink(os.path.join(blob_dir, name))
+                except OSError:
+                    pass
+
+# -------------------------
+# Icon fetch: memory -> disk store -> network
+# -------------------------
+def _icon_key(url: str) -> str:
+    return _shared_key("icon", hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+def _remember_icon(url: str, entry: tuple[float, bytes, str]) -> None:
+    # Shared backends replace the per-process layer, so workers don't each hold a copy
+    backend = get_cache_backend()
+    if backend.shared:
+        if backend.holds_icons:
+            ttl = ICON_CACHE_SECONDS - (time.time() - entry[0])
+            if ttl > 0:
+                backend.set(_icon_key(url), f"{entry[0]}\n{entry[2]}\n".encode("utf-8") + entry[1], ttl=ttl)
+        return
+    _icon_cache.pop(url, None)
+    while len(_icon_cache) >= ICON_MEMORY_CACHE_MAX_ENTRIES:
+        _icon_cache.pop(next(iter(_icon_cache)), None)
+    _icon_cache[url] = entry
+
+def _cached_icon(url: str) -> tuple[bytes, str] | None:
+    """Fresh icon from memory (or the shared backend) or the disk store, without touching the network."""
+    backend = get_cache_backend()
+    if not backend.shared:
+        cached = _icon_cache.get(url)
+        if cached and (time.time() - cached[0] < ICON_CACHE_SECONDS):
+            return cached[1], cached[2]
+    elif backend.holds_icons:
+        raw = backend.get(_icon_key(url))
+        if raw is not None:
+            _, ctype, data = raw.split(b"\n", 2)
+            return data, ctype.decode("utf-8")
+    stored = icon_store_get(url)
+    if stored and (time.time() - stored[0] < ICON_CACHE_SECONDS):
+        _remember_icon(url, stored)
+        return stored[1], stored[2]
+    return None
+
+def fetch_icon_bytes(url: str) -> tuple[bytes, str]:
+    cached = _cached_icon(url)
+    if cached:
+        return cached
 
     if not url.startswith(ALLOWED_ICON_PREFIX):
         raise ValueError("Icon URL not allowed")
 
-    verify = False if ALLOW_INSECURE_SSL else certifi.where()
-    r = requests.get(
-        url, timeout=10,
-        headers={
-            "User-Agent": "KML-Proxy/ATAK-1.2",
-            "Accept": "image/*,*/*;q=0.8",
-            "Referer": "https://mapmil.igeoe.pt/"
-        },
-        verify=verify
-    )
-    r.raise_for_status()
+    started = time.perf_counter()
+    try:
+        r = get_upstream_session().get(
+            url, timeout=ICON_FETCH_TIMEOUT_SECONDS,
+            headers={
+                "Accept": "image/*,*/*;q=0.8",
+                "Referer": "https://mapmil.igeoe.pt/"
+            },
+            verify=_upstream_verify()
+        )
+        r.raise_for_status()
+    except Exception as e:
+        METRIC_UPSTREAM_SECONDS.observe_since(started, "icon")
+        record_icon_failure(url, f"{type(e).__name__}: {e}")
+        # Upstream down: an expired copy on disk beats a missing icon
+        stored = icon_store_get(url)
+        if stored is None:
+            METRIC_UPSTREAM_RESPONSES.inc("icon", "error")
+            raise
+        METRIC_UPSTREAM_RESPONSES.inc("icon", "expired_copy")
+        return stored[1], stored[2]
+    METRIC_UPSTREAM_SECONDS.observe_since(started, "icon")
+
     data = r.content
+    METRIC_UPSTREAM_RESPONSES.inc("icon", "fetched")
+    METRIC_UPSTREAM_BYTES.inc("icon", amount=len(data))
     ctype = r.headers.get("Content-Type", "image/png")
-    _icon_cache[url] = (now, data, ctype)
+    store_icon(url, data, ctype)
     return data, ctype
 
+def store_icon(url: str, data: bytes, ctype: str) -> None:
+    """Caches a freshly downloaded icon in memory (or the shared backend) and the disk store."""
+    now = time.time()
+    _remember_icon(url, (now, data, ctype))
+    icon_store_put(url, data, ctype, now)
+    _icon_failures.pop(url, None)
+
+def record_icon_failure(url: str, error: str, when: float | None = None) -> None:
+    """
+    For ICON_RETRY_AFTER_SECONDS (from `when`, default now), KMZ builds embed
+    the expired copy of url on disk, or else report `error`, instead of
+    downloading it again.
+    """
+    _icon_failures.pop(url, None)
+    while len(_icon_failures) >= ICON_MEMORY_CACHE_MAX_ENTRIES:
+        _icon_failures.pop(next(iter(_icon_failures)), None)
+    _icon_failures[url] = (time.time() if when is None else when, error)
+
+def recent_icon_failures(since: float | None = None) -> dict[str, tuple[float, str]]:
+    """url -> (ts, error) of failures still inside ICON_RETRY_AFTER_SECONDS (and at or after `since`)."""
+    cutoff = time.time() - ICON_RETRY_AFTER_SECONDS
+    if since is not None:
+        cutoff = max(cutoff, since)
+    return {url: entry for url, entry in list(_icon_failures.items()) if entry[0] >= cutoff}
+
+def recent_icon_failure(url: str) -> str | None:
+    entry = _icon_failures.get(url)
+    if entry and time.time() - entry[0] < ICON_RETRY_AFTER_SECONDS:
+        return entry[1]
+    return None
+
+def icons_to_fetch(urls: list[str]) -> list[str]:
+    """The embeddable urls a KMZ build would download: not cached and not recently failed."""
+    return [u for u in urls if u.startswith(ALLOWED_ICON_PREFIX) and _cached_icon(u) is None
+            and recent_icon_failure(u) is None]
+
+def _icon_pool() -> ThreadPoolExecutor:
+    pool = _upstream["icon_pool"]
+    if pool is None:
+        with _upstream["lock"]:
+            if _upstream["icon_pool"] is None:
+                _upstream["icon_pool"] = ThreadPoolExecutor(
+                    max_workers=ICON_FETCH_CONCURRENCY, thread_name_prefix="kml-icon")
+            pool = _upstream["icon_pool"]
+    return pool
+
+def start_icon_fetch(urls: list[str]) -> tuple[float, dict[str, bytes], dict, dict[str, str]]:
+    """Resolves cached (and recently failed) icons and queues the rest; pair with finish_icon_fetch()."""
+    icons, futures, errors = {}, {}, {}
+    for url in urls:
+        cached = _cached_icon(url)
+        if cached:
+            icons[url] = cached[0]
+            continue
+        error = recent_icon_failure(url)
+        if error is None:
+            futures[_icon_pool().submit(fetch_icon_bytes, url)] = url
+            continue
+        stored = icon_store_get(url)
+        if stored is not None:
+            icons[url] = stored[1]
+        else:
+            errors[url] = error
+    METRIC_ICON_CACHE.inc("hit", amount=len(icons))
+    METRIC_ICON_CACHE.inc("miss", amount=len(futures) + len(errors))
+    return time.time(), icons, futures, errors
+
+def finish_icon_fetch(pending: tuple[float, dict[str, bytes], dict, dict[str, str]],
+                      deadline_seconds: float | None = None) -> tuple[dict[str, bytes], dict[str, str]]:
+    """
+    Waits for queued icons until the deadline (counted from start_icon_fetch)
+    and returns (url -> bytes, url -> error). Icons still in flight at the
+    deadline are reported as errors; downloads that already started keep
+    running and land in the icon cache for the next build.
+    """
+    deadline_seconds = ICON_FETCH_DEADLINE_SECONDS if deadline_seconds is None else deadline_seconds
+    started, icons, futures, errors = pending
+
+    done, not_done = wait(futures, timeout=max(0.0, started + deadline_seconds - time.time()))
+    for f in done:
+        try:
+            icons[futures[f]] = f.result()[0]
+        except Exception as e:
+            errors[futures[f]] = f"{type(e).__name__}: {e}"
+    for f in not_done:
+        f.cancel()
+        errors[futures[f]] = f"TimeoutError: not downloaded within the {deadline_seconds}s icon deadline"
+    return icons, errors
+
 def rewrite_kml_hrefs_to_embedded(kml: str, mapping: dict[str, str]) -> str:
     def repl(m):
         url = m.group(1).strip()
         return m.group(0).replace(url, mapping[url]) if url in mapping else m.group(0)
     return re.sub(HREF_RE, repl, kml, flags=re.IGNORECASE)
 
-def build_kmz_with_embedded_icons(kml: str, base_url: str) -> bytes:
-    icon_urls = extract_icon_urls(kml)
+# -------------------------
+# Minimal zip writer over pre-built entries (icons compressed once, not per KMZ)
+# -------------------------
+_ZIP_LOCAL = struct.Struct("<4s2B4HL2L2H")
+_ZIP_CENTRAL = struct.Struct("<4s4B4HL2L5H2L")
+_ZIP_END = struct.Struct("<4s4H2LH")
+
+_ZIP_DESCRIPTOR = struct.Struct("<4s3L")
+# Every member is stamped 1980-01-01 00:00 (the DOS epoch) so identical content
+# zips to identical bytes, and RenderedBody ETags match across renders.
+_ZIP_DOSTIME, _ZIP_DOSDATE = 0, (1 << 5) | 1
+
+class _ZipEntry:
+    """
+    One zip member with its local header and (possibly compressed) data ready to copy.
+
+    With payload=None the member is streamed: the local header carries zeros and
+    iter_zip() writes CRC and sizes in a data descriptor after the data.
+    """
+    __slots__ = ("name", "method", "flags", "crc", "size", "csize", "dostime", "dosdate", "header", "data")
+
+    def __init__(self, name: str, payload: bytes | None, compress: bool):
+        self.name = name.encode("utf-8")
+        self.flags = 0x800 if any(b > 0x7F for b in self.name) else 0
+        self.method = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        if payload is None:
+            self.flags |= 0x08
+            self.crc, self.size, self.csize, self.data = 0, 0, 0, b""
+        else:
+            self.crc = zlib.crc32(payload)
+            self.size = len(payload)
+            if compress:
+                co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+                self.data = co.compress(payload) + co.flush()
+            else:
+                self.data = payload
+            self.csize = len(self.data)
+        self.dostime, self.dosdate = _ZIP_DOSTIME, _ZIP_DOSDATE
+        self.header = _ZIP_LOCAL.pack(
+            b"PK\003\004", 20, 0, self.flags, self.method, self.dostime, self.dosdate,
+            self.crc, self.csize, self.size, len(self.name), 0) + self.name
+
+    def central_record(self, offset: int) -> bytes:
+        return _ZIP_CENTRAL.pack(
+            b"PK\001\002", 20, 3, 20, 0, self.flags, self.method, self.dostime, self.dosdate,
+            self.crc, self.csize, self.size, len(self.name), 0, 0, 0, 0, 0o100644 << 16, offset) + self.name
+
+def assemble_zip(entries: list[_ZipEntry]) -> bytes:
+    return b"".join(iter_zip(entries))
+
+def iter_zip(members: Iterable[_ZipEntry | tuple[str, Iterable[bytes]]]) -> Iterator[bytes]:
+    """
+    Yields a zip archive piece by piece. Members are pre-built _ZipEntry objects
+    or (name, chunks) pairs, which are DEFLATEd on the fly behind a data descriptor.
+    """
+    central, offset = [], 0
+    for m in members:
+        if isinstance(m, _ZipEntry):
+            central.append(m.central_record(offset))
+            yield m.header
+            yield m.data
+            offset += len(m.header) + len(m.data)
+            continue
+
+        name, chunks = m
+        e = _ZipEntry(name, None, compress=True)
+        central_offset = offset
+        yield e.header
+        offset += len(e.header)
+        co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        for chunk in chunks:
+            e.crc = zlib.crc32(chunk, e.crc)
+            e.size += len(chunk)
+            out = co.compress(chunk)
+            if out:
+                e.csize += len(out)
+                yield out
+        out = co.flush()
+        e.csize += len(out)
+        yield out
+        desc = _ZIP_DESCRIPTOR.pack(b"PK\007\010", e.crc, e.csize, e.size)
+        yield desc
+        offset += e.csize + len(desc)
+        central.append(e.central_record(central_offset))
+
+    cd = b"".join(central)
+    yield cd
+    yield _ZIP_END.pack(b"PK\005\006", 0, 0, len(central), len(central), len(cd), offset, 0)
+
+def cached_icon_zip_entry(embedded_path: str, data: bytes) -> _ZipEntry:
+    key = (embedded_path, zlib.crc32(data), len(data))
+    entry = _zip_entry_cache.get(key)
+    if entry is None:
+        entry = _ZipEntry(embedded_path, data, compress=not KMZ_STORE_ICONS)
+        while len(_zip_entry_cache) >= ICON_MEMORY_CACHE_MAX_ENTRIES:
+            _zip_entry_cache.pop(next(iter(_zip_entry_cache)), None)
+        _zip_entry_cache[key] = entry
+    return entry
+
+def stale_icon_zip_entry() -> _ZipEntry:
+    """Zip entry for static/stale.png, re-read only when the file changes on disk."""
+    st = os.stat(STALE_ICON_FILE)
+    key = (STALE_ICON_EMBED_PATH, STALE_ICON_FILE, st.st_mtime_ns, st.st_size)
+    entry = _zip_entry_cache.get(key)
+    if entry is None:
+        with open(STALE_ICON_FILE, "rb") as f:
+            entry = _ZipEntry(STALE_ICON_EMBED_PATH, f.read(), compress=not KMZ_STORE_ICONS)
+        _zip_entry_cache[key] = entry
+    return entry
+
+def _embedded_icon_paths(icon_urls: list[str], stale_href: str) -> dict[str, str]:
     url_to_path = {u: safe_icon_filename(u) for u in icon_urls}
+    url_to_path[stale_href] = STALE_ICON_EMBED_PATH
+    return url_to_path
+
+def build_kmz_with_embedded_icons(kml: str, base_url: str) -> bytes:
+    started = time.perf_counter()
+    kmz = assemble_zip(list(_atak_kmz_members_text(kml, base_url)))
+    METRIC_STAGE_SECONDS.observe_since(started, "kmz", "build_atak")
+    return kmz
 
+def iter_kmz_with_embedded_icons_text(kml: str, base_url: str) -> Iterator[bytes]:
+    """Streaming build_kmz_with_embedded_icons: only the icon entries are produced lazily."""
+    return iter_zip(_atak_kmz_members_text(kml, base_url))
+
+def _atak_kmz_members_text(kml: str, base_url: str) -> Iterator[_ZipEntry | tuple[str, Iterable[bytes]]]:
+    icon_urls = extract_icon_urls(kml)
     stale_href = f"{base_url}{STALE_ICON_PATH}"
-    url_to_path[stale_href] = STALE_ICON_EMBED_PATH
+    url_to_path = _embedded_icon_paths(icon_urls, stale_href)
 
     kml_rewritten = rewrite_kml_hrefs_to_embedded(kml, url_to_path)
+    pending = start_icon_fetch(icon_urls)
+    doc_entry = _ZipEntry("doc.kml", kml_rewritten.encode("utf-8"), compress=True)
+    return _atak_kmz_members(doc_entry, icon_urls, url_to_path, stale_href, pending)
 
+def iter_kmz_with_embedded_icons(root: ET.Element, base_url: str) -> Iterator[bytes]:
+    """
+    Streaming counterpart of build_kmz_with_embedded_icons for an already processed
+    tree. Icon downloads start before doc.kml is streamed and are collected after it.
+    """
+    icon_urls = icon_urls_in_tree(root)
+    stale_href = f"{base_url}{STALE_ICON_PATH}"
+    url_to_path = _embedded_icon_paths(icon_urls, stale_href)
+
+    rewrite_hrefs_in_tree(root, url_to_path)
+    pending = start_icon_fetch(icon_urls)
+    doc_member = ("doc.kml", iter_serialize_kml(root))
+    return iter_zip(_atak_kmz_members(doc_member, icon_urls, url_to_path, stale_href, pending))
+
+def _atak_kmz_members(doc_member, icon_urls: list[str], url_to_path: dict[str, str],
+                      stale_href: str, pending) -> Iterator[_ZipEntry | tuple[str, Iterable[bytes]]]:
     debug_lines = [
         f"Found icon URLs: {len(icon_urls)}",
         f"Stale href expected: {stale_href}",
@@ -492,38 +2351,41 @@ def build_kmz_with_embedded_icons(kml: str, base_url: str) -> bytes:
         f"ALLOWED_ICON_PREFIX: {ALLOWED_ICON_PREFIX}",
     ]
 
+    yield doc_member
+    yield _ZipEntry("debug/_summary.txt", "\n".join(debug_lines).encode("utf-8"), compress=True)
+
+    started = time.perf_counter()
+    icon_data, icon_errors = finish_icon_fetch(pending)
+    METRIC_STAGE_SECONDS.observe_since(started, "kmz", "icon_wait")
     icon_list_lines, error_lines = [], []
-    mem = io.BytesIO()
-    with zipfile.ZipFile(mem, mode="w", compression=zipfile.ZIP_DEFLATED) as z:
-        z.writestr("doc.kml", kml_rewritten)
-        z.writestr("debug/_summary.txt", "\n".join(debug_lines))
 
-        for url, embedded_path in url_to_path.items():
-            icon_list_lines.append(f"{embedded_path} <= {url}")
-
-            if url == stale_href:
-                try:
-                    if os.path.exists(STALE_ICON_FILE):
-                        with open(STALE_ICON_FILE, "rb") as f:
-                            z.writestr(embedded_path, f.read())
-                    else:
-                        error_lines.append(f"{embedded_path} <= {url}\n  ERROR: stale.png missing at {STALE_ICON_FILE}")
-                except Exception as e:
-                    error_lines.append(f"{embedded_path} <= {url}\n  ERROR: {type(e).__name__}: {e}")
-                continue
+    for url, embedded_path in url_to_path.items():
+        icon_list_lines.append(f"{embedded_path} <= {url}")
 
+        if url == stale_href:
             try:
-                data, _ = fetch_icon_bytes(url)
-                z.writestr(embedded_path, data)
+                if os.path.exists(STALE_ICON_FILE):
+                    yield stale_icon_zip_entry()
+                else:
+                    error_lines.append(f"{embedded_path} <= {url}\n  ERROR: stale.png missing at {STALE_ICON_FILE}")
             except Exception as e:
                 error_lines.append(f"{embedded_path} <= {url}\n  ERROR: {type(e).__name__}: {e}")
+            continue
+
+        if url in icon_data:
+            yield cached_icon_zip_entry(embedded_path, icon_data[url])
+        else:
+            error_lines.append(f"{embedded_path} <= {url}\n  ERROR: {icon_errors.get(url, 'not downloaded')}")
 
-        z.writestr("debug/_icon_list.txt", "\n".join(icon_list_lines) if icon_list_lines else "No icon URLs found.")
-        if error_lines:
-            z.writestr("debug/_download_errors.txt", "\n\n".join(error_lines))
+    yield _ZipEntry("debug/_icon_list.txt",
+                    ("\n".join(icon_list_lines) if icon_list_lines else "No icon URLs found.").encode("utf-8"),
+                    compress=True)
+    if error_lines:
+        yield _ZipEntry("debug/_download_errors.txt", "\n\n".join(error_lines).encode("utf-8"), compress=True)
 
-    mem.seek(0)
-    return mem.read()
+def sort_name_key(name: str | None) -> str:
+    """Alphabetical sort key of a <name> text (None: no <name> element)."""
+    return (name or "").strip().lower()
 
 def sort_kml_document_alphabetically(kml_xml: str) -> str:
     """
@@ -532,13 +2394,16 @@ def sort_kml_document_alphabetically(kml_xml: str) -> str:
       - Standalone Placemarks alphabetically by <name>
       - Placemarks inside each Folder alphabetically
     """
-    root = ET.fromstring(kml_xml)
-    doc = root.find("kml:Document", KML_NS)
+    root, doc = parse_kml(kml_xml)
     if doc is None:
         return kml_xml
+    sort_document_alphabetically(doc)
+    return serialize_kml(root)
 
+def sort_document_alphabetically(doc: ET.Element) -> None:
+    """In-place variant of sort_kml_document_alphabetically on a parsed <Document>."""
     def name_key(el: ET.Element) -> str:
-        return (el.findtext("kml:name", default="", namespaces=KML_NS) or "").strip().lower()
+        return sort_name_key(el.findtext("kml:name", default="", namespaces=KML_NS))
 
     # Separate static (Document metadata) from sortable (Folders/Placemarks)
     children = list(doc)
@@ -584,7 +2449,1157 @@ def sort_kml_document_alphabetically(kml_xml: str) -> str:
     for el in sortable_elements:
         doc.append(el)
 
-    return ET.tostring(root, encoding="utf-8", xml_declaration=True).decode("utf-8")
+# -------------------------
+# Render pipeline: parse once, run every stage on the same tree, serialize once
+# -------------------------
+INATIVOS_FOLDER_NAME = "0_Inativos"
+
+def _stage_flag_stale(doc: ET.Element, ctx: dict) -> None:
+    flag_stale_placemarks(doc, ctx["base_url"], ctx["now"], ctx["gdh_by_id"], ctx["index"], ctx["stale_threshold"])
+
+def _stage_group_routes(doc: ET.Element, ctx: dict) -> None:
+    group_route_placemarks(doc, ctx["index"])
+
+def _stage_move_stale(doc: ET.Element, ctx: dict) -> None:
+    move_stale_items_to_folder(doc, ctx["inativos_name"], ctx["index"])
+
+def _stage_sort(doc: ET.Element, ctx: dict) -> None:
+    sort_document_alphabetically(doc)
+
+def _stage_container_ids(doc: ET.Element, ctx: dict) -> None:
+    assign_container_ids(doc, ctx["inativos_name"])
+
+KML_STAGES = {
+    "flag_stale": _stage_flag_stale,
+    "group_routes": _stage_group_routes,
+    "move_stale": _stage_move_stale,
+    "sort": _stage_sort,
+    "container_ids": _stage_container_ids,
+}
+
+# Stage lists per output flavour (the simple KMZ never had the inativos folder)
+PIPELINE_FULL = ("flag_stale", "group_routes", "move_stale", "sort")
+PIPELINE_SIMPLE = ("flag_stale", "group_routes", "sort")
+PIPELINE_LIVE = PIPELINE_FULL + ("container_ids",)
+
+def run_kml_pipeline(kml_xml: str, base_url: str, stages: tuple[str, ...] = PIPELINE_FULL,
+                     inativos_name: str = INATIVOS_FOLDER_NAME, gdh_by_id: dict[str, float] | None = None,
+                     stale_threshold: float | None = None) -> str:
+    """
+    Parses kml_xml once, applies `stages` (names from KML_STAGES) in order to the
+    same tree and serializes once. Equivalent to chaining the *_in_kml / string
+    wrappers, minus the intermediate round trips.
+    """
+    root = apply_kml_pipeline(kml_xml, base_url, stages, inativos_name, gdh_by_id, stale_threshold=stale_threshold)
+    if root is None:
+        return kml_xml
+    started = time.perf_counter()
+    out = serialize_kml(root)
+    METRIC_STAGE_SECONDS.observe_since(started, "tree", "serialize")
+    return out
+
+def apply_kml_pipeline(kml_xml: str, base_url: str, stages: tuple[str, ...] = PIPELINE_FULL,
+                       inativos_name: str = INATIVOS_FOLDER_NAME, gdh_by_id: dict[str, float] | None = None,
+                       now: float | None = None, stale_threshold: float | None = None) -> ET.Element | None:
+    """Parses kml_xml and applies `stages`; returns the root, or None without a <Document>."""
+    started = time.perf_counter()
+    root, doc = parse_kml(kml_xml)
+    METRIC_STAGE_SECONDS.observe_since(started, "tree", "parse")
+    if doc is None:
+        return None
+    # The stages only move elements around, so one RenderIndex serves them all
+    ctx = {"base_url": base_url, "now": time.time() if now is None else now,
+           "inativos_name": inativos_name, "gdh_by_id": gdh_by_id, "index": RenderIndex(doc),
+           "stale_threshold": stale_threshold}
+    for name in stages:
+        started = time.perf_counter()
+        KML_STAGES[name](doc, ctx)
+        METRIC_STAGE_SECONDS.observe_since(started, "tree", name)
+    return root
+
+# -------------------------
+# Record renderer: the same stages over PlacemarkRecords, no tree parse/serialize
+# -------------------------
+class _PmNode:
+    __slots__ = ("rec", "xml", "name", "key", "marked")
+
+    def __init__(self, rec: PlacemarkRecord, stale_href: str, now: float, threshold: float | None = None):
+        self.rec = rec
+        if rec.is_stale(now, threshold):
+            self.xml, self.marked = rec.stale_rendition(stale_href)
+            self.name, self.key = rec.stale_name(), rec.stale_sort_key
+        else:
+            self.xml, self.marked, self.name, self.key = rec.xml, rec.marked_stale, rec.name, rec.sort_key
+
+class _FolderNode:
+    __slots__ = ("children", "key")  # _PmNode, _FolderNode or str (a <name> element's text)
+
+    def __init__(self, children: list):
+        self.children = children
+        first = children[0] if children else None  # folders are built name first
+        self.key = sort_name_key(first if isinstance(first, str) else self.name())
+
+    def name(self) -> str:
+        return next((c for c in self.children if isinstance(c, str)), "")
+
+    def contains_stale(self) -> bool:
+        return any(c.marked if isinstance(c, _PmNode) else isinstance(c, _FolderNode) and c.contains_stale()
+                   for c in self.children)
+
+_node_sort_key = attrgetter("key")
+
+def _group_route_nodes(nodes: list[_PmNode]) -> list:
+    # Mirrors group_route_placemarks: id-less placemarks are dropped, "<id>_route" joins
+    # its base, and a route listed before its base is taken back out of its place
+    id_to_node = {n.rec.id: n for n in nodes if n.rec.id}
+    used, kept_at, out = set(), {}, []  # kept_at: route id -> its position when listed on its own
+    taken = False
+    for n in nodes:
+        pm_id = n.rec.id
+        if not pm_id or pm_id in used:
+            continue
+        used.add(pm_id)
+        route_id = f"{pm_id}_route"
+        route = id_to_node.get(route_id)
+        if route is None or (route_id in used and route_id not in kept_at):
+            if n.rec.route_of is not None:
+                kept_at[pm_id] = len(out)
+            out.append(n)
+            continue
+        if route_id in kept_at:
+            out[kept_at.pop(route_id)] = None
+            taken = True
+        out.append(_FolderNode([(n.name or "").strip() or pm_id, n, route]))
+        used.add(route_id)
+    return [n for n in out if n is not None] if taken else out
+
+def _move_stale_nodes(nodes: list, folder_name: str) -> list:
+    # Mirrors move_stale_items_to_folder
+    inativos = next((n for n in nodes if isinstance(n, _FolderNode)
+                     and n.name().strip().lower() == folder_name.lower()), None)
+    existed = inativos is not None
+    if inativos is None:
+        inativos = _FolderNode([folder_name])
+    out, moved_any = [], False
+    for n in nodes:
+        if n is inativos:
+            continue
+        if n.marked if isinstance(n, _PmNode) else n.contains_stale():
+            inativos.children.append(n)
+            moved_any = True
+        else:
+            out.append(n)
+    if moved_any or existed:
+        out.append(inativos)
+    return out
+
+def _sort_nodes(nodes: list) -> list:
+    # Mirrors sort_document_alphabetically, including the restored-name duplicate.
+    # Records arrive in sort order, so these stable sorts mostly just confirm it
+    for folder in [n for n in nodes if isinstance(n, _FolderNode)]:
+        pms = sorted((c for c in folder.children if isinstance(c, _PmNode)), key=_node_sort_key)
+        others = [c for c in folder.children if not isinstance(c, _PmNode)]
+        folder.children = [folder.name(), *others, *pms]
+    return sorted(nodes, key=_node_sort_key)
+
+def _iter_nodes(nodes: list) -> Iterator[bytes]:
+    for n in nodes:
+        if isinstance(n, _PmNode):
+            yield n.xml
+        elif isinstance(n, _FolderNode):
+            yield b"<Folder>"
+            yield from _iter_nodes(n.children)
+            yield b"</Folder>"
+        elif n:
+            yield f"<name>{html.escape(n, quote=False)}</name>".encode("utf-8")
+        else:
+            yield b"<name />"
+
+RECORD_PIPELINES = (PIPELINE_FULL, PIPELINE_SIMPLE)
+
+def iter_render_records(records: list[PlacemarkRecord], base_url: str, stages: tuple[str, ...] = PIPELINE_FULL,
+                        inativos_name: str = INATIVOS_FOLDER_NAME, now: float | None = None,
+                        stale_threshold: float | None = None) -> Iterator[bytes]:
+    """
+    Renders merged records through `stages` (one of RECORD_PIPELINES) straight
+    to bytes. Same document as run_kml_pipeline on merged_kml_from_records
+    (namespaces other than KML stay declared on the placemarks that use them),
+    but unchanged placemarks are copied as stored bytes instead of being
+    parsed, rebuilt and re-serialized. All stages run before this returns;
+    the iterator only concatenates.
+    """
+    if stages not in RECORD_PIPELINES:
+        raise ValueError(f"stages {stages!r} have no record renderer")
+    now = time.time() if now is None else now
+    stale_href = f"{base_url}{STALE_ICON_PATH}"
+    started = time.perf_counter()
+    nodes = [_PmNode(rec, stale_href, now, stale_threshold) for rec in records]
+    started = _observe_record_stage(started, "flag_stale")
+    nodes = _group_route_nodes(nodes)
+    started = _observe_record_stage(started, "group_routes")
+    if "move_stale" in stages:
+        nodes = _move_stale_nodes(nodes, inativos_name)
+        started = _observe_record_stage(started, "move_stale")
+    nodes = _sort_nodes(nodes)
+    _observe_record_stage(started, "sort")
+    return _iter_document(nodes)
+
+def _observe_record_stage(started: float, stage: str) -> float:
+    now = time.perf_counter()
+    METRIC_STAGE_SECONDS.observe(now - started, "records", stage)
+    return now
+
+def _iter_document(nodes: list) -> Iterator[bytes]:
+    yield _MERGED_HEAD.encode("utf-8")
+    yield from _iter_nodes(nodes)
+    yield _MERGED_TAIL.encode("utf-8")
+
+def render_records(records: list[PlacemarkRecord], base_url: str, stages: tuple[str, ...] = PIPELINE_FULL,
+                   inativos_name: str = INATIVOS_FOLDER_NAME, now: float | None = None,
+                   stale_threshold: float | None = None) -> bytes:
+    return b"".join(iter_render_records(records, base_url, stages, inativos_name, now, stale_threshold))
+
+# -------------------------
+# Streaming serialization
+# -------------------------
+
+def iter_serialize_kml(root: ET.Element) -> Iterator[bytes]:
+    """
+    Serializes the tree one <Document> child at a time, so the full document
+    never exists as a single string. The default KML namespace is declared once
+    on <kml>; other namespaces stay declared on the children that use them.
+    """
+    doc = root.find("kml:Document", KML_NS)
+    if doc is None or len(root) != 1:
+        yield serialize_kml(root).encode("utf-8")
+        return
+
+    marker = "\ue000"
+    shell = ET.Element(root.tag, root.attrib)
+    shell.text = root.text
+    shell_doc = ET.SubElement(shell, doc.tag, doc.attrib)
+    shell_doc.text = (doc.text or "") + marker
+    shell_doc.tail = doc.tail
+    head, tail = ET.tostring(shell, encoding="unicode").split(marker)
+    yield (_XML_DECLARATION + head).encode("utf-8")
+
+    for child in doc:
+        yield serialize_fragment(child).encode("utf-8")
+
+    yield tail.encode("utf-8")
+
+def rechunk(chunks: Iterable[bytes], size: int | None = None) -> Iterator[bytes]:
+    """Coalesces small pieces into ~size byte chunks for the response body."""
+    size = STREAM_CHUNK_BYTES if size is None else size
+    buf, n = [], 0
+    for c in chunks:
+        if not c:
+            continue
+        buf.append(c)
+        n += len(c)
+        if n >= size:
+            yield b"".join(buf)
+            buf, n = [], 0
+    if buf:
+        yield b"".join(buf)
+
+# -------------------------
+# Render cache: final bytes per (merge generation, variant, base_url, stale bucket)
+# -------------------------
+def build_kmz_simple(kml: str | bytes) -> bytes:
+    started = time.perf_counter()
+    body = kml.encode("utf-8") if isinstance(kml, str) else kml
+    kmz = assemble_zip([_ZipEntry("doc.kml", body, compress=True)])
+    METRIC_STAGE_SECONDS.observe_since(started, "kmz", "build_simple")
+    return kmz
+
+# Every renderer takes the merged records when the merge produced them and then
+# skips the parse -> stages -> serialize round trip; without them it runs the
+# ElementTree pipeline on `kml`. stale_threshold is the feed's (None: the default).
+def _render_kml(kml: str, base_url: str, gdh_by_id: dict[str, float] | None = None,
+                records: list[PlacemarkRecord] | None = None, stale_threshold: float | None = None) -> bytes:
+    if records is not None:
+        return render_records(records, base_url, PIPELINE_FULL, stale_threshold=stale_threshold)
+    return run_kml_pipeline(kml, base_url, PIPELINE_FULL, gdh_by_id=gdh_by_id,
+                            stale_threshold=stale_threshold).encode("utf-8")
+
+def _render_kmz_simple(kml: str, base_url: str, gdh_by_id: dict[str, float] | None = None,
+                       records: list[PlacemarkRecord] | None = None, stale_threshold: float | None = None) -> bytes:
+    if records is not None:
+        return build_kmz_simple(render_records(records, base_url, PIPELINE_SIMPLE, stale_threshold=stale_threshold))
+    return build_kmz_simple(run_kml_pipeline(kml, base_url, PIPELINE_SIMPLE, gdh_by_id=gdh_by_id,
+                                             stale_threshold=stale_threshold))
+
+def _render_kmz_atak(kml: str, base_url: str, gdh_by_id: dict[str, float] | None = None,
+                     records: list[PlacemarkRecord] | None = None, stale_threshold: float | None = None) -> bytes:
+    if records is not None:
+        rendered = render_records(records, base_url, PIPELINE_FULL, stale_threshold=stale_threshold)
+        return build_kmz_with_embedded_icons(rendered.decode("utf-8"), base_url)
+    return build_kmz_with_embedded_icons(run_kml_pipeline(kml, base_url, PIPELINE_FULL, gdh_by_id=gdh_by_id,
+                                                          stale_threshold=stale_threshold), base_url)
+
+# Streaming renderers do all parsing/processing eagerly (so errors surface before
+# the response starts) and return an iterator that only serializes/compresses.
+def _iter_render_kml(kml: str, base_url: str, gdh_by_id: dict[str, float] | None = None,
+                     records: list[PlacemarkRecord] | None = None,
+                     stale_threshold: float | None = None) -> Iterator[bytes]:
+    if records is not None:
+        return iter_render_records(records, base_url, PIPELINE_FULL, stale_threshold=stale_threshold)
+    root = apply_kml_pipeline(kml, base_url, PIPELINE_FULL, gdh_by_id=gdh_by_id, stale_threshold=stale_threshold)
+    return iter([kml.encode("utf-8")]) if root is None else iter_serialize_kml(root)
+
+def _iter_render_kml_simple(kml: str, base_url: str, gdh_by_id: dict[str, float] | None = None,
+                            records: list[PlacemarkRecord] | None = None,
+                            stale_threshold: float | None = None) -> Iterator[bytes]:
+    if records is not None:
+        return iter_render_records(records, base_url, PIPELINE_SIMPLE, stale_threshold=stale_threshold)
+    root = apply_kml_pipeline(kml, base_url, PIPELINE_SIMPLE, gdh_by_id=gdh_by_id, stale_threshold=stale_threshold)
+    return iter([kml.encode("utf-8")]) if root is None else iter_serialize_kml(root)
+
+def _iter_render_kmz_simple(kml: str, base_url: str, gdh_by_id: dict[str, float] | None = None,
+                            records: list[PlacemarkRecord] | None = None,
+                            stale_threshold: float | None = None) -> Iterator[bytes]:
+    return iter_zip([("doc.kml", _iter_render_kml_simple(kml, base_url, gdh_by_id, records, stale_threshold))])
+
+def _iter_render_kmz_atak(kml: str, base_url: str, gdh_by_id: dict[str, float] | None = None,
+                          records: list[PlacemarkRecord] | None = None,
+                          stale_threshold: float | None = None) -> Iterator[bytes]:
+    if records is not None:
+        # The href rewrite is textual, so the record output is rewritten whole
+        rendered = render_records(records, base_url, PIPELINE_FULL, stale_threshold=stale_threshold)
+        return iter_kmz_with_embedded_icons_text(rendered.decode("utf-8"), base_url)
+    root = apply_kml_pipeline(kml, base_url, PIPELINE_FULL, gdh_by_id=gdh_by_id, stale_threshold=stale_threshold)
+    if root is None:
+        return iter([_render_kmz_atak(kml, base_url, gdh_by_id, stale_threshold=stale_threshold)])
+    return iter_kmz_with_embedded_icons(root, base_url)
+
+# /mapmil and /mapmil.kml share the "kml" body; only their headers differ
+RENDER_VARIANTS = {
+    "kml": _render_kml,
+    "kmz": _render_kmz_simple,
+    "atak_kmz": _render_kmz_atak,
+}
+STREAM_RENDER_VARIANTS = {
+    "kml": _iter_render_kml,
+    "kmz": _iter_render_kmz_simple,
+    "atak_kmz": _iter_render_kmz_atak,
+}
+
+class RenderedBody:
+    """
+    A finished response body plus its strong ETag (content hash, so identical
+    renders in later stale buckets or generations revalidate with 304) and the
+    compressed copies built on first request for each content coding.
+    last_used (monotonic) orders evictions under MEMORY_BUDGET_BYTES.
+    """
+    __slots__ = ("body", "etag", "_encoded", "last_used")
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self._encoded = {}
+        self.last_used = time.monotonic()
+
+    def size(self) -> int:
+        return len(self.body) + sum(len(data) for data in self._encoded.values())
+
+    def is_encoded(self, coding: str | None) -> bool:
+        """True if encoded(coding) is already available without compressing."""
+        return coding is None or coding in self._encoded
+
+    def etag_for(self, coding: str | None) -> str:
+        return self.etag if coding is None else f"{self.etag}-{coding}"
+
+    def encoded(self, coding: str | None) -> bytes:
+        if coding is None:
+            return self.body
+        data = self._encoded.get(coding)
+        if data is None:
+            if coding == "gzip":
+                data = gzip.compress(self.body, COMPRESS_LEVEL, mtime=0)
+            else:
+                data = zlib.compress(self.body, COMPRESS_LEVEL)
+            self._encoded[coding] = data
+        return data
+
+def _render_key(feed: Feed, key: tuple) -> str:
+    gen, variant, base_url, bucket = key
+    url_hash = hashlib.blake2b(base_url.encode("utf-8"), digest_size=8).hexdigest()
+    return _shared_key("feed", feed.name, "render", str(gen), variant, url_hash, str(bucket))
+
+def _store_rendered(feed: Feed, key: tuple, body: bytes, publish: bool = True) -> RenderedBody:
+    """Keeps body in the feed's render cache and, with a shared backend, for the other workers too."""
+    backend = get_cache_backend()
+    if publish and backend.shared:
+        backend.set(_render_key(feed, key), body, ttl=2 * STALE_BUCKET_SECONDS)
+    entry = RenderedBody(body)
+    with _render_lock:
+        render_cache = feed.render_cache
+        # Entries from older generations/buckets can never be hit again
+        for k in [k for k in render_cache if k[0] != key[0] or k[3] != key[3]]:
+            del render_cache[k]
+        while len(render_cache) >= RENDER_CACHE_MAX_ENTRIES:
+            del render_cache[next(iter(render_cache))]
+        if key[0] == feed.cache["gen"]:
+            render_cache[key] = entry
+            _enforce_memory_budget(keep=entry)
+    return entry
+
+def _release_inflight(feed: Feed, key: tuple, key_lock: "threading.Lock | None") -> None:
+    if key_lock is None:
+        return  # rendered without the lock after RENDER_WAIT_SECONDS
+    with _render_lock:
+        feed.render_inflight.pop(key, None)
+    key_lock.release()
+
+def _cached_render(feed: Feed, key: tuple) -> RenderedBody | None:
+    # Caller holds _render_lock
+    body = feed.render_cache.get(key)
+    if body is not None:
+        body.last_used = time.monotonic()
+        METRIC_RENDER_CACHE.inc(feed.name, key[1], "hit")
+    return body
+
+def peek_rendered(variant: str, base_url: str, feed: Feed | None = None) -> RenderedBody | None:
+    """The body get_rendered_entry would return from the render cache right now; never refreshes or renders."""
+    feed = feed or get_feed()
+    with _render_lock:
+        if feed.cache["kml"] is None:
+            return None
+        return _cached_render(feed, (feed.cache["gen"], variant, base_url, int(time.time() // STALE_BUCKET_SECONDS)))
+
+def get_rendered_entry(variant: str, base_url: str, stream: bool | None = None,
+                       feed: Feed | None = None) -> "RenderedBody | StreamedRender":
+    """
+    Returns the fully post-processed body of `feed` (default feed if None) for
+    `variant`, rendering it at most once per (merge generation, base_url, stale
+    bucket). Concurrent misses on the same key wait (up to RENDER_WAIT_SECONDS)
+    for the first renderer instead of repeating the work; with a shared CACHE_BACKEND a body another
+    worker already rendered is taken from there.
+
+    With stream (default STREAM_RESPONSES) a miss returns a StreamedRender instead
+    of a RenderedBody; the chunks are copied into the render cache only while the body
+    stays under STREAM_CACHE_MAX_BYTES. With RENDER_PROCESSES a miss is rendered
+    whole in a worker process (see render_in_process) and stream does not apply.
+    """
+    stream = STREAM_RESPONSES if stream is None else stream
+    feed = feed or get_feed()
+    kml, gen = get_merged_snapshot(feed)
+    key = (gen, variant, base_url, int(time.time() // STALE_BUCKET_SECONDS))
+
+    with _render_lock:
+        body = _cached_render(feed, key)
+        if body is not None:
+            return body
+        key_lock = feed.render_inflight.setdefault(key, threading.Lock())
+
+    if not key_lock.acquire(timeout=RENDER_WAIT_SECONDS):
+        key_lock = None  # the other render is stuck: don't queue behind it
+    try:
+        with _render_lock:
+            body = feed.render_cache.get(key)
+        result = "hit"  # rendered by the thread we waited for
+        if body is None and get_cache_backend().shared:
+            shared = get_cache_backend().get(_render_key(feed, key))
+            if shared is not None:
+                body = _store_rendered(feed, key, shared, publish=False)
+                result = "shared"
+        if body is not None:
+            METRIC_RENDER_CACHE.inc(feed.name, variant, result)
+            _release_inflight(feed, key, key_lock)
+            return body
+        METRIC_RENDER_CACHE.inc(feed.name, variant, "miss")
+        started = time.perf_counter()
+        if RENDER_PROCESSES > 0:
+            body = _store_rendered(feed, key, render_in_process(feed, gen, kml, variant, base_url))
+            METRIC_RENDER_SECONDS.observe_since(started, feed.name, variant)
+            _release_inflight(feed, key, key_lock)
+            return body
+        args = (kml, base_url, merged_gdh_by_id(gen, feed), merged_records(gen, feed), feed.stale_threshold)
+        if stream:
+            # Only the eager part: serialization and compression run as the response is sent
+            chunks = STREAM_RENDER_VARIANTS[variant](*args)
+            METRIC_RENDER_SECONDS.observe_since(started, feed.name, variant)
+            return StreamedRender(feed, key, key_lock, chunks)
+        body = _store_rendered(feed, key, RENDER_VARIANTS[variant](*args))
+        METRIC_RENDER_SECONDS.observe_since(started, feed.name, variant)
+    except BaseException:
+        _release_inflight(feed, key, key_lock)
+        raise
+    _release_inflight(feed, key, key_lock)
+    return body
+
+class StreamedRender:
+    """
+    Response body of a streamed render-cache miss. It holds the key's in-flight
+    lock until the last chunk is produced (the body is then copied into the
+    render cache) or until close(), which the WSGI server calls however the
+    response ends: client gone mid-body, or never iterated at all (HEAD).
+    """
+
+    def __init__(self, feed: Feed, key: tuple, key_lock: "threading.Lock | None", chunks: Iterator[bytes]):
+        self.feed, self.key, self.key_lock, self.chunks = feed, key, key_lock, chunks
+        self._released = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        kept, size = [], 0
+        for chunk in rechunk(self.chunks):
+            if kept is not None:
+                size += len(chunk)
+                if size <= STREAM_CACHE_MAX_BYTES:
+                    kept.append(chunk)
+                else:
+                    kept = None
+            yield chunk
+        try:
+            if kept is not None and not self._released:
+                _store_rendered(self.feed, self.key, b"".join(kept))
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        if not self._released:
+            self._released = True
+            _release_inflight(self.feed, self.key, self.key_lock)
+
+    def close(self) -> None:
+        try:
+            if hasattr(self.chunks, "close"):
+                self.chunks.close()
+        finally:
+            self._release()
+
+# -------------------------
+# Render worker processes: cache misses rendered off this process's GIL
+# -------------------------
+class SharedDocument:
+    """
+    One merged generation's document in a shared memory block, so render
+    workers read it in place instead of receiving it through the pool's pipe.
+    users counts renders in flight; a retired block (replaced by a newer
+    generation) is unlinked when the last of them finishes.
+    """
+    __slots__ = ("gen", "size", "shm", "users", "retired")
+
+    def __init__(self, gen: int, data: bytes):
+        self.gen, self.size = gen, len(data)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        self.shm.buf[:len(data)] = data
+        self.users, self.retired = 0, False
+
+    def close(self) -> None:
+        self.shm.close()
+        self.shm.unlink()
+
+def _worker_config() -> dict:
+    # Spawned workers import this module afresh: hand them the settings as changed at runtime
+    return {name: value for name, value in globals().items()
+            if name.isupper() and not name.startswith("_")
+            and isinstance(value, (str, int, float, bool, tuple, type(None)))}
+
+def _init_render_worker(config: dict) -> None:
+    globals().update(config)
+
+def render_pool() -> ProcessPoolExecutor:
+    """The RENDER_PROCESSES worker pool, started on first use (spawned, not forked: this process runs threads)."""
+    pool = _render_processes["pool"]
+    if pool is None:
+        with _render_processes["lock"]:
+            pool = _render_processes["pool"]
+            if pool is None:
+                pool = _render_processes["pool"] = ProcessPoolExecutor(
+                    RENDER_PROCESSES, mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_render_worker, initargs=(_worker_config(),))
+    return pool
+
+def stop_render_processes() -> None:
+    """Shuts the render worker pool down and frees the feeds' shared documents."""
+    with _render_processes["lock"]:
+        pool, _render_processes["pool"] = _render_processes["pool"], None
+    if pool is not None:
+        pool.shutdown(cancel_futures=True)
+    with _render_lock:
+        for feed in FEEDS.values():
+            doc, feed.render_document = feed.render_document, None
+            if doc is not None:
+                _retire_document(doc)
+
+def _retire_document(doc: SharedDocument) -> None:
+    # Caller holds _render_lock
+    doc.retired = True
+    if doc.users == 0:
+        doc.close()
+
+def _checkout_document(feed: Feed, gen: int, kml: str) -> SharedDocument:
+    """The feed's SharedDocument for `gen`, created on the first render of that generation."""
+    with _render_lock:
+        doc = feed.render_document
+        if doc is not None and doc.gen == gen:
+            doc.users += 1
+            return doc
+    data = kml.encode("utf-8")
+    with _render_lock:
+        doc = feed.render_document
+        if doc is None or doc.gen != gen:
+            new = SharedDocument(gen, data)
+            if doc is None or doc.gen < gen:
+                if doc is not None:
+                    _retire_document(doc)
+                feed.render_document = new
+            else:
+                new.retired = True  # a generation already replaced: used by this render only
+            doc = new
+        doc.users += 1
+        return doc
+
+def _checkin_document(doc: SharedDocument) -> None:
+    with _render_lock:
+        doc.users -= 1
+        if doc.retired and doc.users == 0:
+            doc.close()
+
+def render_in_process(feed: Feed, gen: int, kml: str, variant: str, base_url: str) -> bytes:
+    """
+    RENDER_VARIANTS[variant] of generation `gen`, run in a render worker. Only
+    the shared block's name, recent icon failures and the finished body cross
+    the process boundary; each worker builds the generation's records once and
+    reuses them.
+    """
+    doc = _checkout_document(feed, gen, kml)
+    try:
+        body, failures = render_pool().submit(_render_in_worker, feed.name, gen, doc.shm.name, doc.size,
+                                              variant, base_url, feed.stale_threshold,
+                                              recent_icon_failures()).result()
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed): start a fresh pool on the next render
+        with _render_processes["lock"]:
+            _render_processes["pool"] = None
+        raise
+    finally:
+        _checkin_document(doc)
+    for url, (ts, error) in failures.items():
+        record_icon_failure(url, error, ts)
+    return body
+
+def _render_in_worker(feed_name: str, gen: int, shm_name: str, size: int, variant: str, base_url: str,
+                      stale_threshold: float,
+                      icon_failures: dict[str, tuple[float, str]]) -> tuple[bytes, dict[str, tuple[float, str]]]:
+    # Runs in a render worker process; stage metrics observed here stay in the worker.
+    # The parent's icon failures replace the worker's, and failures recorded
+    # during this render go back with the body, so both honour the same backoff.
+    _icon_failures.clear()
+    _icon_failures.update(icon_failures)
+    started = time.time()
+    cached = _worker_documents.get(feed_name)
+    if cached is None or cached[0] != gen:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            kml = bytes(shm.buf[:size]).decode("utf-8")
+        finally:
+            shm.close()
+        cached = _worker_documents[feed_name] = (gen, kml, records_from_kml(kml))
+    _, kml, records = cached
+    body = RENDER_VARIANTS[variant](kml, base_url, None, records, stale_threshold)
+    return body, recent_icon_failures(since=started)
+
+# -------------------------
+# Live updates: NetworkLinkControl deltas against a client-held token
+# -------------------------
+_LIVE_CONTAINERS = (_PLACEMARK_TAG, _FOLDER_TAG)
+
+def assign_container_ids(doc: ET.Element, inativos_name: str = INATIVOS_FOLDER_NAME) -> None:
+    """
+    Gives the Document and every Folder a stable id so <Update> can target them:
+    the inativos folder gets LIVE_INATIVOS_FOLDER_ID, route folders
+    "<base placemark id>_folder". Runs last, since grouping/sorting rebuild folders.
+    """
+    doc.set("id", LIVE_DOCUMENT_ID)
+    for folder in doc.iter(_FOLDER_TAG):
+        if folder.get("id"):
+            continue
+        nm = folder.findtext("kml:name", default="", namespaces=KML_NS).strip()
+        if nm.lower() == inativos_name.lower():
+            folder.set("id", LIVE_INATIVOS_FOLDER_ID)
+            continue
+        first = folder.find("kml:Placemark", KML_NS)
+        if first is not None and first.get("id"):
+            folder.set("id", f"{first.get('id')}_folder")
+
+def live_records(doc: ET.Element) -> tuple[dict[str, tuple], dict[str, ET.Element]]:
+    """
+    Walks the Folders/Placemarks under doc and returns (records, elements), both
+    keyed by id. A record is (parent id, tag, leaves) where leaves fingerprints
+    each direct non-container child as (tag, hash, has_no_subelements); that is
+    all live_update_ops needs to diff two snapshots.
+    """
+    records, elements = {}, {}
+
+    def walk(parent: ET.Element, parent_id: str) -> None:
+        for el in parent:
+            if el.tag not in _LIVE_CONTAINERS:
+                continue
+            item_id = el.get("id")
+            if not item_id:
+                continue  # not addressable by <Update>; stays as loaded
+            item_id = sys.intern(item_id)  # ids repeat in every kept snapshot
+            leaves = tuple(
+                (c.tag, placemark_fingerprint(c), len(c) == 0) for c in el if c.tag not in _LIVE_CONTAINERS
+            )
+            records[item_id] = (parent_id, el.tag, leaves)
+            elements[item_id] = el
+            if el.tag == _FOLDER_TAG:
+                walk(el, item_id)
+
+    walk(doc, doc.get("id") or LIVE_DOCUMENT_ID)
+    return records, elements
+
+def _changed_leaves(old: tuple, new: tuple) -> list[int] | None:
+    # Indexes of changed simple children, or None when only a replace can express it
+    if len(old) != len(new):
+        return None
+    changed = []
+    for i, (o, n) in enumerate(zip(old, new)):
+        if o == n:
+            continue
+        if o[0] != n[0] or not (o[2] and n[2]):
+            return None
+        changed.append(i)
+    return changed
+
+def _under(item_id: str, records: dict[str, tuple], ids: set[str]) -> bool:
+    # True if any ancestor of item_id (per records) is in ids
+    parent = records[item_id][0]
+    while parent in records:
+        if parent in ids:
+            return True
+        parent = records[parent][0]
+    return False
+
+def live_update_ops(old: dict[str, tuple], new: dict[str, tuple],
+                    forget: Iterable[str] = ()) -> tuple[list[str], list[str], list[tuple[str, list[int]]]]:
+    """
+    Diffs two live_records snapshots into (deletes, creates, changes):
+    deletes/creates are ids of subtree roots, changes are (id, leaf indexes)
+    for items that kept their parent and differ only in simple children
+    (name, description, styleUrl, ...). Anything else (moved, regrouped, new
+    geometry or style) is replaced: deleted, then re-created in its new parent.
+    Every created id is deleted first, so applying the same ops twice is harmless.
+    `forget` are extra ids to delete when the client's snapshot is unknown.
+    """
+    replaced, changes = set(), []
+    for item_id, rec in new.items():
+        prev = old.get(item_id)
+        if prev is None or prev[:2] != rec[:2]:
+            replaced.add(item_id)
+        elif prev[2] != rec[2]:
+            leaves = _changed_leaves(prev[2], rec[2])
+            if leaves is None:
+                replaced.add(item_id)
+            else:
+                changes.append((item_id, leaves))
+
+    removed = (old.keys() - new.keys()) | (replaced & old.keys())
+    creates = [i for i in new if i in replaced and not _under(i, new, replaced)]
+    deletes = [i for i in old if i in removed and not _under(i, old, removed)]
+    seen = set(deletes)
+    for item_id in [*creates, *forget]:
+        if item_id not in seen:
+            deletes.append(item_id)
+            seen.add(item_id)
+    changes = [(i, leaves) for i, leaves in changes if not _under(i, new, replaced)]
+    return deletes, creates, changes
+
+def _live_base_href(base_url: str) -> str:
+    return f"{base_url}/mapmil_live_base.kml"
+
+def build_live_update(base_url: str, token: str, records: dict[str, tuple], elements: dict[str, ET.Element],
+                      ops: tuple[list[str], list[str], list[tuple[str, list[int]]]],
+                      old: dict[str, tuple]) -> bytes:
+    """Serializes ops as a <NetworkLinkControl> whose cookie carries the new token."""
+    deletes, creates, changes = ops
+    root = ET.Element(f"{{{KML_NS_URI}}}kml")
+    nlc = _sub(root, "NetworkLinkControl")
+    _sub(nlc, "minRefreshPeriod").text = str(LIVE_REFRESH_SECONDS)
+    _sub(nlc, "cookie").text = f"since={token}"
+    if deletes or creates or changes:
+        update = _sub(nlc, "Update")
+        _sub(update, "targetHref").text = _live_base_href(base_url)
+        if deletes:
+            delete = _sub(update, "Delete")
+            for item_id in deletes:
+                rec = old.get(item_id) or records.get(item_id)
+                tag = rec[1] if rec else _PLACEMARK_TAG
+                ET.SubElement(delete, tag, {"targetId": item_id})
+        if creates:
+            create = _sub(update, "Create")
+            by_parent = {}
+            for item_id in creates:
+                by_parent.setdefault(records[item_id][0], []).append(elements[item_id])
+            for parent_id, items in by_parent.items():
+                tag = records[parent_id][1] if parent_id in records else f"{{{KML_NS_URI}}}Document"
+                target = ET.SubElement(create, tag, {"targetId": parent_id})
+                target.extend(items)
+        if changes:
+            change = _sub(update, "Change")
+            for item_id, leaves in changes:
+                el = elements[item_id]
+                target = ET.SubElement(change, el.tag, {"targetId": item_id})
+                children = [c for c in el if c.tag not in _LIVE_CONTAINERS]
+                target.extend(children[i] for i in leaves)
+    return serialize_kml(root).encode("utf-8")
+
+# Rough sizes for LiveUsage: an ElementTree holds ~8 bytes per byte of its
+# serialized KML; a record with its leaf fingerprints is ~1 KB.
+_LIVE_TREE_BYTES_PER_KML_BYTE = 8
+_LIVE_RECORD_BYTES = 1024
+
+class LiveUsage:
+    """
+    Estimated memory of one base URL's live-update state, counted in
+    MEMORY_BUDGET_BYTES: `current` covers the newest snapshot's tree and
+    base_kml, `snapshots` each kept token's records not shared with the
+    snapshot before it, `updates` the cached update bodies. last_used
+    (monotonic) orders evictions alongside RenderedBody.
+    """
+    __slots__ = ("current", "snapshots", "updates", "last_used")
+
+    def __init__(self):
+        self.current, self.snapshots, self.updates = 0, {}, 0
+        self.last_used = time.monotonic()
+
+    def size(self) -> int:
+        return self.current + sum(self.snapshots.values()) + self.updates
+
+def live_snapshot(base_url: str, feed: Feed | None = None) -> tuple[str, dict[str, tuple], dict[str, ET.Element], bytes]:
+    """
+    Returns (token, records, elements, base_kml) of `feed` (default feed if None)
+    for the current merge generation and stale bucket, building it at most once
+    per token. Stale flags are evaluated at the start of the bucket so the base
+    document and its records always agree. Each snapshot's records are kept in
+    feed.live_history so later polls can be answered relative to it; records
+    unchanged since the previous snapshot share its tuples. At most
+    LIVE_MAX_BASE_URLS base URLs keep live state.
+    """
+    feed = feed or get_feed()
+    kml, gen = get_merged_snapshot(feed)
+    gdh_by_id = merged_gdh_by_id(gen, feed)  # takes _render_lock, so not under live_lock
+    bucket = int(time.time() // STALE_BUCKET_SECONDS)
+    with feed.live_lock:
+        cur = feed.live_current.get(base_url)
+        if cur is not None and cur[0] >= (gen, bucket):
+            feed.live_current[base_url] = feed.live_current.pop(base_url)  # most recently used last
+            feed.live_usage[base_url].last_used = time.monotonic()
+            return cur[1:]
+        root = apply_kml_pipeline(kml, base_url, PIPELINE_LIVE, gdh_by_id=gdh_by_id,
+                                  now=bucket * STALE_BUCKET_SECONDS, stale_threshold=feed.stale_threshold)
+        if root is None:
+            raise ValueError("Merged KML has no <Document>")
+        records, elements = live_records(root.find("kml:Document", KML_NS))
+        fresh = len(records)
+        if cur is not None:
+            records, fresh = share_live_records(records, cur[2])
+        token = f"{gen}.{bucket}"
+        base_kml = serialize_kml(root).encode("utf-8")
+        cur = ((gen, bucket), token, records, elements, base_kml)
+        feed.live_current.pop(base_url, None)
+        feed.live_current[base_url] = cur
+        while len(feed.live_current) > LIVE_MAX_BASE_URLS:
+            drop_live_base_url(feed, next(iter(feed.live_current)))
+
+        usage = feed.live_usage.setdefault(base_url, LiveUsage())
+        usage.current = len(base_kml) * (1 + _LIVE_TREE_BYTES_PER_KML_BYTE) + sys.getsizeof(elements)
+        usage.updates = 0
+        usage.last_used = time.monotonic()
+        history = feed.live_history.setdefault(base_url, {})
+        history[token] = records
+        usage.snapshots[token] = sys.getsizeof(records) + fresh * _LIVE_RECORD_BYTES if fresh else 0
+        while len(history) > LIVE_HISTORY_SIZE:
+            oldest = next(iter(history))
+            del history[oldest]
+            del usage.snapshots[oldest]
+        for k in [k for k in feed.live_updates if k[0] == base_url]:
+            del feed.live_updates[k]
+    with _render_lock:
+        _enforce_memory_budget(keep=usage)
+    return cur[1:]
+
+def share_live_records(records: dict[str, tuple], prev: dict[str, tuple]) -> tuple[dict[str, tuple], int]:
+    """
+    Swaps records equal to prev's for prev's own tuples, so kept snapshots share
+    them. Returns (records, how many are new), or (prev, 0) when nothing changed.
+    """
+    fresh = 0
+    for item_id, rec in records.items():
+        old = prev.get(item_id)
+        if old == rec:
+            records[item_id] = old
+        else:
+            fresh += 1
+    if not fresh and len(records) == len(prev):
+        return prev, 0
+    return records, fresh
+
+def drop_live_base_url(feed: Feed, base_url: str) -> None:
+    """
+    Forgets base_url's live snapshot, history and cached updates, keeping only
+    the ids they served in feed.live_dropped. Caller holds feed.live_lock.
+    """
+    feed.live_current.pop(base_url, None)
+    dropped = feed.live_dropped.pop(base_url, {})
+    for records in feed.live_history.pop(base_url, {}).values():
+        dropped.update((item_id, rec[1]) for item_id, rec in records.items())
+    if dropped:
+        feed.live_dropped[base_url] = dropped
+        while len(feed.live_dropped) > LIVE_MAX_BASE_URLS:
+            del feed.live_dropped[next(iter(feed.live_dropped))]
+    feed.live_usage.pop(base_url, None)
+    for k in [k for k in feed.live_updates if k[0] == base_url]:
+        del feed.live_updates[k]
+
+def get_live_base(base_url: str, feed: Feed | None = None) -> bytes:
+    return live_snapshot(base_url, feed)[3]
+
+def get_live_update(base_url: str, since: str, feed: Feed | None = None) -> bytes:
+    """
+    Returns the <Update> that takes a client holding snapshot `since` to the
+    current one. An unknown or expired token gets a resync: every id seen in
+    the kept history, or served before the state was dropped, is deleted and
+    the whole current document re-created.
+    """
+    feed = feed or get_feed()
+    token, records, elements, _ = live_snapshot(base_url, feed)
+    with feed.live_lock:
+        body = feed.live_updates.get((base_url, since))
+        history = feed.live_history.get(base_url, {})
+        old = history.get(since)
+        known = {}
+        if old is None:
+            known = {item_id: (None, tag, ()) for item_id, tag in feed.live_dropped.get(base_url, {}).items()}
+            for snap in history.values():
+                known.update(snap)
+    if body is not None:
+        return body
+    if since == token:
+        ops = ([], [], [])
+    elif old is not None:
+        ops = live_update_ops(old, records)
+    else:
+        ops = live_update_ops({}, records, [i for i in known if i not in records])
+    body = build_live_update(base_url, token, records, elements, ops, old or known)
+    if old is not None:
+        # Only known tokens are cached; arbitrary since= values must not grow the map
+        with feed.live_lock:
+            if feed.live_current.get(base_url, (None, None))[1] == token:
+                feed.live_updates[(base_url, since)] = body
+                feed.live_usage[base_url].updates += len(body)
+    return body
+
+def build_live_root(base_url: str, feed: Feed | None = None) -> str:
+    """Companion root: loads the base document once and polls /mapmil_update.kml for deltas."""
+    token = live_snapshot(base_url, feed)[0]
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="{KML_NS_URI}">
+  <Document>
+    <name>MapMil (live)</name>
+    <NetworkLink>
+      <name>MapMil</name>
+      <Link><href>{_live_base_href(base_url)}</href></Link>
+    </NetworkLink>
+    <NetworkLink>
+      <name>MapMil updates</name>
+      <Link>
+        <href>{base_url}/mapmil_update.kml?since={token}</href>
+        <refreshMode>onInterval</refreshMode>
+        <refreshInterval>{LIVE_REFRESH_SECONDS}</refreshInterval>
+      </Link>
+    </NetworkLink>
+  </Document>
+</kml>"""
+
+# -------------------------
+# Placemark index: ?bbox= / ?stale= / ?name= / ?id= queries without a document scan
+# -------------------------
+_WORD_START_RE = re.compile(r"\S+")
+
+def _cell_range(bbox: tuple[float, float, float, float]) -> tuple[int, int, int, int]:
+    g = INDEX_GRID_DEGREES
+    return (int(bbox[0] // g), int(bbox[1] // g), int(bbox[2] // g), int(bbox[3] // g))
+
+def _intersects(a: tuple[float, float, float, float], b: tuple[float, float, float, float]) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+class PlacemarkIndex:
+    """
+    Read-only lookup structures over the placemarks of one merged document:
+
+    records/ids/bboxes/gdhs/names: per placemark, in document order
+    by_id:  placemark id -> position
+    grid:   (cell_x, cell_y) -> positions whose bbox touches the cell
+    wide:   positions spanning more than INDEX_MAX_CELLS_PER_ITEM cells
+    words:  sorted (lowercase name word, position) for prefix lookups
+    by_gdh: sorted (gdh, position) of placemarks with a GDH, for stale cutoffs
+
+    Staleness uses the owning feed's stale_threshold (default STALE_THRESHOLD_SECONDS).
+    """
+
+    def __init__(self, records: list[PlacemarkRecord], stale_threshold: float | None = None):
+        self.stale_threshold = STALE_THRESHOLD_SECONDS if stale_threshold is None else stale_threshold
+        self.records, self.ids, self.bboxes, self.gdhs, self.names = [], [], [], [], []
+        self.by_id, self.grid, self.wide, words, by_gdh = {}, {}, [], [], []
+        for pos, rec in enumerate(records):
+            pm_id, gdh, bbox = rec.id, rec.gdh, rec.bbox()
+            name = (rec.name or "").strip().lower()
+
+            self.records.append(rec)
+            self.ids.append(pm_id)
+            self.bboxes.append(bbox)
+            self.gdhs.append(gdh)
+            self.names.append(name)
+            if pm_id:
+                self.by_id[pm_id] = pos
+            if gdh:
+                by_gdh.append((gdh, pos))
+            words.extend((w, pos) for w in _WORD_START_RE.findall(name))
+            if bbox is not None:
+                x0, y0, x1, y1 = _cell_range(bbox)
+                if (x1 - x0 + 1) * (y1 - y0 + 1) > INDEX_MAX_CELLS_PER_ITEM:
+                    self.wide.append(pos)
+                    continue
+                for cx in range(x0, x1 + 1):
+                    for cy in range(y0, y1 + 1):
+                        self.grid.setdefault((cx, cy), []).append(pos)
+        words.sort()
+        by_gdh.sort()
+        self.words = words
+        self.by_gdh = by_gdh
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def in_bbox(self, bbox: tuple[float, float, float, float]) -> set[int]:
+        x0, y0, x1, y1 = _cell_range(bbox)
+        found = set(self.wide)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= len(self.grid):
+            for cx in range(x0, x1 + 1):
+                for cy in range(y0, y1 + 1):
+                    found.update(self.grid.get((cx, cy), ()))
+        else:
+            # Query wider than the occupied area: walk occupied cells instead
+            for (cx, cy), positions in self.grid.items():
+                if x0 <= cx <= x1 and y0 <= cy <= y1:
+                    found.update(positions)
+        return {p for p in found if _intersects(self.bboxes[p], bbox)}
+
+    def with_name(self, query: str) -> set[int]:
+        """Case-insensitive: names containing `query` at the start of a word."""
+        query = query.strip().lower()
+        if not query:
+            return set(range(len(self)))
+        first = query.split()[0]
+        start = bisect.bisect_left(self.words, (first,))
+        found = set()
+        for i in range(start, len(self.words)):
+            word, pos = self.words[i]
+            if not word.startswith(first):
+                break
+            found.add(pos)
+        pattern = re.compile(r"(?:^|\s)" + re.escape(query))
+        return {p for p in found if pattern.search(self.names[p])}
+
+    def stale(self, now: float) -> set[int]:
+        """Same rule as flag_stale_placemarks: a GDH older than the stale threshold."""
+        cut = bisect.bisect_left(self.by_gdh, (now - self.stale_threshold,))
+        return {pos for _, pos in self.by_gdh[:cut]}
+
+    def is_stale(self, pos: int, now: float) -> bool:
+        gdh = self.gdhs[pos]
+        return bool(gdh) and (now - gdh) > self.stale_threshold
+
+    def with_routes(self, positions: set[int]) -> set[int]:
+        """Adds the <id>_route partner of every base placemark and vice versa, so groups stay whole."""
+        extra = set()
+        for pos in positions:
+            pm_id = self.ids[pos]
+            if not pm_id:
+                continue
+            partner = pm_id[:-len("_route")] if pm_id.endswith("_route") else f"{pm_id}_route"
+            other = self.by_id.get(partner)
+            if other is not None:
+                extra.add(other)
+        return positions | extra
+
+    def query(self, bbox: tuple[float, float, float, float] | None = None, stale: bool | None = None,
+              name: str | None = None, ids: list[str] | None = None, now: float | None = None) -> list[int]:
+        """
+        Positions (document order) matching every given filter. The most selective
+        index seeds the candidates and the other filters are checked per candidate,
+        so the cost follows the result size rather than the document size.
+        """
+        now = time.time() if now is None else now
+        if ids is not None:
+            found = {self.by_id[i] for i in ids if i in self.by_id}
+        elif bbox is not None:
+            found = self.in_bbox(bbox)
+        elif name:
+            found = self.with_name(name)
+        elif stale:
+            found = self.stale(now)
+        else:
+            found = set(range(len(self)))
+
+        if bbox is not None and ids is not None:
+            found = {p for p in found if self.bboxes[p] is not None and _intersects(self.bboxes[p], bbox)}
+        if name and (ids is not None or bbox is not None):
+            found &= self.with_name(name)
+        if stale is not None:
+            found = {p for p in found if self.is_stale(p, now) == stale}
+        return sorted(self.with_routes(found))
+
+def placemark_index(feed: Feed | None = None) -> PlacemarkIndex:
+    """The index of the current merge generation of `feed` (default feed if None), built on first use."""
+    feed = feed or get_feed()
+    kml, gen = get_merged_snapshot(feed)
+    state = feed.index
+    with state["lock"]:
+        if state["gen"] != gen:
+            records = merged_records(gen, feed)
+            if records is None:
+                records = records_from_kml(kml, merged_gdh_by_id(gen, feed))
+            state.update(gen=gen, index=PlacemarkIndex(records, feed.stale_threshold))
+        return state["index"]
+
+def parse_query_args(args) -> dict:
+    """
+    bbox=west,south,east,north (degrees), stale=true|false, name=<text>,
+    id=<id>[,<id>...]; raises ValueError on malformed values.
+    """
+    query = {}
+    if args.get("bbox"):
+        parts = [float(v) for v in args["bbox"].split(",")]
+        if len(parts) != 4 or parts[0] > parts[2] or parts[1] > parts[3]:
+            raise ValueError("bbox must be west,south,east,north")
+        query["bbox"] = tuple(parts)
+    if args.get("stale"):
+        v = args["stale"].strip().lower()
+        if v not in ("true", "false", "1", "0"):
+            raise ValueError("stale must be true or false")
+        query["stale"] = v in ("true", "1")
+    if args.get("name"):
+        query["name"] = args["name"]
+    if args.get("id"):
+        query["ids"] = [i for i in args["id"].split(",") if i]
+    return query
+
+def render_query(variant: str, base_url: str, query: dict, feed: Feed | None = None) -> bytes:
+    """Renders `variant` from only the placemarks matching `query` (not render-cached)."""
+    feed = feed or get_feed()
+    index = placemark_index(feed)
+    now = time.time()
+    positions = index.query(now=now, **query)
+    records = [index.records[p] for p in positions]
+    gdh_by_id = {rec.id: rec.gdh for rec in records if rec.id}
+    return RENDER_VARIANTS[variant](merged_kml_from_records(records), base_url, gdh_by_id, records,
+                                    feed.stale_threshold)
 
 # -------------------------
 # HTTP helpers + routes
@@ -602,34 +3617,89 @@ def make_error_kml(msg: str) -> str:
   </Document>
 </kml>"""
 
+# Error bodies and live updates are never reused; cached renders use rendered_response
 def add_common_headers(resp: Response) -> Response:
     resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     resp.headers["Pragma"] = "no-cache"
     return resp
 
-def _base_url() -> str:
-    return request.host_url.rstrip("/")
+def request_feed(feed_name: str | None) -> Feed:
+    """The feed a route serves: /feeds/<name>/... or, unprefixed, the default one; 404 if unknown."""
+    try:
+        return get_feed(feed_name)
+    except KeyError:
+        abort(404)
+
+def _base_url(feed_name: str | None = None) -> str:
+    # Feed routes hang below /feeds/<name>, so stale icon and live hrefs stay inside the feed
+    base = request.host_url.rstrip("/")
+    return base if feed_name is None else f"{base}/feeds/{feed_name}"
 
-def kml_response(kml_body: str, content_type: str, disposition: str) -> Response:
+def kml_response(kml_body: str | bytes | Iterator[bytes], content_type: str, disposition: str) -> Response:
     resp = Response(kml_body)
     resp.headers["Content-Type"] = content_type
     resp.headers["Content-Disposition"] = disposition
     return add_common_headers(resp)
 
-def kmz_response(kmz_bytes: bytes, filename: str) -> Response:
+def request_body(variant: str, feed: Feed, base_url: str) -> RenderedBody | StreamedRender:
+    """The cached render of `variant`, or a filtered render when the URL carries query filters."""
+    query = parse_query_args(request.args)
+    if query:
+        return RenderedBody(render_query(variant, base_url, query, feed))
+    return get_rendered_entry(variant, base_url, feed=feed)
+
+def _negotiate_coding(size: int) -> str | None:
+    if size < COMPRESS_MIN_BYTES:
+        return None
+    return request.accept_encodings.best_match(["gzip", "deflate"])
+
+def rendered_response(body: RenderedBody | StreamedRender, content_type: str, disposition: str,
+                      negotiate: bool = False) -> Response:
+    """
+    Success response for a render-cache body: strong ETag, 304 on a matching
+    If-None-Match and, with negotiate, a pre-compressed gzip/deflate copy.
+    Streamed misses go out as-is; the next poll hits the cache and gets an ETag.
+    """
+    etag = coding = None
+    if isinstance(body, RenderedBody):
+        coding = _negotiate_coding(len(body.body)) if negotiate else None
+        etag = body.etag_for(coding)
+        if request.if_none_match.contains_weak(etag):
+            resp = Response(status=304)
+        else:
+            resp = Response(body.encoded(coding))
+    else:
+        resp = Response(body)
+    if resp.status_code != 304:
+        resp.headers["Content-Type"] = content_type
+        resp.headers["Content-Disposition"] = disposition
+        if coding:
+            resp.headers["Content-Encoding"] = coding
+    if etag:
+        resp.set_etag(etag)
+    if negotiate:
+        resp.vary.add("Accept-Encoding")
+    resp.headers["Cache-Control"] = OUTPUT_CACHE_CONTROL
+    return resp
+
+def kmz_response(kmz_bytes: bytes | Iterator[bytes], filename: str) -> Response:
     resp = Response(kmz_bytes)
     resp.headers["Content-Type"] = "application/vnd.google-earth.kmz"
     resp.headers["Content-Disposition"] = f"attachment; filename={filename}"
     return add_common_headers(resp)
 
-@app.route("/static/<path:filename>")
-def static_files(filename):
+@app.route("/static/<path:filename>", defaults={"feed_name": None})
+@app.route("/feeds/<feed_name>/static/<path:filename>")
+def static_files(filename, feed_name):
+    request_feed(feed_name)
     return send_from_directory(STATIC_DIR, filename)
 
-@app.route("/debug/icons")
-def debug_icons():
+@app.route("/debug/icons", defaults={"feed_name": None})
+@app.route("/feeds/<feed_name>/debug/icons")
+def debug_icons(feed_name):
+    feed = request_feed(feed_name)
     try:
-        kml_body = get_merged_kml_cached()
+        kml_body = get_merged_kml_cached(feed)
         icon_urls = extract_icon_urls(kml_body)
         lines = [
             f"Icons found: {len(icon_urls)}",
@@ -643,65 +3713,98 @@ def debug_icons():
     except Exception as e:
         return Response(str(e), mimetype="text/plain; charset=utf-8", status=500)
 
-@app.route("/mapmil")
-def mapmil_inline():
-    try:
-        body = flag_stale_placemarks_in_kml(get_merged_kml_cached(), _base_url())
-        body = group_route_placemarks_into_folders(body)
-        body = move_stale_items_to_inativos_folder(body, "0_Inativos")
-        body = sort_kml_document_alphabetically(body)
+@app.route("/debug/refresh", defaults={"feed_name": None})
+@app.route("/feeds/<feed_name>/debug/refresh")
+def debug_refresh(feed_name):
+    return Response("\n".join(refresh_stats_lines(request_feed(feed_name))), mimetype="text/plain; charset=utf-8")
 
-        return kml_response(body, "application/xml; charset=utf-8", "inline; filename=mapmil.kml")
+@app.route("/mapmil", defaults={"feed_name": None})
+@app.route("/feeds/<feed_name>/mapmil")
+def mapmil_inline(feed_name):
+    feed = request_feed(feed_name)
+    try:
+        body = request_body("kml", feed, _base_url(feed_name))
+        return rendered_response(body, "application/xml; charset=utf-8", "inline; filename=mapmil.kml", negotiate=True)
     except Exception as e:
         return kml_response(make_error_kml(str(e)), "application/xml; charset=utf-8", "inline; filename=mapmil.kml")
 
-@app.route("/mapmil.kml")
-def mapmil_download_kml():
+@app.route("/mapmil.kml", defaults={"feed_name": None})
+@app.route("/feeds/<feed_name>/mapmil.kml")
+def mapmil_download_kml(feed_name):
+    feed = request_feed(feed_name)
     try:
-        body = flag_stale_placemarks_in_kml(get_merged_kml_cached(), _base_url())
-        body = group_route_placemarks_into_folders(body)
-        body = move_stale_items_to_inativos_folder(body, "0_Inativos")
-        body = sort_kml_document_alphabetically(body)
-        return kml_response(body, "application/vnd.google-earth.kml+xml; charset=utf-8", "attachment; filename=mapmil.kml")
+        body = request_body("kml", feed, _base_url(feed_name))
+        return rendered_response(body, "application/vnd.google-earth.kml+xml; charset=utf-8", "attachment; filename=mapmil.kml", negotiate=True)
     except Exception as e:
         return kml_response(make_error_kml(str(e)), "application/vnd.google-earth.kml+xml; charset=utf-8", "attachment; filename=mapmil.kml")
 
-@app.route("/mapmil.kmz")
-def mapmil_download_kmz_simple():
+@app.route("/mapmil.kmz", defaults={"feed_name": None})
+@app.route("/feeds/<feed_name>/mapmil.kmz")
+def mapmil_download_kmz_simple(feed_name):
+    feed = request_feed(feed_name)
     try:
-        kml_body = flag_stale_placemarks_in_kml(get_merged_kml_cached(), _base_url())
-        body = group_route_placemarks_into_folders(body)
-        body = sort_kml_document_alphabetically(body)
-        mem = io.BytesIO()
-        with zipfile.ZipFile(mem, mode="w", compression=zipfile.ZIP_DEFLATED) as z:
-            z.writestr("doc.kml", kml_body)
-        return kmz_response(mem.getvalue(), "mapmil.kmz")
+        body = request_body("kmz", feed, _base_url(feed_name))
+        return rendered_response(body, "application/vnd.google-earth.kmz", "attachment; filename=mapmil.kmz")
     except Exception as e:
-        error_kml = make_error_kml(str(e))
-        mem = io.BytesIO()
-        with zipfile.ZipFile(mem, mode="w", compression=zipfile.ZIP_DEFLATED) as z:
-            z.writestr("doc.kml", error_kml)
-        return kmz_response(mem.getvalue(), "mapmil.kmz")
-
-@app.route("/mapmil_atak.kmz")
-def mapmil_download_kmz_atak():
-    try:
-        base_url = _base_url()
-        kml_body = flag_stale_placemarks_in_kml(get_merged_kml_cached(), base_url)
-        kml_body = group_route_placemarks_into_folders(kml_body)
-        kml_body = move_stale_items_to_inativos_folder(kml_body, "0_Inativos")
-        kml_body = sort_kml_document_alphabetically(kml_body)
+        return kmz_response(build_kmz_simple(make_error_kml(str(e))), "mapmil.kmz")
 
-        return kmz_response(kmz_bytes, "mapmil_atak.kmz")
+@app.route("/mapmil_atak.kmz", defaults={"feed_name": None})
+@app.route("/feeds/<feed_name>/mapmil_atak.kmz")
+def mapmil_download_kmz_atak(feed_name):
+    feed = request_feed(feed_name)
+    try:
+        body = request_body("atak_kmz", feed, _base_url(feed_name))
+        return rendered_response(body, "application/vnd.google-earth.kmz", "attachment; filename=mapmil_atak.kmz")
     except Exception as e:
-        base_url = _base_url()
+        base_url = _base_url(feed_name)
         error_kml = flag_stale_placemarks_in_kml(make_error_kml(str(e)), base_url)
         kmz_bytes = build_kmz_with_embedded_icons(error_kml, base_url)
         return kmz_response(kmz_bytes, "mapmil_atak.kmz")
 
+@app.route("/mapmil_live.kml", defaults={"feed_name": None})
+@app.route("/feeds/<feed_name>/mapmil_live.kml")
+def mapmil_live_root(feed_name):
+    feed = request_feed(feed_name)
+    try:
+        body = build_live_root(_base_url(feed_name), feed)
+    except Exception as e:
+        body = make_error_kml(str(e))
+    return kml_response(body, "application/vnd.google-earth.kml+xml; charset=utf-8", "attachment; filename=mapmil_live.kml")
+
+@app.route("/mapmil_live_base.kml", defaults={"feed_name": None})
+@app.route("/feeds/<feed_name>/mapmil_live_base.kml")
+def mapmil_live_base(feed_name):
+    feed = request_feed(feed_name)
+    try:
+        body = get_live_base(_base_url(feed_name), feed)
+    except Exception as e:
+        body = make_error_kml(str(e))
+    return kml_response(body, "application/vnd.google-earth.kml+xml; charset=utf-8", "inline; filename=mapmil_live_base.kml")
+
+@app.route("/mapmil_update.kml", defaults={"feed_name": None})
+@app.route("/feeds/<feed_name>/mapmil_update.kml")
+def mapmil_update(feed_name):
+    feed = request_feed(feed_name)
+    # Google Earth appends the previous <cookie> to the link's query, so the
+    # newest since= wins
+    since = (request.args.getlist("since") or [""])[-1]
+    try:
+        body = get_live_update(_base_url(feed_name), since, feed)
+    except Exception as e:
+        body = make_error_kml(str(e))
+    return kml_response(body, "application/vnd.google-earth.kml+xml; charset=utf-8", "inline; filename=mapmil_update.kml")
+
+@app.route("/metrics")
+def metrics():
+    if not METRICS_ENABLED:
+        abort(404)
+    return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.route("/")
 def index():
-    return "OK | /debug/icons | /mapmil | /mapmil.kml | /mapmil.kmz | /mapmil_atak.kmz"
+    return ("OK | /metrics | /debug/icons | /debug/refresh | /mapmil | /mapmil.kml | /mapmil.kmz | /mapmil_atak.kmz"
+            " | /mapmil_live.kml | /mapmil_update.kml"
+            f" | feeds (under /feeds/<name>/...): {', '.join(FEEDS)}")
 
 if __name__ == "__main__":
     os.makedirs(STATIC_DIR, exist_ok=True)
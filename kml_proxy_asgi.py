@@ -0,0 +1,512 @@
+"""
+Asyncio (ASGI) serving mode for kml_proxy: the same routes, feeds and caches,
+with upstream I/O on the event loop instead of in request threads.
+
+    uvicorn kml_proxy_asgi:app --host 0.0.0.0 --port 8000
+
+- Feeds refresh in one asyncio task each. The recent/full GETs are awaited, and
+  the merge runs on the render threads. There is no refresh thread per feed.
+- ATAK KMZ misses download their missing icons on the loop before rendering,
+  so the render finds them cached instead of waiting out the icon deadline.
+- Concurrent requests for the same render, live snapshot or refresh share one
+  run. A slow upstream costs waiting coroutines, not worker threads, so `/`
+  keeps answering.
+- XML and KMZ work runs on ASGI_RENDER_WORKERS threads. With
+  kml_proxy.RENDER_PROCESSES, those threads hand render-cache misses to worker processes.
+
+Upstream GETs use httpx.AsyncClient when the httpx package is installed.
+Otherwise they fall back to the shared requests session on ASGI_IO_WORKERS
+threads: still off the loop, but one thread per GET in flight.
+"""
+import asyncio
+import mimetypes
+import os
+import ssl
+import time
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+import requests
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+from werkzeug.security import safe_join
+
+import kml_proxy as kp
+
+# -------------------------
+# Config
+# -------------------------
+ASGI_RENDER_WORKERS = min(4, os.cpu_count() or 1)  # threads for XML parsing, rendering and KMZ/gzip work
+ASGI_IO_WORKERS = kp.UPSTREAM_POOL_SIZE           # blocking upstream GETs (no httpx) and disk reads
+
+# -------------------------
+# Upstream
+# -------------------------
+class AsyncUpstream:
+    """
+    GET for the event loop, returning (status, headers, content, text) with
+    case-insensitive headers and `text` decoding content on demand. Raises
+    requests.HTTPError on 4xx/5xx, like raise_for_status in kml_proxy.
+    """
+
+    def __init__(self, io_pool: ThreadPoolExecutor):
+        self.io_pool = io_pool
+        try:
+            import httpx
+        except ImportError:
+            self.client = None
+            return
+        cafile = kp._upstream_verify()
+        verify = ssl.create_default_context(cafile=cafile) if cafile else False
+        limits = httpx.Limits(max_connections=kp.UPSTREAM_POOL_SIZE + kp.ICON_FETCH_CONCURRENCY)
+        self.client = httpx.AsyncClient(
+            headers={"User-Agent": kp.USER_AGENT}, follow_redirects=True, limits=limits,
+            transport=httpx.AsyncHTTPTransport(verify=verify, limits=limits),
+        )
+        self.timeout = lambda t: httpx.Timeout(t, connect=min(t, kp.UPSTREAM_CONNECT_TIMEOUT_SECONDS))
+        self.retry_errors = (httpx.ConnectError, httpx.ConnectTimeout)
+
+    async def get(self, url: str, headers: dict[str, str] | None, timeout: float) -> tuple:
+        if self.client is not None:
+            r = await self._get_retrying(url, headers, timeout)
+            status, resp_headers, content, text = r.status_code, r.headers, r.content, lambda: r.text
+        else:
+            get = partial(kp.get_upstream_session().get, url, headers=headers,
+                          timeout=(min(timeout, kp.UPSTREAM_CONNECT_TIMEOUT_SECONDS), timeout),
+                          verify=kp._upstream_verify())
+            r = await asyncio.get_running_loop().run_in_executor(self.io_pool, get)
+            status, resp_headers, content, text = r.status_code, r.headers, r.content, lambda: r.text
+        if status >= 400:
+            raise requests.HTTPError(f"{status} Error for url: {url}")
+        return status, resp_headers, content, text
+
+    async def _get_retrying(self, url: str, headers: dict[str, str] | None, timeout: float):
+        """
+        The requests session's retry policy on httpx: connect errors and
+        UPSTREAM_RETRY_STATUSES are retried up to UPSTREAM_RETRIES times with
+        urllib3's backoff (or the Retry-After of a 429/503), read timeouts are not.
+        """
+        for retry in range(1, kp.UPSTREAM_RETRIES + 2):
+            last = retry > kp.UPSTREAM_RETRIES
+            try:
+                r = await self.client.get(url, headers=headers, timeout=self.timeout(timeout))
+            except self.retry_errors:
+                if last:
+                    raise
+                delay = kp.upstream_backoff_seconds(retry)
+            else:
+                if last or r.status_code not in kp.UPSTREAM_RETRY_STATUSES:
+                    return r
+                delay = _retry_after(r.headers) if r.status_code in (429, 503) else None
+                if delay is None:
+                    delay = kp.upstream_backoff_seconds(retry)
+                await r.aclose()
+            await asyncio.sleep(delay)
+
+    async def aclose(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+
+def _retry_after(headers) -> float | None:
+    # Retry-After in seconds (the HTTP-date form falls back to the backoff)
+    value = headers.get("Retry-After", "").strip()
+    return float(value) if value.isdigit() else None
+
+# -------------------------
+# Coalescing + refresh tasks
+# -------------------------
+class Coalescer:
+    """One run per key at a time; callers arriving while it runs await the same result."""
+
+    def __init__(self):
+        self._inflight = {}
+
+    async def run(self, key: tuple, factory: Callable[[], Awaitable]):
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(factory())
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # A disconnecting client must not cancel work others are waiting on
+        return await asyncio.shield(fut)
+
+class FeedRefresher:
+    """A feed's refresh loop on the event loop; sits in feed.refresher so kml_proxy starts no thread for it."""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+
+    def is_alive(self) -> bool:
+        return not self.task.done()
+
+    def join(self, timeout: float | None = None) -> None:
+        # Called from kml_proxy.stop_background_refresh, possibly off the loop
+        self.task.get_loop().call_soon_threadsafe(self.task.cancel)
+
+# -------------------------
+# Requests + responses
+# -------------------------
+class Request:
+    __slots__ = ("method", "path", "args", "headers", "host_url")
+
+    def __init__(self, scope: dict):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = MultiDict(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True))
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        host = self.headers.get("host") or "{}:{}".format(*(scope.get("server") or ("localhost", 80)))
+        self.host_url = f"{scope.get('scheme', 'http')}://{host}"
+
+    def base_url(self, feed_name: str | None) -> str:
+        # Same as kml_proxy._base_url: feed routes hang below /feeds/<name>
+        return self.host_url if feed_name is None else f"{self.host_url}/feeds/{feed_name}"
+
+class Reply:
+    __slots__ = ("status", "headers", "body")
+
+    def __init__(self, body: bytes | str = b"", status: int = 200, headers: list[tuple[str, str]] | None = None):
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.status = status
+        self.headers = [] if headers is None else headers
+
+def text_reply(text: str, status: int = 200) -> Reply:
+    return Reply(text, status, [("Content-Type", "text/plain; charset=utf-8")])
+
+def kml_reply(body: str | bytes, content_type: str, disposition: str) -> Reply:
+    """kml_proxy.kml_response: uncached bodies (live documents, errors)."""
+    return Reply(body, 200, [
+        ("Content-Type", content_type), ("Content-Disposition", disposition),
+        ("Cache-Control", "no-store, no-cache, must-revalidate, max-age=0"), ("Pragma", "no-cache"),
+    ])
+
+# -------------------------
+# Application
+# -------------------------
+KML_TYPE = "application/vnd.google-earth.kml+xml; charset=utf-8"
+KMZ_TYPE = "application/vnd.google-earth.kmz"
+
+class KmlProxyAsgi:
+    """The ASGI callable. Pools, the upstream client and refresh tasks start with the first request or lifespan."""
+
+    def __init__(self):
+        self.started = False
+        self.coalesce = Coalescer()
+        self.icon_urls = {}  # feed name -> (merge gen, icon URLs of that merge)
+
+    # ---- lifecycle ----
+    def _start(self) -> None:
+        if self.started:
+            return
+        self.started = True
+        # Refreshes are this loop's FeedRefresher tasks; requests only ever read the latest merge
+        kp.BACKGROUND_REFRESH = True
+        self.render_pool = ThreadPoolExecutor(ASGI_RENDER_WORKERS, thread_name_prefix="kml-asgi-render")
+        self.io_pool = ThreadPoolExecutor(ASGI_IO_WORKERS, thread_name_prefix="kml-asgi-io")
+        self.upstream = AsyncUpstream(self.io_pool)
+        self.icon_slots = asyncio.Semaphore(kp.ICON_FETCH_CONCURRENCY)
+
+    async def _stop(self) -> None:
+        if not self.started:
+            return
+        for feed in kp.FEEDS.values():
+            if isinstance(feed.refresher, FeedRefresher):
+                feed.refresher.task.cancel()
+                feed.refresher = None
+        await self.upstream.aclose()
+        self.render_pool.shutdown(wait=False)
+        self.io_pool.shutdown(wait=False)
+        kp.stop_render_processes()
+        self.started = False
+
+    async def cpu(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.render_pool, partial(fn, *args))
+
+    async def io(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.io_pool, partial(fn, *args))
+
+    # ---- feeds ----
+    def _ensure_refresher(self, feed: kp.Feed) -> None:
+        if isinstance(feed.refresher, FeedRefresher) and feed.refresher.is_alive():
+            return
+        feed.refresher = FeedRefresher(asyncio.ensure_future(self._refresh_loop(feed)))
+
+    async def _refresh_loop(self, feed: kp.Feed) -> None:
+        while True:
+            try:
+                await self.refresh(feed)
+            except Exception:
+                pass  # recorded in feed.refresh_stats; keep serving the previous merge
+            await asyncio.sleep(feed.refresh_interval)
+
+    async def refresh(self, feed: kp.Feed) -> tuple[str, int]:
+        return await self.coalesce.run(("refresh", feed.name), lambda: self._refresh(feed))
+
+    async def _refresh(self, feed: kp.Feed) -> tuple[str, int]:
+        if kp.get_cache_backend().shared:
+            # Leases and publishing stay in kml_proxy; blocking, but on the I/O threads
+            return await self.io(kp.refresh_merged_kml, feed)
+        responses = await asyncio.gather(*(self._fetch_source(url, feed) for url in (feed.recent_url, feed.full_url)),
+                                         return_exceptions=True)
+        return await self.cpu(kp.refresh_from_responses, feed, responses)
+
+    async def _fetch_source(self, url: str, feed: kp.Feed) -> tuple:
+        started = time.perf_counter()
+        try:
+            return await self.upstream.get(url, kp._conditional_headers(feed.source_state.get(url)),
+                                           kp.UPSTREAM_TIMEOUT_SECONDS)
+        except Exception:
+            kp.METRIC_UPSTREAM_RESPONSES.inc("kml", "error")
+            raise
+        finally:
+            kp.METRIC_UPSTREAM_SECONDS.observe_since(started, "kml")
+
+    def _peek(self, feed: kp.Feed, variant: str | None,
+              base_url: str | None) -> tuple[bool, tuple[int, int], kp.RenderedBody | None]:
+        # (has a merge, _stamp, cached render of variant); takes kp._render_lock, so render threads only
+        merged = kp._snapshot(feed)[0] is not None
+        body = kp.peek_rendered(variant, base_url, feed) if merged and variant else None
+        return merged, self._stamp(feed), body
+
+    async def ready(self, feed: kp.Feed, variant: str | None = None,
+                    base_url: str | None = None) -> tuple[tuple[int, int], kp.RenderedBody | None]:
+        """
+        Returns once feed has a merge, so kml_proxy calls made for it never fetch
+        inline: its (merge gen, stale bucket) and, given a variant, the cached render if any.
+        """
+        self._ensure_refresher(feed)
+        merged, stamp, body = await self.cpu(self._peek, feed, variant, base_url)
+        if not merged:
+            await self.refresh(feed)
+            _, stamp, body = await self.cpu(self._peek, feed, variant, base_url)
+        return stamp, body
+
+    # ---- icons ----
+    def _missing_icons(self, feed: kp.Feed) -> list[str]:
+        kml, gen, _ = kp._snapshot(feed)
+        cached = self.icon_urls.get(feed.name)
+        if cached is None or cached[0] != gen:
+            cached = self.icon_urls[feed.name] = (gen, kp.extract_icon_urls(kml))
+        return kp.icons_to_fetch(cached[1])
+
+    async def prefetch_icons(self, feed: kp.Feed) -> None:
+        """
+        Downloads the icons an ATAK KMZ render would, within the icon deadline.
+        Failures, and icons still downloading when the deadline passes, are
+        recorded with kml_proxy.record_icon_failure. The render then leaves them
+        out instead of downloading them again on a render thread.
+        """
+        urls = await self.cpu(self._missing_icons, feed)
+        if not urls:
+            return
+        tasks = {asyncio.ensure_future(self.coalesce.run(("icon", url), partial(self._fetch_icon, url))): url
+                 for url in urls}
+        done, late = await asyncio.wait(tasks, timeout=kp.ICON_FETCH_DEADLINE_SECONDS)
+        for t in done:
+            t.exception()  # recorded by _fetch_icon
+        for t in late:
+            t.add_done_callback(lambda t: t.cancelled() or t.exception())
+            kp.record_icon_failure(tasks[t], f"TimeoutError: not downloaded within the "
+                                             f"{kp.ICON_FETCH_DEADLINE_SECONDS}s icon deadline")
+
+    async def _fetch_icon(self, url: str) -> None:
+        async with self.icon_slots:
+            started = time.perf_counter()
+            try:
+                _, headers, data, _ = await self.upstream.get(
+                    url, {"Accept": "image/*,*/*;q=0.8", "Referer": "https://mapmil.igeoe.pt/"},
+                    kp.ICON_FETCH_TIMEOUT_SECONDS)
+            except Exception as e:
+                kp.METRIC_UPSTREAM_RESPONSES.inc("icon", "error")
+                kp.record_icon_failure(url, f"{type(e).__name__}: {e}")
+                raise
+            finally:
+                kp.METRIC_UPSTREAM_SECONDS.observe_since(started, "icon")
+        kp.METRIC_UPSTREAM_RESPONSES.inc("icon", "fetched")
+        kp.METRIC_UPSTREAM_BYTES.inc("icon", amount=len(data))
+        await self.io(kp.store_icon, url, data, headers.get("Content-Type", "image/png"))
+
+    # ---- rendering ----
+    def _stamp(self, feed: kp.Feed) -> tuple[int, int]:
+        # Takes kp._render_lock: render threads only
+        return kp._snapshot(feed)[1], int(time.time() // kp.STALE_BUCKET_SECONDS)
+
+    async def rendered(self, variant: str, feed: kp.Feed, req: Request, feed_name: str | None) -> kp.RenderedBody:
+        """
+        kml_proxy.request_body without blocking: the cache lookup runs on a render
+        thread (it takes kml_proxy's _render_lock), misses are rendered once per key.
+        """
+        query = kp.parse_query_args(req.args)
+        base_url = req.base_url(feed_name)
+        stamp, body = await self.ready(feed, None if query else variant, base_url)
+        if body is not None:
+            return body
+        if variant == "atak_kmz":
+            await self.prefetch_icons(feed)
+        if query:
+            key = ("query", feed.name, variant, base_url, *stamp, tuple(sorted(req.args.items(multi=True))))
+            render = lambda: kp.RenderedBody(kp.render_query(variant, base_url, query, feed))
+        else:
+            key = ("render", feed.name, variant, base_url, *stamp)
+            render = partial(kp.get_rendered_entry, variant, base_url, False, feed)
+        return await self.coalesce.run(key, partial(self.cpu, render))
+
+    async def rendered_reply(self, req: Request, body: kp.RenderedBody, content_type: str, disposition: str,
+                             negotiate: bool = False) -> Reply:
+        """kml_proxy.rendered_response: strong ETag, 304 on If-None-Match, optional gzip/deflate copy."""
+        coding = None
+        if negotiate and len(body.body) >= kp.COMPRESS_MIN_BYTES:
+            coding = parse_accept_header(req.headers.get("accept-encoding")).best_match(["gzip", "deflate"])
+        etag = body.etag_for(coding)
+        headers = []
+        if parse_etags(req.headers.get("if-none-match")).contains_weak(etag):
+            reply = Reply(b"", 304, headers)
+        else:
+            data = body.encoded(coding) if body.is_encoded(coding) else await self.cpu(body.encoded, coding)
+            reply = Reply(data, 200, headers)
+            headers += [("Content-Type", content_type), ("Content-Disposition", disposition)]
+            if coding:
+                headers.append(("Content-Encoding", coding))
+        headers.append(("ETag", quote_etag(etag)))
+        if negotiate:
+            headers.append(("Vary", "Accept-Encoding"))
+        headers.append(("Cache-Control", kp.OUTPUT_CACHE_CONTROL))
+        return reply
+
+    # ---- routes ----
+    async def mapmil(self, req: Request, feed: kp.Feed, feed_name: str | None, inline: bool) -> Reply:
+        content_type = "application/xml; charset=utf-8" if inline else KML_TYPE
+        disposition = "inline; filename=mapmil.kml" if inline else "attachment; filename=mapmil.kml"
+        try:
+            body = await self.rendered("kml", feed, req, feed_name)
+            return await self.rendered_reply(req, body, content_type, disposition, negotiate=True)
+        except Exception as e:
+            return kml_reply(kp.make_error_kml(str(e)), content_type, disposition)
+
+    async def mapmil_kmz(self, req: Request, feed: kp.Feed, feed_name: str | None, atak: bool) -> Reply:
+        filename = "mapmil_atak.kmz" if atak else "mapmil.kmz"
+        try:
+            body = await self.rendered("atak_kmz" if atak else "kmz", feed, req, feed_name)
+            return await self.rendered_reply(req, body, KMZ_TYPE, f"attachment; filename={filename}")
+        except Exception as e:
+            base_url = req.base_url(feed_name)
+            error_kml = kp.make_error_kml(str(e))
+            if atak:
+                kmz = await self.cpu(lambda: kp.build_kmz_with_embedded_icons(
+                    kp.flag_stale_placemarks_in_kml(error_kml, base_url), base_url))
+            else:
+                kmz = await self.cpu(kp.build_kmz_simple, error_kml)
+            return kml_reply(kmz, KMZ_TYPE, f"attachment; filename={filename}")
+
+    async def live(self, req: Request, feed: kp.Feed, feed_name: str | None, kind: str) -> Reply:
+        base_url = req.base_url(feed_name)
+        if kind == "root":
+            disposition, key, fn = "attachment; filename=mapmil_live.kml", (), kp.build_live_root
+        elif kind == "base":
+            disposition, key, fn = "inline; filename=mapmil_live_base.kml", (), kp.get_live_base
+        else:
+            # Google Earth appends the previous <cookie> to the link's query, so the newest since= wins
+            since = (req.args.getlist("since") or [""])[-1]
+            disposition, key, fn = "inline; filename=mapmil_update.kml", (since,), partial(kp.get_live_update,
+                                                                                            since=since)
+        try:
+            stamp, _ = await self.ready(feed)
+            body = await self.coalesce.run(("live", kind, feed.name, base_url, *stamp, *key),
+                                           partial(self.cpu, partial(fn, base_url, feed=feed)))
+        except Exception as e:
+            body = kp.make_error_kml(str(e))
+        return kml_reply(body, KML_TYPE, disposition)
+
+    async def debug_icons(self, feed: kp.Feed) -> Reply:
+        try:
+            await self.ready(feed)
+            icon_urls = await self.cpu(lambda: kp.extract_icon_urls(kp.get_merged_kml_cached(feed)))
+        except Exception as e:
+            return text_reply(str(e), 500)
+        return text_reply("\n".join([
+            f"Icons found: {len(icon_urls)}",
+            f"ALLOWED_ICON_PREFIX: {kp.ALLOWED_ICON_PREFIX}",
+            f"HREF_RE: {kp.HREF_RE}",
+            "",
+            "First 20 icon URLs:",
+            *icon_urls[:20]
+        ]))
+
+    async def static(self, filename: str) -> Reply:
+        path = safe_join(kp.STATIC_DIR, filename)
+        if path is None or not os.path.isfile(path):
+            return text_reply("Not Found", 404)
+        data = await self.io(Path(path).read_bytes)
+        return Reply(data, 200, [("Content-Type", mimetypes.guess_type(path)[0] or "application/octet-stream")])
+
+    async def dispatch(self, req: Request) -> Reply:
+        path = req.path
+        if path == "/":
+            return text_reply("OK (asgi) | /metrics | /debug/icons | /debug/refresh | /mapmil | /mapmil.kml"
+                              " | /mapmil.kmz | /mapmil_atak.kmz | /mapmil_live.kml | /mapmil_update.kml"
+                              f" | feeds (under /feeds/<name>/...): {', '.join(kp.FEEDS)}")
+        if path == "/metrics":
+            if not kp.METRICS_ENABLED:
+                return text_reply("Not Found", 404)
+            return Reply(await self.cpu(kp.render_metrics), 200,
+                         [("Content-Type", "text/plain; version=0.0.4; charset=utf-8")])
+
+        feed_name = None
+        if path.startswith("/feeds/"):
+            feed_name, _, rest = path[len("/feeds/"):].partition("/")
+            path = "/" + rest
+        try:
+            feed = kp.get_feed(feed_name)
+        except KeyError:
+            return text_reply("Not Found", 404)
+
+        if path.startswith("/static/"):
+            return await self.static(path[len("/static/"):])
+        if path == "/mapmil":
+            return await self.mapmil(req, feed, feed_name, inline=True)
+        if path == "/mapmil.kml":
+            return await self.mapmil(req, feed, feed_name, inline=False)
+        if path == "/mapmil.kmz":
+            return await self.mapmil_kmz(req, feed, feed_name, atak=False)
+        if path == "/mapmil_atak.kmz":
+            return await self.mapmil_kmz(req, feed, feed_name, atak=True)
+        if path == "/mapmil_live.kml":
+            return await self.live(req, feed, feed_name, "root")
+        if path == "/mapmil_live_base.kml":
+            return await self.live(req, feed, feed_name, "base")
+        if path == "/mapmil_update.kml":
+            return await self.live(req, feed, feed_name, "update")
+        if path == "/debug/icons":
+            return await self.debug_icons(feed)
+        if path == "/debug/refresh":
+            return text_reply("\n".join(await self.cpu(kp.refresh_stats_lines, feed)))
+        return text_reply("Not Found", 404)
+
+    # ---- ASGI ----
+    async def __call__(self, scope: dict, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    self._start()
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await self._stop()
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+        self._start()
+        req = Request(scope)
+        if req.method not in ("GET", "HEAD"):
+            reply = Reply(b"Method Not Allowed", 405, [("Allow", "GET, HEAD")])
+        else:
+            reply = await self.dispatch(req)
+        headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in reply.headers]
+        headers.append((b"content-length", str(len(reply.body)).encode("latin-1")))
+        await send({"type": "http.response.start", "status": reply.status, "headers": headers})
+        await send({"type": "http.response.body", "body": b"" if req.method == "HEAD" else reply.body})
+
+app = KmlProxyAsgi()
@@ -0,0 +1,100 @@
+"""
+Shared fixtures: a local stand-in for the MapMil upstream and a kml_proxy
+pointed at it, with module settings and process-wide caches restored after
+each test.
+"""
+import hashlib
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+import kml_proxy as kp
+
+BASE_URL = "http://localhost"  # what the Flask test client's requests resolve to
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+
+
+class Upstream:
+    """Serves `docs` (path -> KML text) with ETags and 304s, and a PNG for any /icons/ path."""
+
+    def __init__(self):
+        self.docs = {}
+        self.hits = []  # request paths, in order
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                upstream.hits.append(path)
+                if path.startswith("/icons/"):
+                    body, ctype = PNG + path.encode("utf-8"), "image/png"
+                elif path in upstream.docs:
+                    body, ctype = upstream.docs[path].encode("utf-8"), "application/vnd.google-earth.kml+xml"
+                else:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", ctype)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def feed_hits(self) -> int:
+        return sum(1 for p in self.hits if not p.startswith("/icons/"))
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def upstream():
+    server = Upstream()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def proxy(upstream, monkeypatch, tmp_path):
+    """kml_proxy reading its default feed from `upstream`, refreshing inline, with empty caches."""
+    monkeypatch.setattr(kp, "SOURCE_KML_RECENT", upstream.base + "/recent")
+    monkeypatch.setattr(kp, "SOURCE_KML_FULL", upstream.base + "/full")
+    monkeypatch.setattr(kp, "ALLOWED_ICON_PREFIX", upstream.base + "/icons/")
+    monkeypatch.setattr(kp, "BACKGROUND_REFRESH", False)
+    monkeypatch.setattr(kp, "ICON_CACHE_DIR", str(tmp_path / "icons"))
+    monkeypatch.setattr(kp, "CACHE_SHARED_DIR", str(tmp_path / "shared"))
+    monkeypatch.setattr(kp, "FEEDS", kp.load_feed_registry(None))
+    monkeypatch.setitem(kp._backend, "backend", None)
+    saved = [(cache, dict(cache)) for cache in (kp._icon_cache, kp._icon_failures, kp._zip_entry_cache)]
+    for cache, _ in saved:
+        cache.clear()
+    yield kp
+    for cache, contents in saved:
+        cache.clear()
+        cache.update(contents)
@@ -0,0 +1,31 @@
+"""Small hand-built MapMil-style documents for the tests."""
+import time
+import xml.etree.ElementTree as ET
+
+from synthetic import gdh_text
+
+NOW = time.time()
+FRESH, STALE = 60, 90000  # GDH ages in seconds
+
+
+def placemark(pm_id: str | None, name: str, age: float, line: bool = False,
+              lon: float = -9.0, lat: float = 38.0, icon: str = "https://example.test/i.png") -> str:
+    id_attr = f' id="{pm_id}"' if pm_id else ""
+    geometry = (f"<LineString><coordinates>{lon},{lat},0 {lon + 0.1},{lat + 0.1},0</coordinates></LineString>" if line
+                else f"<Point><coordinates>{lon},{lat},0</coordinates></Point>")
+    return (f"<Placemark{id_attr}><name>{name}</name>"
+            f"<description><![CDATA[GDH de recepção do último sinal:<br> {gdh_text(NOW - age)}]]></description>"
+            f"<Style><IconStyle><scale>1</scale><Icon><href>{icon}</href></Icon></IconStyle>"
+            f"<LabelStyle><scale>1</scale></LabelStyle></Style>{geometry}</Placemark>")
+
+
+def feed(*placemarks: str) -> str:
+    return ('<?xml version="1.0" encoding="UTF-8"?><kml xmlns="http://www.opengis.net/kml/2.2">'
+            f"<Document><name>Feed</name>{''.join(placemarks)}</Document></kml>")
+
+
+def canonical(kml: str | bytes) -> str:
+    """C14N form of a document, without its XML declaration."""
+    if isinstance(kml, bytes):
+        kml = kml.decode("utf-8")
+    return ET.canonicalize(kml.split("?>", 1)[1] if kml.startswith("<?xml") else kml)
@@ -0,0 +1,106 @@
+"""kml_proxy_asgi driven through its ASGI callable against the fake upstream."""
+import asyncio
+import io
+import threading
+import time
+import zipfile
+
+import pytest
+
+import kml_proxy_asgi
+from synthetic import synthetic_sources
+
+
+async def call(app, path: str, method: str = "GET", headers: dict[str, str] | None = None) -> tuple:
+    """One HTTP request through app; returns (status, headers, body)."""
+    path, _, query = path.partition("?")
+    headers = {"host": "localhost", **(headers or {})}
+    scope = {"type": "http", "method": method, "path": path, "query_string": query.encode("latin-1"),
+             "headers": [(k.encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()],
+             "scheme": "http", "server": ("127.0.0.1", 8000)}
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    start, body = sent
+    return start["status"], {k.decode("latin-1"): v.decode("latin-1") for k, v in start["headers"]}, body["body"]
+
+
+@pytest.fixture
+def serve(proxy, upstream):
+    """Runs `scenario(app)` on a fresh app and loop, stopping the app's tasks and pools afterwards."""
+    upstream.docs["/recent"], upstream.docs["/full"] = synthetic_sources(30, time.time(),
+                                                                        icon_base=upstream.base + "/icons/")
+
+    def run(scenario):
+        async def main():
+            app = kml_proxy_asgi.KmlProxyAsgi()
+            try:
+                return await scenario(app)
+            finally:
+                await app._stop()
+        return asyncio.run(main())
+
+    return run
+
+
+def test_mapmil_and_etag(serve, proxy):
+    async def scenario(app):
+        first = await call(app, "/mapmil")
+        again = await call(app, "/mapmil", headers={"if-none-match": first[1]["etag"]})
+        stale_etag = await call(app, "/mapmil", headers={"if-none-match": '"other"'})
+        return first, again, stale_etag
+
+    (status, headers, body), again, stale_etag = serve(scenario)
+    assert status == 200
+    assert headers["content-type"] == "application/xml; charset=utf-8"
+    assert body.startswith(b"<?xml") and b"<Placemark" in body
+    assert body == proxy.app.test_client().get("/mapmil").data
+    assert again[0] == 304 and again[2] == b"" and again[1]["etag"] == headers["etag"]
+    assert stale_etag[0] == 200 and stale_etag[2] == body
+
+
+def test_atak_kmz(serve, proxy, upstream):
+    async def scenario(app):
+        return await call(app, "/mapmil_atak.kmz")
+
+    status, headers, body = serve(scenario)
+    assert status == 200
+    assert headers["content-type"] == "application/vnd.google-earth.kmz"
+    assert headers["content-disposition"] == "attachment; filename=mapmil_atak.kmz"
+    kmz = zipfile.ZipFile(io.BytesIO(body))
+    doc = kmz.read("doc.kml").decode("utf-8")
+    icons = [n for n in kmz.namelist() if n.startswith("icons/")]
+    assert icons and all(f"<href>{n}</href>" in doc for n in icons)
+    assert upstream.base not in doc  # every upstream icon was prefetched and embedded
+    assert not proxy._icon_failures
+
+
+def test_not_found_and_method(serve):
+    async def scenario(app):
+        return [await call(app, path, method) for path, method in
+                [("/nope", "GET"), ("/feeds/unknown/mapmil", "GET"), ("/mapmil", "POST")]]
+
+    unknown, unknown_feed, post = serve(scenario)
+    assert unknown[0] == unknown_feed[0] == 404
+    assert post[0] == 405 and post[1]["allow"] == "GET, HEAD"
+
+
+def test_render_lock_is_taken_off_the_loop(serve, proxy, monkeypatch):
+    threads = []
+    for name in ("peek_rendered", "refresh_stats_lines", "_snapshot"):
+        original = getattr(proxy, name)
+        monkeypatch.setattr(proxy, name, lambda *a, _original=original, **kw: (
+            threads.append(threading.current_thread()), _original(*a, **kw))[1])
+
+    async def scenario(app):
+        for path in ("/mapmil", "/mapmil", "/mapmil_update.kml?since=x", "/debug/refresh"):
+            assert (await call(app, path))[0] == 200
+
+    serve(scenario)
+    assert threads and threading.main_thread() not in threads
@@ -0,0 +1,137 @@
+import os
+import time
+
+import pytest
+
+import kml_proxy as kp
+from synthetic import synthetic_sources
+
+
+class FakeRedis:
+    """The slice of redis-py RedisCacheBackend uses: get, set(nx=, px=) and the lease-release eval."""
+
+    def __init__(self):
+        self.values = {}  # key -> (expires or None, value)
+
+    def get(self, key):
+        entry = self.values.get(key)
+        if entry is None or (entry[0] is not None and entry[0] <= time.time()):
+            self.values.pop(key, None)
+            return None
+        return entry[1]
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and self.get(key) is not None:
+            return None
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        self.values[key] = (time.time() + px / 1000 if px else None, value)
+        return True
+
+    def eval(self, script, numkeys, key, owner):
+        assert script == kp.RedisCacheBackend._RELEASE_SCRIPT and numkeys == 1
+        if self.get(key) == owner.encode("utf-8"):
+            del self.values[key]
+            return 1
+        return 0
+
+
+@pytest.fixture(params=["file", "redis"])
+def backend_pair(request, tmp_path):
+    """Two backend instances over one store, like two workers."""
+    if request.param == "file":
+        return kp.FileCacheBackend(str(tmp_path / "shared")), kp.FileCacheBackend(str(tmp_path / "shared"))
+    client = FakeRedis()
+    return kp.RedisCacheBackend(client=client), kp.RedisCacheBackend(client=client)
+
+
+def test_get_set_and_ttl(backend_pair):
+    a, b = backend_pair
+    assert a.get("k") is None
+    a.set("k", b"value")
+    assert b.get("k") == b"value"
+    a.set("k", b"newer")
+    assert b.get("k") == b"newer"
+    a.set("short", b"gone soon", ttl=0.05)
+    assert b.get("short") == b"gone soon"
+    time.sleep(0.1)
+    assert b.get("short") is None
+    assert b.get("k") == b"newer"  # no TTL: stays
+
+
+def test_truncated_file_reads_as_missing(tmp_path):
+    backend = kp.FileCacheBackend(str(tmp_path / "shared"))
+    backend.set("k", b"value")
+    with open(backend._path("k"), "r+b") as f:
+        f.truncate(3)  # shorter than the expiry header
+    assert backend.get("k") is None
+
+
+def test_lease_is_exclusive_until_released(backend_pair):
+    a, b = backend_pair
+    assert a.acquire_lease("feed:refresh", 5)
+    assert not b.acquire_lease("feed:refresh", 5)
+    assert b.acquire_lease("other", 5)  # leases are per name
+    a.release_lease("feed:refresh")
+    assert b.acquire_lease("feed:refresh", 5)
+    b.release_lease("feed:refresh")
+    b.release_lease("other")
+
+
+def test_redis_lease_release_only_by_owner(monkeypatch):
+    client = FakeRedis()
+    a, b = kp.RedisCacheBackend(client=client), kp.RedisCacheBackend(client=client)
+    monkeypatch.setattr(kp, "_lease_owner", lambda: "host-a:1")
+    assert a.acquire_lease("lease", 5)
+    monkeypatch.setattr(kp, "_lease_owner", lambda: "host-b:2")
+    b.release_lease("lease")  # not b's lease: stays held
+    assert not b.acquire_lease("lease", 5)
+
+
+def test_redis_lease_expires():
+    a = kp.RedisCacheBackend(client=FakeRedis())
+    assert a.acquire_lease("lease", 0.05)
+    time.sleep(0.1)
+    assert a.acquire_lease("lease", 5)
+
+
+def test_shared_private_directory(tmp_path):
+    directory = tmp_path / "shared"
+    kp.FileCacheBackend(str(directory))
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    os.chmod(directory, 0o777)
+    with pytest.raises(RuntimeError):
+        kp.FileCacheBackend(str(directory))
+    os.chmod(directory, 0o700)
+    os.symlink(directory, tmp_path / "link")
+    with pytest.raises(RuntimeError):
+        kp.FileCacheBackend(str(tmp_path / "link"))
+
+
+def test_incomplete_backend_fails_at_construction():
+    class NoLeases(kp.CacheBackend):
+        def get(self, key):
+            return None
+
+        def set(self, key, value, ttl=None):
+            pass
+
+    with pytest.raises(TypeError):
+        NoLeases()
+
+
+def test_second_worker_adopts_published_merge(proxy, upstream, tmp_path):
+    upstream.docs["/recent"], upstream.docs["/full"] = synthetic_sources(200, time.time())
+    shared = str(tmp_path / "shared")
+    worker_a = kp.Feed(kp.DEFAULT_FEED_NAME, proxy.SOURCE_KML_RECENT, proxy.SOURCE_KML_FULL)
+    worker_b = kp.Feed(kp.DEFAULT_FEED_NAME, proxy.SOURCE_KML_RECENT, proxy.SOURCE_KML_FULL)
+
+    kml_a, gen_a = kp._refresh_shared(worker_a, kp.FileCacheBackend(shared))
+    fetched = upstream.feed_hits()
+    assert fetched == 2  # recent + full
+
+    kml_b, gen_b = kp._refresh_shared(worker_b, kp.FileCacheBackend(shared))
+    assert upstream.feed_hits() == fetched  # B went nowhere near upstream
+    assert (kml_b, gen_b) == (kml_a, gen_a)
+    assert worker_b.cache["ts"] == worker_a.cache["ts"]
+    assert [r.id for r in worker_b.cache["records"]] == [r.id for r in worker_a.cache["records"]]
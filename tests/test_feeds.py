@@ -0,0 +1,53 @@
+import threading
+import time
+
+import pytest
+import requests
+
+import kml_proxy as kp
+from synthetic import synthetic_sources
+
+def test_inline_refresh_uses_feed_interval(proxy, upstream):
+    upstream.docs["/recent"], upstream.docs["/full"] = synthetic_sources(20, time.time())
+    feed = kp.get_feed()
+    feed.refresh_interval = 3600
+    kp.get_merged_snapshot(feed)
+    hits = upstream.feed_hits()
+    feed.cache["ts"] -= 60  # older than CACHE_SECONDS, newer than the feed's interval
+    kp.get_merged_snapshot(feed)
+    assert upstream.feed_hits() == hits
+    feed.refresh_interval = 30
+    kp.get_merged_snapshot(feed)
+    assert upstream.feed_hits() == hits + 2
+
+
+def test_fetch_kml(proxy, upstream):
+    upstream.docs["/full"] = "<kml/>"
+    assert kp.fetch_kml(upstream.base + "/full") == "<kml/>"
+    with pytest.raises(requests.HTTPError):
+        kp.fetch_kml(upstream.base + "/missing")
+
+
+def test_restarting_one_refresher_leaves_stopped_ones_stopped(proxy, monkeypatch):
+    a, b = proxy.get_feed(), proxy.Feed("b", "http://127.0.0.1:9/recent", "http://127.0.0.1:9/full")
+    monkeypatch.setitem(proxy.FEEDS, "b", b)
+    a.refresh_interval = b.refresh_interval = 3600
+    gate, refreshing = threading.Event(), threading.Event()
+
+    def refresh(feed):
+        if feed is a:
+            refreshing.set()
+            gate.wait(5)
+    monkeypatch.setattr(proxy, "refresh_merged_kml", refresh)
+
+    proxy.start_background_refresh(a)
+    thread = a.refresher
+    assert refreshing.wait(5)
+    proxy.stop_background_refresh(timeout=0)  # a is still mid-refresh
+    proxy.start_background_refresh(b)
+    gate.set()
+    thread.join(5)
+    try:
+        assert not thread.is_alive()
+    finally:
+        proxy.stop_background_refresh(timeout=5)
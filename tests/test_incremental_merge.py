@@ -0,0 +1,113 @@
+"""
+merge_kml_incremental must give the same document as a full merge of the
+same sources, whichever way it maintains the sorted order: moving the few
+changed entries (_reorder) or re-sorting once past a larger churn.
+"""
+import pytest
+
+import kml_proxy as kp
+from kml_samples import FRESH, STALE, canonical, feed, placemark
+
+UNITS = 120
+
+
+def render(units: dict) -> str:
+    """units: id -> (name, age); ids ending in _route become lines."""
+    return feed(*(placemark(pm_id, name, age, line=pm_id.endswith("_route")) for pm_id, (name, age) in units.items()))
+
+
+def initial() -> tuple[dict, dict]:
+    full = {}
+    for i in range(UNITS):
+        full[f"u{i}"] = (["Alfa", "bravo", "Charlie", "Écho", " delta"][i % 5] + f" {i}", STALE if i % 4 == 0 else FRESH)
+        if i % 3 == 0:
+            full[f"u{i}_route"] = (f"rota {i}", FRESH)
+    recent = {f"u{i}": (full[f"u{i}"][0], 10) for i in range(0, UNITS, 7)}
+    return recent, full
+
+
+def add(recent, full):
+    full.update({"n1": ("Novo", FRESH), "n1_route": ("Novo rota", FRESH)})
+    recent["n2"] = ("aaa primeiro", 10)
+
+
+def remove(recent, full):
+    del full["u5"], full["u6"], full["u6_route"]
+
+
+def rename(recent, full):
+    full["u8"] = ("zzz último", full["u8"][1])
+    full["u9"] = ("Alfa 9", full["u9"][1])  # same sort key region, different name
+    recent["u14"] = ("Bravo renomeado", 10)
+
+
+def move_between_sources(recent, full):
+    recent["u10"] = full.pop("u10")  # only in recent now
+    full["u21"] = recent.pop("u21")  # only in full now
+
+
+def newer_gdh_in_full(recent, full):
+    full["u28"] = ("Full vence", 1)  # newer than recent's report of u28
+
+
+def unchanged(recent, full):
+    pass
+
+
+def big_churn(recent, full):
+    for i in range(30, 90):
+        if f"u{i}" in full:
+            full[f"u{i}"] = (f"Renomeado {UNITS - i}", full[f"u{i}"][1])
+
+
+def rename_after_resort(recent, full):
+    full["u8"] = ("Alfa 8", full["u8"][1])
+
+
+STEPS = [add, remove, rename, move_between_sources, newer_gdh_in_full, unchanged, big_churn, rename_after_resort]
+
+
+def full_merge(recent: str, full: str) -> str:
+    return kp.merge_kml_two_sources(kp.transform_kml_scales(recent), kp.transform_kml_scales(full))
+
+
+def test_churn_matches_full_merge(monkeypatch):
+    calls = []
+    reorder = kp._reorder
+    monkeypatch.setattr(kp, "_reorder", lambda *args: (calls.append(args[1]), reorder(*args)))
+
+    recent, full = initial()
+    state = kp.new_merge_state()
+    merged, _ = kp.merge_kml_incremental(state, {kp.SOURCE_PRIORITY_RECENT: render(recent),
+                                                 kp.SOURCE_PRIORITY_FULL: render(full)})
+    assert canonical(merged) == canonical(full_merge(render(recent), render(full)))
+
+    branches = {}
+    for step in STEPS:
+        calls.clear()
+        step(recent, full)
+        recent_kml, full_kml = render(recent), render(full)
+        merged, gdh_by_id = kp.merge_kml_incremental(state, {kp.SOURCE_PRIORITY_RECENT: recent_kml,
+                                                             kp.SOURCE_PRIORITY_FULL: full_kml})
+        assert canonical(merged) == canonical(full_merge(recent_kml, full_kml)), step.__name__
+        assert gdh_by_id == kp.merge_kml_two_sources_with_gdh(recent_kml, full_kml)[1], step.__name__
+        dirty = state["stats"]["placemarks"] - state["stats"]["reused"] + state["stats"]["removed"]
+        branches[step.__name__] = "reorder" if calls else ("resort" if dirty else "none")
+
+    assert branches["rename"] == branches["rename_after_resort"] == "reorder"
+    assert branches["move_between_sources"] == "reorder"
+    assert branches["big_churn"] == "resort"
+    assert branches["unchanged"] == "none"
+
+
+@pytest.mark.parametrize("changed_source", [kp.SOURCE_PRIORITY_RECENT, kp.SOURCE_PRIORITY_FULL])
+def test_unchanged_source_is_not_parsed(changed_source):
+    recent, full = initial()
+    state = kp.new_merge_state()
+    kp.merge_kml_incremental(state, {kp.SOURCE_PRIORITY_RECENT: render(recent), kp.SOURCE_PRIORITY_FULL: render(full)})
+    changed = recent if changed_source == kp.SOURCE_PRIORITY_RECENT else full
+    changed["u7"] = ("zzz mudou", 5)
+    other = kp.SOURCE_PRIORITY_FULL if changed_source == kp.SOURCE_PRIORITY_RECENT else kp.SOURCE_PRIORITY_RECENT
+    merged, _ = kp.merge_kml_incremental(state, {changed_source: render(changed), other: "<not parsed"},
+                                         unchanged={other})
+    assert canonical(merged) == canonical(full_merge(render(recent), render(full)))
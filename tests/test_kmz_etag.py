@@ -0,0 +1,42 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import kml_proxy as kp
+
+BASE_URL = "http://localhost"
+KML = """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2"><Document><name>MapMil</name>
+<Placemark id="u1"><name>Unit 1</name><Point><coordinates>-47.9,-15.8,0</coordinates></Point></Placemark>
+</Document></kml>"""
+
+
+def _at(monkeypatch, when: float) -> None:
+    """Moves the clock seen by kml_proxy to `when` (seconds since the epoch)."""
+    monkeypatch.setattr(kp.time, "time", lambda: when)
+    monkeypatch.setattr(kp.time, "localtime", lambda secs=None: time.gmtime(when if secs is None else secs))
+
+
+def _etags(monkeypatch, render) -> tuple[str, str]:
+    _at(monkeypatch, 1_700_000_000)
+    first = kp.RenderedBody(render()).etag
+    _at(monkeypatch, 1_700_003_723)  # an hour, two minutes and three seconds later
+    second = kp.RenderedBody(render()).etag
+    return first, second
+
+
+def test_simple_kmz_etag_is_stable(monkeypatch):
+    first, second = _etags(monkeypatch, lambda: kp.build_kmz_simple(KML))
+    assert first == second
+
+
+def test_atak_kmz_etag_is_stable(monkeypatch):
+    first, second = _etags(monkeypatch, lambda: kp.build_kmz_with_embedded_icons(KML, BASE_URL))
+    assert first == second
+
+
+def test_streamed_atak_kmz_etag_is_stable(monkeypatch):
+    first, second = _etags(monkeypatch, lambda: b"".join(kp.iter_kmz_with_embedded_icons_text(KML, BASE_URL)))
+    assert first == second
@@ -0,0 +1,98 @@
+"""
+/mapmil_update.kml applied to the base document a client already holds must
+give the current base, whether the client's token is known or has to be resynced.
+"""
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import kml_proxy as kp
+from conftest import BASE_URL
+from kml_samples import FRESH, STALE, feed, placemark
+
+NS = "{http://www.opengis.net/kml/2.2}"
+
+BEFORE = feed(
+    placemark("a", "Alfa", FRESH),
+    placemark("b", "Bravo", STALE),
+    placemark("c", "Charlie", FRESH),
+    placemark("c_route", "Charlie rota", FRESH, line=True),
+    placemark("d", "Delta", FRESH),
+)
+AFTER = feed(
+    placemark("a", "Alfa 2", FRESH),                   # renamed: a Change
+    placemark("b", "Bravo", FRESH),                    # fresh again: leaves the inativos folder
+    placemark("c", "Charlie", FRESH, lon=-8.5),        # moved: replaced
+    placemark("c_route", "Charlie rota", FRESH, line=True),
+    placemark("e", "Eco", STALE),                      # new, straight into the inativos folder
+)                                                      # d removed
+
+
+def apply_update(doc: ET.Element, update: bytes) -> str:
+    """Applies an <Update> the way Google Earth does; returns the cookie's token."""
+    nlc = ET.fromstring(update).find(NS + "NetworkLinkControl")
+    by_id = lambda: {el.get("id"): (parent, el) for parent in doc.iter() for el in parent if el.get("id")}
+    for op in nlc.find(NS + "Update") or ():
+        for target in op:
+            parent, el = by_id().get(target.get("targetId"), (None, None))
+            if op.tag == NS + "Delete":
+                if el is not None:
+                    parent.remove(el)
+            elif op.tag == NS + "Create":
+                (el if el is not None else doc.find(NS + "Document")).extend(target)
+            else:
+                for child in target:
+                    old = el.find(child.tag)
+                    el[list(el).index(old)] = child
+    return nlc.findtext(NS + "cookie").split("=", 1)[1]
+
+
+def outline(doc: ET.Element) -> list[tuple]:
+    """(parent id, id, tag, serialized simple children) of every Folder/Placemark, order-free."""
+    out = []
+    for parent in doc.iter():
+        for el in parent:
+            if el.tag in (NS + "Folder", NS + "Placemark"):
+                leaves = tuple(ET.tostring(c).strip() for c in el if c.tag not in (NS + "Folder", NS + "Placemark"))
+                out.append((parent.get("id"), el.get("id"), el.tag, leaves))
+    return sorted(out)
+
+
+@pytest.fixture
+def live(proxy, upstream):
+    """Serves BEFORE, returns (client, base document, token) as a client would hold them."""
+    upstream.docs["/recent"] = upstream.docs["/full"] = BEFORE
+    client = kp.app.test_client()
+    base = ET.fromstring(client.get("/mapmil_live_base.kml").data)
+    token = kp.live_snapshot(BASE_URL)[0]
+    upstream.docs["/recent"] = upstream.docs["/full"] = AFTER
+    kp.get_feed().cache["ts"] = 0  # next request refreshes inline
+    return client, base, token
+
+
+def test_update_takes_old_base_to_new_base(live):
+    client, base, token = live
+    update = client.get(f"/mapmil_update.kml?since={token}").data
+    new_token = apply_update(base, update)
+    assert new_token != token
+    expected = outline(ET.fromstring(client.get("/mapmil_live_base.kml").data))
+    assert outline(base) == expected
+    assert b"<Change>" in update.replace(b"kml:", b"")  # the rename is not a replace
+    apply_update(base, update)  # Google Earth may apply an update twice
+    assert outline(base) == expected
+    assert apply_update(base, client.get(f"/mapmil_update.kml?since={new_token}").data) == new_token
+    assert outline(base) == expected
+
+
+@pytest.mark.parametrize("evict", [False, True], ids=["unknown_since", "evicted"])
+def test_resync(live, monkeypatch, evict):
+    client, base, token = live
+    since = token
+    if evict:
+        monkeypatch.setattr(kp, "MEMORY_BUDGET_BYTES", 1)
+        kp.live_snapshot("http://other")  # evicts BASE_URL's live state, sparing its own
+        assert BASE_URL not in kp.get_feed().live_usage
+    else:
+        since = "123.456"
+    apply_update(base, client.get(f"/mapmil_update.kml?since={since}").data)
+    assert outline(base) == outline(ET.fromstring(client.get("/mapmil_live_base.kml").data))
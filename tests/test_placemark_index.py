@@ -0,0 +1,90 @@
+"""
+PlacemarkIndex.query against a per-record scan, and the error KML a malformed
+?bbox= / ?stale= gets.
+"""
+import re
+
+import pytest
+
+import kml_proxy as kp
+from kml_samples import FRESH, NOW, STALE, feed, placemark
+
+DOC = feed(
+    placemark("a", "Alfa Um", FRESH, lon=-9.0, lat=38.0),
+    placemark("a_route", "Alfa rota", FRESH, line=True, lon=-9.0, lat=38.0),
+    placemark("b", "Bravo", STALE, lon=-8.0, lat=39.0),
+    placemark("c", "Charlie Alfa", FRESH, lon=10.0, lat=50.0),
+    placemark("d", "Delta", STALE, lon=-8.95, lat=38.05),
+    '<Placemark id="n"><name>Alfa sem posição</name></Placemark>',     # no coordinates, no GDH
+    '<Placemark id="long"><name>Longa</name><LineString><coordinates>'  # wider than INDEX_MAX_CELLS_PER_ITEM
+    '-20,30,0 20,45,0</coordinates></LineString></Placemark>',
+)
+
+QUERIES = [
+    {"bbox": (-9.1, 37.9, -8.9, 38.2)},
+    {"bbox": (-8.1, 38.9, -7.9, 39.1)},
+    {"bbox": (-180.0, -90.0, 180.0, 90.0)},
+    {"bbox": (100.0, 0.0, 101.0, 1.0)},
+    {"ids": ["a", "b", "c", "n", "missing"], "bbox": (-9.1, 37.9, -7.9, 39.1)},
+    {"ids": ["n", "c"], "bbox": (-180.0, -90.0, 180.0, 90.0)},
+    {"name": "alfa", "stale": False},
+    {"name": "alfa", "stale": True},
+    {"name": "Delta", "stale": True},
+    {"name": "lfa"},
+    {"stale": True},
+    {"stale": False, "bbox": (-9.1, 37.9, -8.9, 38.2)},
+    {"ids": ["d"], "name": "delta", "stale": True},
+]
+
+
+@pytest.fixture(scope="module")
+def index():
+    return kp.PlacemarkIndex(kp.records_from_kml(DOC))
+
+
+def scan(index: kp.PlacemarkIndex, bbox=None, stale=None, name=None, ids=None) -> list[int]:
+    found = set()
+    for pos, rec in enumerate(index.records):
+        box = rec.bbox()
+        if ids is not None and rec.id not in ids:
+            continue
+        if bbox is not None and (box is None or not kp._intersects(box, bbox)):
+            continue
+        if name and not re.search(r"(?:^|\s)" + re.escape(name.lower()), (rec.name or "").strip().lower()):
+            continue
+        if stale is not None and rec.is_stale(NOW, index.stale_threshold) != stale:
+            continue
+        found.add(pos)
+    return sorted(index.with_routes(found))
+
+
+@pytest.mark.parametrize("query", QUERIES, ids=lambda q: ",".join(sorted(q)))
+def test_query_matches_scan(index, query):
+    assert index.query(now=NOW, **query) == scan(index, **query)
+
+
+def test_query_results(index):
+    ids = lambda **query: {index.ids[p] for p in index.query(now=NOW, **query)}
+    assert ids(bbox=(-9.1, 37.9, -8.9, 38.2)) == {"a", "a_route", "d", "long"}
+    assert ids(bbox=(100.0, 0.0, 101.0, 1.0)) == set()
+    assert "n" not in ids(bbox=(-180.0, -90.0, 180.0, 90.0))
+    assert ids(ids=["n", "c"], bbox=(-180.0, -90.0, 180.0, 90.0)) == {"c"}
+    assert ids(name="alfa", stale=False) == {"a", "a_route", "c", "n"}
+    assert ids(name="delta", stale=True) == {"d"}
+    assert ids(name="alfa", stale=True) == set()
+
+
+@pytest.mark.parametrize("args", ["bbox=-9,38,-10", "bbox=-8,38,-9,39", "bbox=a,b,c,d", "stale=maybe"])
+def test_invalid_query_returns_error_kml(proxy, upstream, args):
+    upstream.docs["/recent"] = upstream.docs["/full"] = DOC
+    resp = kp.app.test_client().get(f"/mapmil?{args}")
+    assert resp.status_code == 200
+    assert b"<name>KML Proxy Error</name>" in resp.data
+    assert b"<name>Alfa Um</name>" not in resp.data
+
+
+def test_query_endpoint(proxy, upstream):
+    upstream.docs["/recent"] = upstream.docs["/full"] = DOC
+    body = kp.app.test_client().get("/mapmil?bbox=-8.1,38.9,-7.9,39.1&stale=true").data
+    assert b"Bravo" in body
+    assert b"Alfa" not in body and b"Delta" not in body
@@ -0,0 +1,44 @@
+"""Renders from RENDER_PROCESSES workers must equal the in-process ones, KMZ contents included."""
+import io
+import time
+import zipfile
+
+import pytest
+
+from synthetic import synthetic_sources
+
+PATHS = ["/mapmil", "/mapmil.kml", "/mapmil.kmz", "/mapmil_atak.kmz"]
+
+
+def contents(path: str, body: bytes):
+    if not path.endswith(".kmz"):
+        return body
+    kmz = zipfile.ZipFile(io.BytesIO(body))
+    return {name: kmz.read(name) for name in kmz.namelist()}
+
+
+def render_all(kp) -> dict:
+    for feed in kp.FEEDS.values():
+        feed.render_cache.clear()
+    client = kp.app.test_client()
+    return {path: contents(path, client.get(path).data) for path in PATHS}
+
+
+@pytest.fixture
+def processes(proxy, monkeypatch):
+    yield lambda n: monkeypatch.setattr(proxy, "RENDER_PROCESSES", n)
+    proxy.stop_render_processes()
+
+
+def test_worker_output_matches_in_process(proxy, upstream, processes):
+    # Ages keep clear of the stale threshold, so both runs flag the same units
+    upstream.docs["/recent"], upstream.docs["/full"] = synthetic_sources(60, time.time(),
+                                                                        icon_base=upstream.base + "/icons/")
+    expected = render_all(proxy)
+    processes(2)
+    got = render_all(proxy)
+    assert proxy.get_feed().render_document is not None  # really rendered by the workers
+    assert got.keys() == expected.keys()
+    for path in PATHS:
+        assert got[path] == expected[path], path
+    assert any(name.startswith("icons/") for name in got["/mapmil_atak.kmz"])
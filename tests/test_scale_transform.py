@@ -0,0 +1,42 @@
+"""
+transform_kml_scales (the regex original) and scale_styles_in_tree must scale
+the same styles the same way, whichever parts of a <Style> are missing.
+"""
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import kml_proxy as kp
+from kml_samples import canonical
+
+ICON = "<Icon><href>https://example.test/i.png</href></Icon>"
+
+STYLES = {
+    "existing_scales": f"<Style><IconStyle><scale>1</scale>{ICON}</IconStyle><LabelStyle><scale>1</scale></LabelStyle></Style>",
+    "missing_scales": f"<Style><IconStyle>{ICON}</IconStyle><LabelStyle><color>ff00ffff</color></LabelStyle></Style>",
+    "icon_style_without_icon": "<Style><IconStyle><scale>1</scale><color>ff0000ff</color></IconStyle></Style>",
+    "empty_icon_style": "<Style><IconStyle></IconStyle><LabelStyle><scale>2</scale></LabelStyle></Style>",
+    "label_style_only": "<Style><LabelStyle><scale>1</scale></LabelStyle></Style>",
+    "no_icon_or_label_style": "<Style><LineStyle><width>2</width></LineStyle></Style>",
+    "padded_scale": f"<Style><IconStyle>\n  <scale> 1.5 </scale>\n  {ICON}\n</IconStyle></Style>",
+    "style_with_id": f'<Style id="s1"><IconStyle id="i1"><scale>1</scale>{ICON}</IconStyle></Style>',
+}
+
+
+def document(style: str) -> str:
+    return ('<?xml version="1.0" encoding="UTF-8"?><kml xmlns="http://www.opengis.net/kml/2.2"><Document>'
+            f'{style}<Placemark id="a"><name>Alfa</name><styleUrl>#s1</styleUrl>{style}'
+            '<Point><coordinates>-9,38,0</coordinates></Point></Placemark>'
+            '<Placemark id="b"><name>Bravo</name><StyleMap><Pair><key>normal</key>'
+            f'{style}</Pair></StyleMap><Point><coordinates>-8,38,0</coordinates></Point></Placemark>'
+            '</Document></kml>')
+
+
+@pytest.mark.parametrize("style", STYLES.values(), ids=STYLES.keys())
+def test_regex_transform_matches_tree(style):
+    kml = document(style)
+    root = ET.fromstring(kml.encode("utf-8"))
+    kp.scale_styles_in_tree(root)
+    expected = canonical(kp.serialize_kml(root))
+    assert canonical(kp.transform_kml_scales(kml)) == expected
+    assert expected.count(str(kp.ICON_SCALE)) >= 3  # document, placemark and StyleMap styles